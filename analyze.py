@@ -1,117 +1,2479 @@
+from __future__ import annotations
 import sys
 import os
-from pathlib import Path
-from bs4 import BeautifulSoup, Tag
-import sqlite3
-from sqlite3 import Connection
-import csv
-from typing import List, Tuple, Any
+import hashlib
+import html
+import json
+import math
+import mmap
+import random
+import re
+import threading
+import time
+import zlib
+from contextlib import contextmanager, nullcontext
+from collections import deque
+from array import array
+from itertools import chain, groupby, islice
+from html.parser import HTMLParser
+from typing import List, Tuple, Any, Callable, Dict, Iterator, Iterable, TYPE_CHECKING
+
+# Modules that only some parsers, backends and modes need are imported where they are
+# used, so that startup (e.g. one file per pre-commit hook run) doesn't pay for them:
+# bs4, sqlite3, csv, subprocess, concurrent.futures, socket
+if TYPE_CHECKING:
+    from sqlite3 import Connection, Cursor
+    from concurrent.futures import Executor
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
 
 type TagEntry = tuple[str, str, int, str]
 
-def get_filepaths(path: str) -> List[str]:
+# Tags whose class attributes are collected by parse_html by default
+TARGET_TAGS = ("div",)
+# Tag name that matches every tag
+ALL_TAGS = "*"
+
+# File extensions analyzed in a directory by default
+DEFAULT_EXTENSIONS = (".html",)
+# Files in the analyzed tree whose .gitignore-style rules prune the walk
+IGNORE_FILES = (".gitignore",)
+# Directories skipped whenever ignore files are honored, as git itself does
+IGNORED_DIRS = frozenset([".git"])
+
+# An ignore rule: (directory it applies under, relative to the walk root, compiled
+# pattern, negated, directories only, anchored to that directory)
+type IgnoreRule = tuple[str, re.Pattern, bool, bool, bool]
+
+def get_filepaths(path: str, extensions: Tuple[str, ...] = DEFAULT_EXTENSIONS, excludes: Tuple[str, ...] = (), ignore_files: bool = True, follow_symlinks: bool = False) -> List[str]:
+    """
+    path: a path to a file or directory
+    extensions, excludes, ignore_files, follow_symlinks: as for iter_filepaths
+
+    returns: a list of the paths of every file under the directory whose name ends in one
+             of extensions, leaving out files and directories matched by excludes and (if
+             ignore_files) by .gitignore files or IGNORED_DIRS, in the order iter_filepaths
+             walks them. It is empty if there are none, or a list of a single filepath if
+             path is to a file.
+             If the path is invalid, raise an error
+    """
+    return list(iter_filepaths(path, extensions, excludes, ignore_files, follow_symlinks))
+
+def iter_filepaths(path: str, extensions: Tuple[str, ...] = DEFAULT_EXTENSIONS, excludes: Tuple[str, ...] = (), ignore_files: bool = True, follow_symlinks: bool = False) -> Iterator[str]:
+    """
+    path: a path to a file or directory
+    extensions: file name endings of the files to yield from a directory
+    excludes: .gitignore-style patterns, relative to path, of files and directories to skip
+    ignore_files: honor the rules in any IGNORE_FILES found in the directory, and skip IGNORED_DIRS
+    follow_symlinks: also walk symlinked directories, each real directory only once
+
+    returns: an iterator over the paths of all matching files in the directory, yielded
+             lazily as the directory is walked, or over path alone if path is to a file.
+             If the path is invalid, raise an error immediately
+    """
+
+    if (os.path.isfile(path)):
+        return iter([path])
+    elif (os.path.isdir(path)):
+        exclude_rules = [rule for pattern in excludes if (rule := parse_ignore_pattern(normalize_exclude(pattern), "")) is not None]
+        return _walk_files(path, tuple(extensions), exclude_rules, ignore_files, follow_symlinks)
+    
+    raise FileNotFoundError(f"\'{path}\' is not a path to a file or directory.")
+
+def normalize_exclude(pattern: str) -> str:
+    """
+    Return an --exclude pattern with its leading "./" removed. As "./" stands for the
+    analyzed directory, the rest of the pattern is anchored there, e.g. "./dist" becomes
+    "/dist", instead of matching nothing.
+    """
+    negate = "!" if pattern.startswith("!") else ""
+    body = pattern[len(negate):]
+    if not body.startswith("./"):
+        return pattern
+    while body.startswith("./"):
+        body = body[2:].lstrip("/")
+    return negate + "/" + body
+
+def _glob_regex(pattern: str) -> str:
+    """
+    Translate a .gitignore glob to a regex over "/"-separated paths: * and ? don't match
+    "/", a leading "**/" matches any number of directories, a trailing "/**" everything
+    inside and "/**/" zero or more directories
+    """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**", i) and (i == 0 or pattern[i-1] == "/") and (i + 2 == len(pattern) or pattern[i+2] == "/"):
+            if i + 2 == len(pattern):
+                parts.append(".*")
+                i += 2
+            else:
+                parts.append("(?:.*/)?")
+                i += 3
+        elif char == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif char == "?":
+            parts.append("[^/]")
+            i += 1
+        elif char == "[" and (close := pattern.find("]", i + 2)) != -1:
+            body = pattern[i+1:close]
+            if body[0] in "!^":
+                body = "^" + body[1:]
+            parts.append("[" + body.replace("\\", "\\\\") + "]")
+            i = close + 1
+        elif char == "\\" and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i+1]))
+            i += 2
+        else:
+            parts.append(re.escape(char))
+            i += 1
+    return "".join(parts)
+
+def parse_ignore_pattern(line: str, base: str) -> IgnoreRule | None:
+    """
+    Compile one line of a .gitignore file in the directory base (relative to the walk
+    root, "" for the root), or None for blank lines and comments
+    """
+    line = line.rstrip("\n\r")
+    # Trailing spaces are ignored unless escaped
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        stripped += " "
+    line = stripped
+    if not line or line.startswith("#"):
+        return None
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    elif line.startswith("\\#") or line.startswith("\\!"):
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    # A pattern with a "/" before its end matches paths relative to base; otherwise
+    # it matches a file or directory name at any depth
+    anchored = "/" in line
+    return (base, re.compile(_glob_regex(line.lstrip("/"))), negate, dir_only, anchored)
+
+def read_ignore_file(file_path: str, base: str) -> List[IgnoreRule]:
+    try:
+        with open(file_path, encoding="utf-8", errors="replace") as f:
+            return [rule for line in f if (rule := parse_ignore_pattern(line, base)) is not None]
+    except OSError:
+        return []
+
+def is_ignored(rules: List[IgnoreRule], rel_path: str, name: str, is_dir: bool) -> bool:
+    """
+    Return whether the last of rules that matches rel_path (relative to the walk root) is
+    an ignore rather than a negated rule
+    """
+    for base, regex, negate, dir_only, anchored in reversed(rules):
+        if dir_only and not is_dir:
+            continue
+        if anchored:
+            if base and not rel_path.startswith(base + "/"):
+                continue
+            matched = regex.fullmatch(rel_path[len(base) + 1:] if base else rel_path)
+        else:
+            matched = regex.fullmatch(name)
+        if matched:
+            return not negate
+    return False
+
+def _walk_files(root: str, extensions: Tuple[str, ...], exclude_rules: List[IgnoreRule], ignore_files: bool, follow_symlinks: bool) -> Iterator[str]:
+    """
+    Walk root with os.scandir, top-down in the order of os.walk, yielding each matching
+    file as soon as its directory is read. Ignored and excluded directories are pruned
+    before they are opened, and unreadable directories are skipped like os.walk does.
+    """
+    # (directory path, path relative to root, ignore rules in effect)
+    stack = [(root, "", [])]
+    visited = set()
+    if follow_symlinks:
+        stat = os.stat(root)
+        visited.add((stat.st_dev, stat.st_ino))
+    while stack:
+        dir_path, rel_dir, rules = stack.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        if ignore_files:
+            for entry in entries:
+                if entry.name in IGNORE_FILES and entry.is_file():
+                    rules = rules + read_ignore_file(entry.path, rel_dir)
+        subdirs = []
+        for entry in entries:
+            name = entry.name
+            rel_path = f"{rel_dir}/{name}" if rel_dir else name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                if ignore_files and name in IGNORED_DIRS:
+                    continue
+            elif not name.endswith(extensions):
+                continue
+            if (rules and is_ignored(rules, rel_path, name, is_dir)) or (exclude_rules and is_ignored(exclude_rules, rel_path, name, is_dir)):
+                continue
+            if not is_dir:
+                yield entry.path
+            elif entry.is_symlink() and not follow_symlinks:
+                continue
+            else:
+                if follow_symlinks:
+                    # Only walk each real directory once, so symlink loops end
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    if (stat.st_dev, stat.st_ino) in visited:
+                        continue
+                    visited.add((stat.st_dev, stat.st_ino))
+                subdirs.append((entry.path, rel_path, rules))
+        stack.extend(reversed(subdirs))
+
+class ClassAttrExtractor(HTMLParser):
+    """
+    Streaming html.parser handler that records (tag_name, classes) for every start tag
+    in tags (or any tag, if tags contains ALL_TAGS) that has a class attribute, without
+    building a document tree.
+    Attribute handling mirrors BeautifulSoup's html.parser builder: a valueless class
+    attribute counts as empty and the last of duplicate class attributes wins.
+    """
+
+    def __init__(self, tags: Tuple[str, ...] = TARGET_TAGS) -> None:
+        # BeautifulSoup also runs html.parser with convert_charrefs off
+        super().__init__(convert_charrefs=False)
+        self.tags = None if ALL_TAGS in tags else frozenset(tags)
+        self.found: List[Tuple[str, List[str]]] = []
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, str | None]]) -> None:
+        if self.tags is not None and tag not in self.tags:
+            return
+
+        class_value = None
+        for key, value in attrs:
+            if key == "class":
+                class_value = "" if value is None else value
+        if class_value is not None:
+            self.found.append((tag, class_value.split()))
+
+def extract_stream(content: str, tags: Tuple[str, ...] = TARGET_TAGS) -> List[Tuple[str, List[str]]]:
+    """
+    Return (tag_name, classes) for each tag in tags with a class attribute in content,
+    in document order, using the streaming ClassAttrExtractor.
+    """
+    extractor = ClassAttrExtractor(tags)
+    extractor.feed(content)
+    extractor.close()
+    return extractor.found
+
+def extract_bs4(content: str, tags: Tuple[str, ...] = TARGET_TAGS) -> List[Tuple[str, List[str]]]:
+    """
+    Return (tag_name, classes) for each tag in tags with a class attribute in content,
+    in document order, using a full BeautifulSoup tree.
+    """
+    from bs4 import BeautifulSoup, Tag
+
+    soup = BeautifulSoup(content, "html.parser")
+    all_elements = soup.find_all(True if ALL_TAGS in tags else list(tags))
+    tags = [elem for elem in all_elements if isinstance(elem, Tag)]
+
+    found = []
+    for tag in tags:
+        class_attr = tag.attrs.get("class")
+        if class_attr is None:
+            continue
+        found.append((tag.name, list(class_attr)))
+    return found
+
+# Elements that never have children or an end tag
+VOID_ELEMENTS = frozenset(["area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"])
+
+# Size in bytes of the digest that identifies a subtree
+SUBTREE_DIGEST_SIZE = 16
+# Longest subtree skeleton kept for display; longer ones are cut off and end in "..."
+MAX_SKELETON_LENGTH = 1000
+# Separates a subtree's digest from its skeleton in the first entry of each subtree in a file
+SKELETON_SEPARATOR = "\t"
+
+class SubtreeExtractor(HTMLParser):
+    """
+    Streaming html.parser handler that fingerprints the element structure of a document
+    bottom-up. When an element closes, its digest is computed with blake2b from its tag,
+    sorted classes and the digests of its children, so identical subtrees get the same
+    fixed-size digest in one linear pass, however large or deeply nested they are.
+
+    Records (tag_name, key, num_classes) for every element in tags (or any element, if
+    tags contains ALL_TAGS) that has at least one child element. key is the hex digest of
+    the element's subtree, except for the first element with each digest, where it is
+    followed by SKELETON_SEPARATOR and the subtree's skeleton for display: the subtree as
+    html with only tags and sorted classes, cut off at MAX_SKELETON_LENGTH. Text and
+    attributes other than class are ignored. Unclosed elements are closed by the end tag
+    of an element containing them, or at the end of the document.
+    """
+
+    def __init__(self, tags: Tuple[str, ...] = TARGET_TAGS) -> None:
+        super().__init__(convert_charrefs=False)
+        self.tags = None if ALL_TAGS in tags else frozenset(tags)
+        self.found: List[Tuple[str, str, int]] = []
+        # Skeleton of each distinct subtree, by digest
+        self.skeletons: Dict[bytes, str] = {}
+        # Digests of the subtrees recorded so far
+        self.recorded: set = set()
+        # [tag, classes, child digests] of each open element
+        self.open: List[List] = []
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, str | None]]) -> None:
+        class_value = ""
+        for key, value in attrs:
+            if key == "class":
+                class_value = value or ""
+        element = [tag, " ".join(sorted(set(class_value.split()))), []]
+        if tag in VOID_ELEMENTS:
+            self.close_element(element)
+        else:
+            self.open.append(element)
+
+    def handle_startendtag(self, tag: str, attrs: List[Tuple[str, str | None]]) -> None:
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.close_element(self.open.pop())
+
+    def handle_endtag(self, tag: str) -> None:
+        # Ignore end tags without a matching open element
+        if not any(element[0] == tag for element in self.open):
+            return
+        while True:
+            element = self.open.pop()
+            self.close_element(element)
+            if element[0] == tag:
+                return
+
+    def close(self) -> None:
+        super().close()
+        while self.open:
+            self.close_element(self.open.pop())
+
+    def close_element(self, element: List) -> None:
+        tag, classes, children = element
+        # Tag names have no spaces and classes are length-prefixed, so the header is unambiguous
+        header = f"{tag} {len(classes)} {classes}".encode("utf-8", "surrogatepass")
+        digest = hashlib.blake2b(header + b"".join(children), digest_size=SUBTREE_DIGEST_SIZE).digest()
+        if digest not in self.skeletons:
+            self.skeletons[digest] = self.render(tag, classes, children)
+
+        if self.open:
+            self.open[-1][2].append(digest)
+        if children and (self.tags is None or tag in self.tags):
+            key = digest.hex()
+            if digest not in self.recorded:
+                self.recorded.add(digest)
+                key += SKELETON_SEPARATOR + self.skeletons[digest]
+            self.found.append((tag, key, len(classes.split())))
+
+    def render(self, tag: str, classes: str, children: List[bytes]) -> str:
+        """
+        Return the skeleton of an element from those of its children, only joining as many
+        children as fit in MAX_SKELETON_LENGTH so the work per element stays bounded
+        """
+        parts = [f"<{tag} class=\"{html.escape(classes)}\">" if classes else f"<{tag}>"]
+        length = len(parts[0])
+        for child in children:
+            if length > MAX_SKELETON_LENGTH:
+                break
+            parts.append(self.skeletons[child])
+            length += len(parts[-1])
+        if tag not in VOID_ELEMENTS:
+            parts.append(f"</{tag}>")
+        skeleton = "".join(parts)
+        if len(skeleton) > MAX_SKELETON_LENGTH:
+            skeleton = skeleton[:MAX_SKELETON_LENGTH] + "..."
+        return skeleton
+
+def extract_subtrees(content: str, tags: Tuple[str, ...] = TARGET_TAGS) -> List[Tuple[str, str, int]]:
+    """
+    Return (tag_name, key, num_classes) for each element in tags with child elements in
+    content, using the streaming SubtreeExtractor. key is the hex digest of the element's
+    subtree, so identical subtrees have identical keys, and the first element with each
+    digest also carries its skeleton (see split_skeletons). Elements are listed in the
+    order they close.
+    """
+    extractor = SubtreeExtractor(tags)
+    extractor.feed(content)
+    extractor.close()
+    return extractor.found
+
+def split_skeletons(entries: Iterable[Tuple], skeletons: Dict[str, str]) -> List[Tuple]:
+    """
+    Return --subtrees entries (of any length, with the key second) keyed on their bare
+    subtree digests, moving the skeletons carried by the first entry of each subtree in a
+    file into skeletons, by digest
+    """
+    split = []
+    for entry in entries:
+        digest, separator, skeleton = entry[1].partition(SKELETON_SEPARATOR)
+        if separator:
+            skeletons[digest] = skeleton
+            entry = (entry[0], digest) + entry[2:]
+        split.append(entry)
+    return split
+
+def show_skeletons(rows: Iterable[Tuple], skeletons: Dict[str, str], column: int = 2) -> Iterator[Tuple]:
+    """
+    Yield output rows with the subtree digest in column replaced by its skeleton, for display
+    """
+    for row in rows:
+        yield row[:column] + (skeletons.get(row[column], row[column]),) + row[column + 1:]
+
+# Parser backends available to parse_html, by name
+PARSERS: Dict[str, Callable[[str, Tuple[str, ...]], List[Tuple[str, List[str]]]]] = {
+    "stream": extract_stream,
+    "bs4": extract_bs4,
+}
+DEFAULT_PARSER = "stream"
+
+def parse_html(content: str, file_path: str, parser: str = DEFAULT_PARSER, verify: bool = False, tags: Tuple[str, ...] = TARGET_TAGS, subtrees: bool = False) -> List[TagEntry]:
+    """
+    Given a file_path and its content, return a 4-tuple for each tag in the file:
+    (tag_name, class_strs, num_classes, file_path), where class_strs is a alphabetically sorted,
+    space separated string of classes in the tag. 
+
+    parser selects the extraction backend from PARSERS. If verify is True, the result is
+    also computed with the BeautifulSoup backend and a ValueError is raised if they differ.
+    tags are the tag names to collect, in a single pass over content; ALL_TAGS collects every tag.
+
+    If subtrees is True, each tag in tags with child elements is returned with its subtree
+    key from extract_subtrees in place of class_strs, and num_classes is the number of
+    classes on the tag itself. parser and verify don't apply to subtrees.
+    """
+    if subtrees:
+        return [(name, key, num_classes, file_path) for name, key, num_classes in extract_subtrees(content, tags)]
+
+    data = []
+    for name, class_attr in PARSERS[parser](content, tags):
+        classes = sorted(set(class_attr))
+        num_classes = len(classes)
+        class_strs = " ".join(str(class_name) for class_name in classes)
+        data.append((name, class_strs, num_classes, file_path))
+
+    if verify and parser != "bs4":
+        expected = parse_html(content, file_path, "bs4", tags=tags)
+        if data != expected:
+            raise ValueError(f"Error: {parser} parser output differs from bs4 for \'{file_path}\'")
+
+    return data
+
+def peak_rss() -> int | None:
+    """
+    Return the peak resident memory of this process in bytes, or None if it is unavailable
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+class RunStats:
+    """
+    Wall time and cpu time of each stage of a run (walk, cache, read, parse, ingest, query,
+    write), plus counters, for the --stats output. Read and parse times from worker
+    processes are summed over all workers. profiler, if set, is a cProfile profiler that
+    is enabled around parse_html calls in this process.
+
+    Stages run in this process (walk, cache, ingest, ...) only time their own calls; timed
+    only counts the time spent inside next() of the wrapped iterator. With worker processes
+    or io threads running at the same time, though, those calls also wait for the cpu and
+    the GIL, so their wall times overlap with the workers' and can be far above their cpu
+    times. Compare cpu times to see what a stage itself costs in a parallel run.
+
+    Each stage also records the process's peak resident memory by the end of the stage.
+    That peak is a high-water mark over the whole run so far (of the worker processes,
+    for stages run in them), so it never goes down from one stage to the next, and a
+    stage only used memory of its own if its value is higher than the stages before it.
+    """
+
+    def __init__(self, profiler=None) -> None:
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.counts: Dict[str, int] = {}
+        self.profiler = profiler
+
+    def add_time(self, stage: str, wall_seconds: float, cpu_seconds: float, max_rss_bytes: int | None = None) -> None:
+        timing = self.stages.setdefault(stage, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "max_rss_so_far_bytes": None})
+        timing["wall_seconds"] += wall_seconds
+        timing["cpu_seconds"] += cpu_seconds
+        if max_rss_bytes is None:
+            max_rss_bytes = peak_rss()
+        if max_rss_bytes is not None:
+            timing["max_rss_so_far_bytes"] = max(timing["max_rss_so_far_bytes"] or 0, max_rss_bytes)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """
+        Add the time spent in the with block to stage. The cpu time is that of the calling
+        thread only, so it leaves out pool threads working at the same time.
+        """
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def timed(self, stage: str, items: Iterable) -> Iterator:
+        """
+        Yield from items, adding the time spent producing each item to stage
+        """
+        iterator = iter(items)
+        while True:
+            with self.stage(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add_file(self, entries: List[Tuple[str, str, int]], file_stats: Dict[str, Any]) -> List[Tuple[str, str, int]]:
+        """
+        Record the result of analyze_file_stats, returning its entries
+        """
+        for stage in ["read", "parse"]:
+            self.add_time(stage, *file_stats[stage], file_stats["max_rss_bytes"])
+        self.count("bytes", file_stats["bytes"])
+        if file_stats["skipped"]:
+            self.count("skipped_files")
+        return entries
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"stages": self.stages, "counts": self.counts}
+
+    def summary(self) -> str:
+        """
+        Return the stage timings and counters as a text table
+        """
+        lines = [f"{'stage':<8} {'wall (s)':>10} {'cpu (s)':>10} {'max rss so far (MB)':>20}"]
+        for stage, timing in self.stages.items():
+            rss = "-" if timing["max_rss_so_far_bytes"] is None else f"{timing['max_rss_so_far_bytes'] / 2**20:.1f}"
+            lines.append(f"{stage:<8} {timing['wall_seconds']:>10.3f} {timing['cpu_seconds']:>10.3f} {rss:>20}")
+        lines.append("")
+        lines += [f"{name}: {value}" for name, value in self.counts.items()]
+        return "\n".join(lines)
+
+# Files of at least this many bytes are memory-mapped instead of read into memory
+MMAP_THRESHOLD = 1 << 20
+
+def read_file_raw(file_path: str) -> bytes | mmap.mmap:
+    """
+    Return the undecoded content of the file at file_path. Files of at least MMAP_THRESHOLD
+    bytes are memory-mapped rather than copied into memory; close the mmap when done.
+    """
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return f.read()
+
+def decode_content(raw: bytes | mmap.mmap) -> str:
+    """
+    Decode raw file content as utf-8, translating \\r\\n and \\r line endings to \\n
+    the way reading the file in text mode does
+    """
+    content = str(raw, "utf-8")
+    if "\r" in content:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+    return content
+
+def read_file(file_path: str) -> str:
+    """
+    Return the utf-8 decoded content of the file at file_path
+    """
+    raw = read_file_raw(file_path)
+    try:
+        return decode_content(raw)
+    finally:
+        if isinstance(raw, mmap.mmap):
+            raw.close()
+
+def analyze_content(raw: bytes | mmap.mmap, file_path: str, parser: str = DEFAULT_PARSER, verify: bool = False, tags: Tuple[str, ...] = TARGET_TAGS, profiler=None, subtrees: bool = False) -> List[Tuple[str, str, int]]:
+    """
+    Decode and parse raw content read from file_path, returning (tag_name, class_strs, num_classes)
+    for each tag. raw is closed afterwards if it is an mmap. If profiler is given, it is
+    enabled while the content is parsed.
+    """
+    try:
+        content = decode_content(raw)
+    finally:
+        if isinstance(raw, mmap.mmap):
+            raw.close()
+
+    if profiler is not None:
+        profiler.enable()
+    try:
+        return [entry[:3] for entry in parse_html(content, file_path, parser, verify, tags, subtrees)]
+    finally:
+        if profiler is not None:
+            profiler.disable()
+
+def may_have_entries(raw: bytes | mmap.mmap, tags: Tuple[str, ...] = TARGET_TAGS, subtrees: bool = False) -> bool:
+    """
+    Cheap check of raw file content before it is decoded and parsed. Returns False only if
+    parsing it can't produce any entries: it has no start tag of any of tags, or (unless
+    subtrees) no class attribute anywhere. Names are matched against the lowercased content,
+    as html.parser lowercases tag and attribute names, so this never changes results.
+    Memory-mapped files are always parsed.
+    """
+    if isinstance(raw, mmap.mmap):
+        return True
+    if raw.isascii():
+        text = raw.lower()
+        needles = [tag.encode("ascii", "ignore") for tag in tags]
+        class_needle, tag_start = b"class", b"<"
+    else:
+        # Decoding raises for invalid utf-8 just like the full parse would
+        text = str(raw, "utf-8").lower()
+        needles = list(tags)
+        class_needle, tag_start = "class", "<"
+
+    if not subtrees and class_needle not in text:
+        return False
+    if ALL_TAGS in tags:
+        return True
+    return any(tag_start + needle in text for needle in needles)
+
+def analyze_file(file_path: str, parser: str = DEFAULT_PARSER, verify: bool = False, tags: Tuple[str, ...] = TARGET_TAGS, subtrees: bool = False) -> List[Tuple[str, str, int]]:
+    """
+    Read and parse the file at file_path, returning (tag_name, class_strs, num_classes)
+    for each tag. The file path is left out so results from worker processes stay compact.
+    """
+    raw = read_file_raw(file_path)
+    if not may_have_entries(raw, tags, subtrees):
+        return []
+    return analyze_content(raw, file_path, parser, verify, tags, subtrees=subtrees)
+
+def analyze_file_stats(file_path: str, parser: str = DEFAULT_PARSER, verify: bool = False, tags: Tuple[str, ...] = TARGET_TAGS, profiler=None, subtrees: bool = False) -> Tuple[List[Tuple[str, str, int]], Dict[str, Any]]:
+    """
+    analyze_file that also returns the wall and cpu time of reading and of parsing the file,
+    its size in bytes, whether may_have_entries let it skip parsing and the peak memory of
+    the process so far, for RunStats. If profiler is given, it is enabled while the file is parsed.
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    raw = read_file_raw(file_path)
+    read_time = (time.perf_counter() - wall, time.process_time() - cpu)
+    num_bytes = len(raw)
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    skipped = not may_have_entries(raw, tags, subtrees)
+    entries = [] if skipped else analyze_content(raw, file_path, parser, verify, tags, profiler, subtrees)
+    parse_time = (time.perf_counter() - wall, time.process_time() - cpu)
+
+    return entries, {"read": read_time, "parse": parse_time, "bytes": num_bytes, "skipped": skipped, "max_rss_bytes": peak_rss()}
+
+def read_file_timed(file_path: str) -> Tuple[bytes | mmap.mmap, Tuple[float, float]]:
+    """
+    Return read_file_raw(file_path) and the wall and thread cpu time it took
+    """
+    wall, cpu = time.perf_counter(), time.thread_time()
+    raw = read_file_raw(file_path)
+    return raw, (time.perf_counter() - wall, time.thread_time() - cpu)
+
+def read_files(file_paths: Iterable[str], io_threads: int) -> Iterator[Tuple[str, Tuple[bytes | mmap.mmap, Tuple[float, float]]]]:
+    """
+    Yield (file_path, read_file_timed(file_path)) for each path in file_paths, in the order
+    given, reading the files concurrently in a pool of io_threads threads. Only a bounded
+    number of files are read ahead of the one being yielded.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        tasks = ((file_path, executor.submit(read_file_timed, file_path)) for file_path in file_paths)
+        yield from _ordered_results(tasks, io_threads * PENDING_PER_JOB)
+
+def _parse_read_file(raw: bytes | mmap.mmap, read_time: Tuple[float, float], file_path: str, parser: str, verify: bool, tags: Tuple[str, ...], stats: "RunStats | None", subtrees: bool) -> List[Tuple[str, str, int]]:
+    """
+    Parse a file read by read_files in this process, adding its read and parse times to stats if given
+    """
+    if stats is None:
+        return analyze_content(raw, file_path, parser, verify, tags, subtrees=subtrees) if may_have_entries(raw, tags, subtrees) else []
+    stats.add_time("read", *read_time)
+    stats.count("bytes", len(raw))
+    with stats.stage("parse"):
+        skipped = not may_have_entries(raw, tags, subtrees)
+        entries = [] if skipped else analyze_content(raw, file_path, parser, verify, tags, stats.profiler, subtrees)
+    if skipped:
+        stats.count("skipped_files")
+    return entries
+
+def analyze_files(file_paths: Iterable[str], parser: str = DEFAULT_PARSER, verify: bool = False, jobs: int = 1, stats: "RunStats | None" = None, tags: Tuple[str, ...] = TARGET_TAGS, io_threads: int = 1, subtrees: bool = False) -> Iterator[Tuple[str, List[Tuple[str, str, int]]]]:
+    """
+    Yield (file_path, analyze_file(file_path)) for each path in file_paths, in the order given.
+    file_paths is consumed lazily.
+
+    If jobs is greater than 1, files are read and parsed in a pool of that many processes.
+    Otherwise, if io_threads is greater than 1, files are read concurrently by that many
+    threads and parsed in this process. Either way results are yielded in file_paths order,
+    so output matches a serial run.
+
+    If stats is given, read and parse times and file counts are added to it. If subtrees
+    is True, subtree keys are collected instead of class strings, as in parse_html.
+    """
+    if jobs <= 1 and io_threads > 1:
+        for file_path, (raw, read_time) in read_files(file_paths, io_threads):
+            yield file_path, _parse_read_file(raw, read_time, file_path, parser, verify, tags, stats, subtrees)
+        return
+
+    if jobs <= 1:
+        for file_path in file_paths:
+            if stats is None:
+                yield file_path, analyze_file(file_path, parser, verify, tags, subtrees)
+            else:
+                yield file_path, stats.add_file(*analyze_file_stats(file_path, parser, verify, tags, stats.profiler, subtrees))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    work = analyze_file if stats is None else analyze_file_stats
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        tasks = ((file_path, executor.submit(work, file_path, parser, verify, tags, subtrees=subtrees)) for file_path in file_paths)
+        for file_path, result in _ordered_results(tasks, jobs * PENDING_PER_JOB):
+            yield file_path, result if stats is None else stats.add_file(*result)
+
+# Number of submitted files per worker process that may be waiting to be yielded
+PENDING_PER_JOB = 4
+
+def _ordered_results(tasks: Iterable[Tuple[str, Any]], window: int) -> Iterator[Tuple[str, Any]]:
+    """
+    Yield (file_path, result) for each (file_path, result) in tasks, in order, waiting on
+    results that are Futures. Only window tasks are pulled ahead of the one being waited on,
+    which bounds both memory and the number of files in flight.
+    """
+    from concurrent.futures import Future
+
+    pending = deque()
+    for task in tasks:
+        pending.append(task)
+        while pending and (len(pending) > window or not isinstance(pending[0][1], Future)):
+            file_path, result = pending.popleft()
+            yield file_path, result.result() if isinstance(result, Future) else result
+    while pending:
+        file_path, result = pending.popleft()
+        yield file_path, result.result() if isinstance(result, Future) else result
+
+# Bump when the layout or meaning of cached rows changes
+CACHE_VERSION = 3
+
+def open_cache(cache_path: str, parser: str = DEFAULT_PARSER, tags: Tuple[str, ...] = TARGET_TAGS, subtrees: bool = False) -> Connection:
+    """
+    Open (creating if needed) the persistent cache database at cache_path, which stores
+    each analyzed file's fingerprint and tag entries. Cached rows produced by a different
+    cache version, parser, set of tags or subtrees setting are discarded.
+    """
+    import sqlite3
+
+    conn = sqlite3.connect(cache_path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+    config = f"{CACHE_VERSION}:{parser}:{','.join(sorted(tags))}"
+    if subtrees:
+        config += ":subtrees"
+    row = cursor.execute("SELECT value FROM cache_meta WHERE key = 'config'").fetchone()
+    if row is None or row[0] != config:
+        cursor.execute("DROP TABLE IF EXISTS file_index")
+        cursor.execute("DROP TABLE IF EXISTS file_tags")
+        cursor.execute("INSERT OR REPLACE INTO cache_meta (key, value) VALUES ('config', ?)", (config,))
+
+    # last_run is the run that last saw the file, used to find files that were not walked
+    cursor.executescript('''
+        CREATE TABLE IF NOT EXISTS file_index (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER,
+            size INTEGER,
+            hash TEXT,
+            last_run INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS file_tags (
+            path TEXT,
+            name TEXT,
+            classes TEXT,
+            num_classes INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS file_tags_path ON file_tags (path);
+    ''')
+    conn.commit()
+    cursor.close()
+    return conn
+
+def hash_file(file_path: str) -> str:
+    """
+    Return a hex digest of the raw bytes of the file at file_path
+    """
+    with open(file_path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+def analyze_files_cached(file_paths: Iterable[str], cache_conn: Connection, parser: str = DEFAULT_PARSER, verify: bool = False, jobs: int = 1, stats: "RunStats | None" = None, tags: Tuple[str, ...] = TARGET_TAGS, io_threads: int = 1, subtrees: bool = False) -> Iterator[Tuple[str, List[Tuple[str, str, int]]]]:
+    """
+    Cached version of analyze_files, taking the same arguments in the same order after
+    cache_conn. A file is only reparsed if it is new or its (mtime, size) changed and its
+    content hash no longer matches the cache; otherwise its entries are read back from
+    cache_conn. Once file_paths is exhausted, cached files that were not walked and no
+    longer exist are pruned. As in analyze_files, files that are reparsed are read by
+    io_threads threads if jobs is 1 and io_threads is greater than 1.
+
+    If stats is given, time spent checking the cache is recorded as the cache stage.
+    """
+    cursor = cache_conn.cursor()
+    row = cursor.execute("SELECT value FROM cache_meta WHERE key = 'run'").fetchone()
+    run = 1 if row is None else int(row[0]) + 1
+    cursor.execute("INSERT OR REPLACE INTO cache_meta (key, value) VALUES ('run', ?)", (str(run),))
+
+    # Fingerprints of files being reparsed, until their results are stored
+    fingerprints = {}
+
+    def cached_entries(key: str) -> List[Tuple[str, str, int]]:
+        cursor.execute("SELECT name, classes, num_classes FROM file_tags WHERE path = ? ORDER BY rowid", (key,))
+        return cursor.fetchall()
+
+    def cache_lookup(file_path: str) -> List[Tuple[str, str, int]] | None:
+        """
+        Return the cached entries of file_path, or None (after noting its new fingerprint)
+        if it has to be reparsed
+        """
+        key = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        fingerprint = cursor.execute("SELECT mtime_ns, size, hash FROM file_index WHERE path = ?", (key,)).fetchone()
+        if fingerprint is not None and fingerprint[:2] == (stat.st_mtime_ns, stat.st_size):
+            cursor.execute("UPDATE file_index SET last_run = ? WHERE path = ?", (run, key))
+            return cached_entries(key)
+
+        # Touched but unchanged files (e.g. after a checkout) only need their fingerprint updated
+        file_hash = hash_file(file_path)
+        if fingerprint is not None and fingerprint[2] == file_hash:
+            cursor.execute("UPDATE file_index SET mtime_ns = ?, size = ?, last_run = ? WHERE path = ?",
+                           (stat.st_mtime_ns, stat.st_size, run, key))
+            return cached_entries(key)
+
+        fingerprints[file_path] = (key, stat.st_mtime_ns, stat.st_size, file_hash)
+        return None
+
+    def tasks(executor: Executor | None) -> Iterator[Tuple[str, Any]]:
+        for file_path in file_paths:
+            if stats is None:
+                entries = cache_lookup(file_path)
+            else:
+                with stats.stage("cache"):
+                    entries = cache_lookup(file_path)
+                if entries is not None:
+                    stats.count("cached_files")
+
+            if entries is not None:
+                yield file_path, entries
+            elif read_in_threads:
+                yield file_path, executor.submit(read_file_timed, file_path)
+            elif executor is not None:
+                yield file_path, executor.submit(analyze_file if stats is None else analyze_file_stats, file_path, parser, verify, tags, subtrees=subtrees)
+            elif stats is None:
+                yield file_path, analyze_file(file_path, parser, verify, tags, subtrees)
+            else:
+                yield file_path, analyze_file_stats(file_path, parser, verify, tags, stats.profiler, subtrees)
+
+    # Reparsed files are read and parsed by worker processes, or read by threads and parsed here
+    read_in_threads = jobs <= 1 and io_threads > 1
+    executor = None
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs)
+    elif read_in_threads:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=io_threads)
+    try:
+        for file_path, result in _ordered_results(tasks(executor), max(1, jobs, io_threads if read_in_threads else 1) * PENDING_PER_JOB):
+            fingerprint = fingerprints.pop(file_path, None)
+            if fingerprint is None:
+                entries = result
+            else:
+                if read_in_threads:
+                    entries = _parse_read_file(*result, file_path, parser, verify, tags, stats, subtrees)
+                else:
+                    entries = result if stats is None else stats.add_file(*result)
+                key = fingerprint[0]
+                cursor.execute("DELETE FROM file_tags WHERE path = ?", (key,))
+                cursor.executemany("INSERT INTO file_tags (path, name, classes, num_classes) VALUES(?, ?, ?, ?)",
+                                   [(key, *entry) for entry in entries])
+                cursor.execute("INSERT OR REPLACE INTO file_index (path, mtime_ns, size, hash, last_run) VALUES(?, ?, ?, ?, ?)",
+                               (*fingerprint, run))
+            yield file_path, entries
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    unseen = cursor.execute("SELECT path FROM file_index WHERE last_run != ?", (run,)).fetchall()
+    for (key,) in unseen:
+        if not os.path.exists(key):
+            cursor.execute("DELETE FROM file_tags WHERE path = ?", (key,))
+            cursor.execute("DELETE FROM file_index WHERE path = ?", (key,))
+    cache_conn.commit()
+    cursor.close()
+
+def create_tables(conn: Connection) -> None:
+    """
+    Create the tag data tables and the tag_data view used by parse_data, if they don't exist
+    """
+    conn.cursor().executescript('''
+        CREATE TABLE IF NOT EXISTS class_sets (
+            id INTEGER PRIMARY KEY,
+            classes TEXT UNIQUE,
+            num_classes INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS file_paths (
+            id INTEGER PRIMARY KEY,
+            file_path TEXT UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS tag_rows (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            class_id INTEGER,
+            file_id INTEGER
+        );
+        CREATE VIEW IF NOT EXISTS tag_data AS
+            SELECT tag_rows.id, name, classes, num_classes, file_path
+            FROM tag_rows
+            JOIN class_sets ON class_sets.id = tag_rows.class_id
+            JOIN file_paths ON file_paths.id = tag_rows.file_id;
+    ''')
+
+def parse_data(data: List[TagEntry], conn: Connection, bulk_ids: Dict[str, Dict[str, int]] | None = None) -> None:
+    """
+    Given a data representation of tag data, update the
+    database to include that data
+
+    Each distinct class string and file path is stored once, in the class_sets and
+    file_paths tables, and tag_rows refers to them by id. The tag_data view joins
+    them back into (id, name, classes, num_classes, file_path) rows.
+
+    bulk_ids, as returned by begin_bulk_load, puts parse_data in bulk mode: data is added
+    to the open transaction without committing, and the ids of stored strings are kept
+    in bulk_ids so they are never looked up in the database.
+    """
+    if bulk_ids is None:
+        create_tables(conn)
+        class_ids, file_ids = {}, {}
+    else:
+        class_ids, file_ids = bulk_ids["classes"], bulk_ids["file_paths"]
+    cursor = conn.cursor()
+
+    for _, classes, num_classes, file_path in data:
+        if classes not in class_ids:
+            if bulk_ids is None:
+                cursor.execute("INSERT OR IGNORE INTO class_sets (classes, num_classes) VALUES(?, ?)", (classes, num_classes))
+                class_ids[classes] = cursor.execute("SELECT id FROM class_sets WHERE classes = ?", (classes,)).fetchone()[0]
+            else:
+                cursor.execute("INSERT INTO class_sets (classes, num_classes) VALUES(?, ?)", (classes, num_classes))
+                class_ids[classes] = cursor.lastrowid
+        if file_path not in file_ids:
+            if bulk_ids is None:
+                cursor.execute("INSERT OR IGNORE INTO file_paths (file_path) VALUES(?)", (file_path,))
+                file_ids[file_path] = cursor.execute("SELECT id FROM file_paths WHERE file_path = ?", (file_path,)).fetchone()[0]
+            else:
+                cursor.execute("INSERT INTO file_paths (file_path) VALUES(?)", (file_path,))
+                file_ids[file_path] = cursor.lastrowid
+
+    cursor.executemany("INSERT INTO tag_rows (name, class_id, file_id) VALUES(?, ?, ?)",
+                       [(name, class_ids[classes], file_ids[file_path]) for name, classes, _, file_path in data])
+    if bulk_ids is None:
+        conn.commit()
+    cursor.close()
+
+# Page cache size for bulk loads, in KiB
+BULK_CACHE_KIB = 256 * 1024
+
+def begin_bulk_load(conn: Connection) -> Dict[str, Dict[str, int]]:
+    """
+    Prepare a throwaway analysis database for loading with parse_data in bulk mode, and
+    return the bulk_ids to pass to it. Any tag data left in the database is dropped. Journaling and syncing are turned off, since the
+    database is discarded if the run fails, and the page cache is enlarged. The covering
+    index used by query_db_info is only built by finish_bulk_load, so rows don't have to
+    be indexed one at a time.
+    """
+    conn.cursor().executescript(f'''
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        PRAGMA locking_mode = EXCLUSIVE;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -{BULK_CACHE_KIB};
+    ''')
+    drop_data(conn)
+    create_tables(conn)
+    return {"classes": {}, "file_paths": {}}
+
+def finish_bulk_load(conn: Connection) -> None:
+    """
+    Commit a bulk load started with begin_bulk_load and build the index covering the
+    GROUP BY name, classes of query_db_info
+    """
+    conn.commit()
+    conn.cursor().executescript('''
+        CREATE INDEX IF NOT EXISTS tag_rows_component ON tag_rows (name, class_id, file_id);
+        ANALYZE;
+    ''')
+
+def count_db_components(conn: Connection) -> int:
+    """
+    Return the number of distinct components (tag + classes) in the database
+    """
+    return conn.cursor().execute("SELECT COUNT(*) FROM (SELECT DISTINCT name, class_id FROM tag_rows)").fetchone()[0]
+
+def drop_data(conn: Connection) -> None:
+    """
+    Remove the tag data tables created by parse_data from the database
+    """
+    conn.cursor().executescript('''
+        DROP VIEW IF EXISTS tag_data;
+        DROP TABLE IF EXISTS tag_rows;
+        DROP TABLE IF EXISTS class_sets;
+        DROP TABLE IF EXISTS file_paths;
+    ''')
+
+# Maximum number of tag entries handed to the aggregation backend at once
+BATCH_SIZE = 10000
+
+def load_entries(results: Iterable[Tuple[str, List[Tuple[str, str, int]]]], add_batch: Callable[[List[TagEntry]], None], is_short: bool = False, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Label the entries of each (file_path, entries) in results with the file path (or just
+    the file name if is_short) and pass them to add_batch in lists of at most batch_size,
+    so only one batch of entries is held in memory at a time.
+
+    returns: the number of files in results
+    """
+    num_files = 0
+    batch = []
+    for file_path, entries in results:
+        num_files += 1
+        label = os.path.basename(file_path) if is_short else file_path
+        for name, class_strs, num_classes in entries:
+            batch.append((name, class_strs, num_classes, label))
+            if len(batch) >= batch_size:
+                add_batch(batch)
+                batch = []
+    if batch:
+        add_batch(batch)
+    return num_files
+
+# Column headers of the analysis output
+RESULT_HEADERS = ["name", "num_instances", "classes", "file_paths"]
+SUBTREE_HEADERS = ["name", "num_instances", "subtree", "file_paths"]
+
+def iter_db_info(conn: Connection, min_classes=1, min_instances=2, min_locations=1) -> Iterator[Tuple[str, int, str, List[str]]]:
+    """
+    Given a connection to a populated database, return an iterator over (name, num_instances,
+    classes, file_paths) for each unique component (tag + classes), most frequent first,
+    where file_paths is a sorted list. Rows are read from the cursor as they are consumed,
+    so the result set is never held in memory at once.
+
+    Only include tags with at least min_classes classes that occur at least min_instances times
+    in at least min_locations distinct files.
+    """
+    cursor = conn.cursor()
+    # Group and filter on integer ids, and only decode class strings and file paths
+    # for the components that make it into the output
+    cursor.execute('''
+        WITH components AS (
+            SELECT name, class_id, COUNT(tag_rows.id) as num_instances
+            FROM tag_rows
+            JOIN class_sets ON class_sets.id = tag_rows.class_id
+            WHERE num_classes >= ? 
+            GROUP BY name, class_id
+            HAVING num_instances >= ? AND COUNT(DISTINCT file_id) >= ?
+        )
+        SELECT components.name, num_instances, classes, json_group_array(DISTINCT file_path ORDER BY file_path) as file_paths
+        FROM components
+        JOIN tag_rows ON tag_rows.name = components.name AND tag_rows.class_id = components.class_id
+        JOIN class_sets ON class_sets.id = components.class_id
+        JOIN file_paths ON file_paths.id = tag_rows.file_id
+        GROUP BY components.name, components.class_id
+        ORDER BY num_instances DESC, components.name, classes
+    ''', (min_classes, min_instances, min_locations))
+    return ((name, num_instances, classes, json.loads(file_paths)) for name, num_instances, classes, file_paths in cursor)
+
+def query_db_info(conn: Connection, min_classes=1, min_instances=2, min_locations=1) -> List[Tuple[str, int, str, str]]:
+    """
+    Given a connection to a populated database, return (name, num_instances, classes, file_paths)
+    for each unique component (tag + classes), most frequent first, with file_paths joined
+    by commas as in the csv output.
+
+    Only include tags with at least min_classes classes that occur at least min_instances times
+    in at least min_locations distinct files.
+    """
+    return [(name, num_instances, classes, ",".join(file_paths))
+            for name, num_instances, classes, file_paths in iter_db_info(conn, min_classes, min_instances, min_locations)]
+
+def output_path(path: str, extension: str) -> str:
+    """
+    Return path, with extension added if it has none, creating its parent directories as needed
+    """
+    if "." not in path:
+        path += extension
+
+    if not os.path.isdir(path) and os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def write_csv(rows: Iterable[Tuple], csv_path="template_analysis.csv", headers=RESULT_HEADERS) -> int:
+    """
+    Write headers and rows to the csv file at csv_path, creating parent directories as needed.
+    List values (such as file_paths) are joined by commas. rows may be any iterable, and are
+    written as they are produced.
+
+    returns: the number of rows written
+    """
+    import csv
+
+    num_rows = 0
+    with open(output_path(csv_path, ".csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        for row in rows:
+            writer.writerow([",".join(value) if isinstance(value, list) else value for value in row])
+            num_rows += 1
+    return num_rows
+
+def write_jsonl(rows: Iterable[Tuple], jsonl_path="template_analysis.jsonl", headers=RESULT_HEADERS) -> int:
+    """
+    Write rows to the JSON Lines file at jsonl_path, one object per row keyed by headers.
+    List values (such as file_paths) are written as arrays.
+
+    returns: the number of rows written
+    """
+    num_rows = 0
+    with open(output_path(jsonl_path, ".jsonl"), "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(dict(zip(headers, row)), ensure_ascii=False))
+            f.write("\n")
+            num_rows += 1
+    return num_rows
+
+# Identifies files written by write_columnar, and the version of their layout
+COLUMNAR_MAGIC = b"TACOLUMN"
+COLUMNAR_VERSION = 1
+# Rows buffered and written together as one group of column chunks
+ROW_GROUP_SIZE = 10000
+
+def _column_type(value: Any) -> str:
+    if isinstance(value, list):
+        return "list"
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return "str"
+    return "int" if isinstance(value, int) else "float"
+
+def _encode_strings(values: List[str]) -> bytes:
+    data = [value.encode("utf-8") for value in values]
+    lengths = array("I", [len(value) for value in data])
+    if sys.byteorder == "big":
+        lengths.byteswap()
+    return lengths.tobytes() + b"".join(data)
+
+def _decode_strings(data: bytes, count: int) -> List[str]:
+    lengths = array("I")
+    lengths.frombytes(data[:4 * count])
+    if sys.byteorder == "big":
+        lengths.byteswap()
+    values, offset = [], 4 * count
+    for length in lengths:
+        values.append(data[offset:offset + length].decode("utf-8"))
+        offset += length
+    return values
+
+def _encode_column(values: List[Any], column_type: str) -> bytes:
+    if column_type == "str":
+        return _encode_strings(["" if value is None else str(value) for value in values])
+    if column_type == "list":
+        counts = array("I", [len(value) for value in values])
+        if sys.byteorder == "big":
+            counts.byteswap()
+        return counts.tobytes() + _encode_strings([item for value in values for item in value])
+    numbers = array("q" if column_type == "int" else "d", values)
+    if sys.byteorder == "big":
+        numbers.byteswap()
+    return numbers.tobytes()
+
+def _decode_column(data: bytes, column_type: str, count: int) -> List[Any]:
+    if column_type == "str":
+        return _decode_strings(data, count)
+    if column_type == "list":
+        counts = array("I")
+        counts.frombytes(data[:4 * count])
+        if sys.byteorder == "big":
+            counts.byteswap()
+        items = _decode_strings(data[4 * count:], sum(counts))
+        values, offset = [], 0
+        for length in counts:
+            values.append(items[offset:offset + length])
+            offset += length
+        return values
+    numbers = array("q" if column_type == "int" else "d")
+    numbers.frombytes(data)
+    if sys.byteorder == "big":
+        numbers.byteswap()
+    return numbers.tolist()
+
+def write_columnar(rows: Iterable[Tuple], columnar_path="template_analysis.tacol", headers=RESULT_HEADERS) -> int:
+    """
+    Write rows to a compact columnar binary file at columnar_path, for loading into dashboards
+    with read_columnar.
+
+    The file starts with COLUMNAR_MAGIC, a version byte and a length-prefixed JSON header
+    with the column names and types (str, int, float or list of str), taken from the first
+    row. Rows follow in groups of up to ROW_GROUP_SIZE: a row count, then each column's
+    values as a length-prefixed zlib-compressed chunk. Numbers are little-endian 64 bit,
+    strings are utf-8 with their lengths up front. A row count of 0 ends the file. Only one
+    group of rows is held in memory at a time.
+
+    returns: the number of rows written
+    """
+    num_rows = 0
+    with open(output_path(columnar_path, ".tacol"), "wb") as f:
+        f.write(COLUMNAR_MAGIC + bytes([COLUMNAR_VERSION]))
+        column_types = None
+        rows = iter(rows)
+        while True:
+            group = list(islice(rows, ROW_GROUP_SIZE))
+            if column_types is None:
+                column_types = [_column_type(value) for value in group[0]] if group else ["str"] * len(headers)
+                header = json.dumps({"columns": [{"name": name, "type": column_type} for name, column_type in zip(headers, column_types)]}).encode("utf-8")
+                f.write(len(header).to_bytes(4, "little") + header)
+            f.write(len(group).to_bytes(4, "little"))
+            if not group:
+                return num_rows
+            for values, column_type in zip(zip(*group), column_types):
+                chunk = zlib.compress(_encode_column(list(values), column_type))
+                f.write(len(chunk).to_bytes(4, "little") + chunk)
+            num_rows += len(group)
+
+def read_columnar(columnar_path: str) -> Tuple[List[str], Iterator[Tuple]]:
+    """
+    Open a file written by write_columnar, returning its column names and an iterator over
+    its rows, which reads one group of rows at a time
+
+    raises: ValueError if the file is not a columnar output file of a supported version
+    """
+    f = open(columnar_path, "rb")
+    prefix = f.read(len(COLUMNAR_MAGIC) + 1)
+    if prefix[:-1] != COLUMNAR_MAGIC:
+        f.close()
+        raise ValueError(f"Error: \'{columnar_path}\' is not a columnar output file")
+    if prefix[-1] != COLUMNAR_VERSION:
+        f.close()
+        raise ValueError(f"Error: \'{columnar_path}\' is columnar version {prefix[-1]}, expected {COLUMNAR_VERSION}")
+    columns = json.loads(f.read(int.from_bytes(f.read(4), "little")))["columns"]
+
+    def iter_rows() -> Iterator[Tuple]:
+        with f:
+            while True:
+                count = int.from_bytes(f.read(4), "little")
+                if not count:
+                    return
+                values = []
+                for column in columns:
+                    chunk = zlib.decompress(f.read(int.from_bytes(f.read(4), "little")))
+                    values.append(_decode_column(chunk, column["type"], count))
+                yield from zip(*values)
+
+    return [column["name"] for column in columns], iter_rows()
+
+# Output writers selectable with --format, by name
+OUTPUT_FORMATS: Dict[str, Callable[[Iterable[Tuple], str, List[str]], int]] = {
+    "csv": write_csv,
+    "jsonl": write_jsonl,
+    "columnar": write_columnar,
+}
+# File extension of each output format, for the default output file
+OUTPUT_EXTENSIONS = {"csv": ".csv", "jsonl": ".jsonl", "columnar": ".tacol"}
+
+def write_rows(rows: Iterable[Tuple], path: str, headers=RESULT_HEADERS, output_format="csv") -> int:
+    """
+    Write headers and rows to path with the writer of output_format from OUTPUT_FORMATS
+
+    returns: the number of rows written
+    """
+    return OUTPUT_FORMATS[output_format](rows, path, headers)
+
+def analyze_db_info(conn: Connection, csv_path="template_analysis.csv", min_classes=1, min_instances=2, min_locations=1) -> None:
+    """
+    Given a connection to a populated database, analyze the tag data in the database and
+    create a csv file with (name, num_occurrences, classes, file_paths) for each unique
+    component (tag + classes). 
+
+    Only include tags with at least min_classes (default=1) classes that occur at least min_instances (default=2) times.  
+    """
+    write_csv(iter_db_info(conn, min_classes, min_instances, min_locations), csv_path)
+
+def aggregate_data(data: List[TagEntry], aggregate: Dict[Tuple[str, str], List]) -> None:
+    """
+    In-memory counterpart of parse_data. Given a data representation of tag data, update
+    aggregate, which maps (name, classes) to [num_classes, num_instances, set of file paths]
+    """
+    for name, classes, num_classes, file_path in data:
+        component = aggregate.get((name, classes))
+        if component is None:
+            component = aggregate[(name, classes)] = [num_classes, 0, set()]
+        component[1] += 1
+        component[2].add(file_path)
+
+def iter_memory_info(aggregate: Dict[Tuple[str, str], List], min_classes=1, min_instances=2, min_locations=1) -> Iterator[Tuple[str, int, str, List[str]]]:
+    """
+    In-memory counterpart of iter_db_info, returning the same rows in the same order
+    from an aggregate built by aggregate_data. Components are sorted up front, but each
+    row's sorted file_paths list is only built as it is consumed.
+    """
+    components = [(name, num_instances, classes, file_paths)
+                  for (name, classes), (num_classes, num_instances, file_paths) in aggregate.items()
+                  if num_classes >= min_classes and num_instances >= min_instances and len(file_paths) >= min_locations]
+    components.sort(key=lambda row: (-row[1], row[0], row[2]))
+    return ((name, num_instances, classes, sorted(file_paths)) for name, num_instances, classes, file_paths in components)
+
+def query_memory_info(aggregate: Dict[Tuple[str, str], List], min_classes=1, min_instances=2, min_locations=1) -> List[Tuple[str, int, str, str]]:
+    """
+    In-memory counterpart of query_db_info, returning the same rows in the same order
+    from an aggregate built by aggregate_data.
+    """
+    return [(name, num_instances, classes, ",".join(file_paths))
+            for name, num_instances, classes, file_paths in iter_memory_info(aggregate, min_classes, min_instances, min_locations)]
+
+def analyze_memory_info(aggregate: Dict[Tuple[str, str], List], csv_path="template_analysis.csv", min_classes=1, min_instances=2, min_locations=1) -> None:
+    """
+    In-memory counterpart of analyze_db_info, writing the analysis csv from an aggregate
+    built by aggregate_data.
+    """
+    write_csv(iter_memory_info(aggregate, min_classes, min_instances, min_locations), csv_path)
+
+# Number of MinHash permutations in each class set signature
+NUM_PERMUTATIONS = 64
+# Mersenne prime modulus of the MinHash permutations
+MINHASH_PRIME = (1 << 61) - 1
+# Seed of the MinHash permutations, fixed so clusters are the same on every run
+MINHASH_SEED = 1
+# Chance that LSH makes two class sets at exactly the similarity threshold candidates
+LSH_RECALL = 0.99
+
+CLUSTER_HEADERS = ["cluster", "name", "num_instances", "classes", "file_paths", "similarity"]
+
+def lsh_params(threshold: float, num_permutations: int = NUM_PERMUTATIONS) -> Tuple[int, int]:
+    """
+    Return (bands, rows) for splitting MinHash signatures into LSH bands. Picks the most rows
+    per band (fewest false candidates) for which two class sets with Jaccard similarity
+    threshold still share a band with a chance of at least LSH_RECALL.
+    """
+    for rows in range(num_permutations, 0, -1):
+        bands = num_permutations // rows
+        if 1 - (1 - threshold ** rows) ** bands >= LSH_RECALL:
+            return bands, rows
+    return num_permutations, 1
+
+def minhash_permutations(num_permutations: int = NUM_PERMUTATIONS, seed: int = MINHASH_SEED) -> List[Tuple[int, int]]:
+    """
+    Return num_permutations (a, b) pairs for the hash permutations (a * x + b) % MINHASH_PRIME
+    """
+    rng = random.Random(seed)
+    return [(rng.randrange(1, MINHASH_PRIME), rng.randrange(MINHASH_PRIME)) for _ in range(num_permutations)]
+
+def minhash_signature(classes: Iterable[str], permutations: List[Tuple[int, int]], token_signatures: Dict[str, Tuple[int, ...]]) -> Tuple[int, ...]:
+    """
+    Return the MinHash signature of the non-empty set of class names classes.
+
+    token_signatures caches the signature of each class name, so a class set's signature
+    is just the element-wise minimum of the signatures of its classes.
+    """
+    signatures = []
+    for token in classes:
+        signature = token_signatures.get(token)
+        if signature is None:
+            x = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+            signature = token_signatures[token] = tuple((a * x + b) % MINHASH_PRIME for a, b in permutations)
+        signatures.append(signature)
+    if len(signatures) == 1:
+        return signatures[0]
+    return tuple(map(min, *signatures))
+
+def jaccard(a: set, b: set) -> float:
+    """
+    Return the Jaccard similarity of the sets a and b
+    """
+    return len(a & b) / len(a | b)
+
+def cluster_similar(rows: List[Tuple[str, int, str, str]], threshold: float, min_instances=2, min_locations=1) -> List[Tuple[int, str, int, str, str, float]]:
+    """
+    Group components with the same tag name whose class sets have a Jaccard similarity of at
+    least threshold, given rows from iter_db_info or iter_memory_info (or their query_
+    counterparts, with joined file paths).
+
+    Candidate pairs come from LSH banding of MinHash signatures rather than comparing every
+    pair, and each candidate is then checked against its exact similarity. Components are
+    visited most frequent first; each one not yet in a cluster starts a new cluster and
+    takes every unclustered candidate at least threshold similar to it.
+
+    Only clusters of two or more components whose instances add up to at least min_instances,
+    found in at least min_locations distinct files, are returned, largest first, as
+    (cluster, name, num_instances, classes, file_paths, similarity) rows. similarity is
+    relative to the cluster's first, most frequent, component.
+    """
+    rows = sorted(rows, key=lambda row: (-row[1], row[0], row[2]))
+    bands, band_rows = lsh_params(threshold)
+    permutations = minhash_permutations()
+    token_signatures: Dict[str, Tuple[int, ...]] = {}
+
+    # Hash each band of each signature, along with the tag name so only components of
+    # the same tag collide. Components without classes can't be similar to anything.
+    indices = [i for i, row in enumerate(rows) if row[2].strip()]
+    band_hashes = [array("q", bytes(8 * len(indices))) for _ in range(bands)]
+    band_starts = list(enumerate(range(0, bands * band_rows, band_rows)))
+    for position, i in enumerate(indices):
+        name, _, classes, _ = rows[i]
+        signature = minhash_signature(set(classes.split()), permutations, token_signatures)
+        for band, start in band_starts:
+            band_hashes[band][position] = hash((name, signature[start:start + band_rows]))
+    token_signatures.clear()
+
+    # Keep only the buckets of each band that hold more than one component
+    groups: List[List[int]] = []
+    memberships: Dict[int, List[int]] = {}
+    for hashes in band_hashes:
+        buckets: Dict[int, List[int]] = {}
+        for i, value in zip(indices, hashes):
+            buckets.setdefault(value, []).append(i)
+        for members in buckets.values():
+            if len(members) > 1:
+                for i in members:
+                    memberships.setdefault(i, []).append(len(groups))
+                groups.append(members)
+    del band_hashes
+
+    clusters = []
+    clustered = [False] * len(rows)
+    for i in range(len(rows)):
+        if clustered[i] or i not in memberships:
+            continue
+        clustered[i] = True
+        classes = set(rows[i][2].split())
+        members = [(i, 1.0)]
+        for group_id in memberships[i]:
+            remaining = []
+            for j in groups[group_id]:
+                if clustered[j]:
+                    continue
+                similarity = jaccard(classes, set(rows[j][2].split()))
+                if similarity >= threshold:
+                    clustered[j] = True
+                    members.append((j, similarity))
+                else:
+                    remaining.append(j)
+            # Later visits to this group only need to look at unclustered components
+            groups[group_id] = remaining
+        if len(members) > 1:
+            clusters.append(sorted(members))
+
+    results = []
+    for members in clusters:
+        num_instances = sum(rows[j][1] for j, _ in members)
+        file_paths = set()
+        for j, _ in members:
+            file_paths.update(rows[j][3].split(",") if isinstance(rows[j][3], str) else rows[j][3])
+        if num_instances >= min_instances and len(file_paths) >= min_locations:
+            results.append((num_instances, members))
+    results.sort(key=lambda result: (-result[0], result[1][0][0]))
+
+    return [(cluster, *rows[j], round(similarity, 3))
+            for cluster, (_, members) in enumerate(results, 1)
+            for j, similarity in members]
+
+# Aggregation backends selectable with --backend
+BACKENDS = ["sqlite", "memory"]
+
+# HyperLogLog registers per distinct-location sketch, and the resulting relative standard error
+HLL_PRECISION = 10
+HLL_REGISTERS = 1 << HLL_PRECISION
+HLL_RELATIVE_ERROR = 1.04 / HLL_REGISTERS ** 0.5
+# Counters kept by TopKSketch for each of the k components it reports, and at least
+# TOPK_MIN_COUNTERS in total, so a small k still catches components above 1/1000 of all tags
+TOPK_COUNTERS_PER_K = 10
+TOPK_MIN_COUNTERS = 1000
+# File paths kept per counter to show where a component occurs
+TOPK_EXAMPLES = 3
+
+TOPK_HEADERS = ["name", "num_instances", "max_error", "classes", "num_locations", "location_error", "example_file_paths"]
+TOPK_SUBTREE_HEADERS = ["name", "num_instances", "max_error", "subtree", "num_locations", "location_error", "example_file_paths"]
+
+def hll_position(label: str) -> Tuple[int, int]:
+    """
+    Return the HyperLogLog register index of label and the rank to store there
+    """
+    x = int.from_bytes(hashlib.blake2b(label.encode("utf-8"), digest_size=8).digest(), "little")
+    rest = x & ((1 << (64 - HLL_PRECISION)) - 1)
+    return x >> (64 - HLL_PRECISION), 64 - HLL_PRECISION - rest.bit_length() + 1
+
+def hll_estimate(registers: bytearray) -> int:
+    """
+    Return the estimated number of distinct labels added to registers
+    """
+    m = len(registers)
+    zeros = registers.count(0)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -rank for rank in registers)
+    # Linear counting is more accurate while few registers are set
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)
+    return round(estimate)
+
+class TopKSketch:
+    """
+    Approximate aggregation backend for --top-k, using a fixed amount of memory however many
+    distinct components there are.
+
+    Instance counts are kept by the Space-Saving algorithm in capacity counters. When all
+    counters are taken, a new component replaces the one with the lowest count and inherits
+    that count as its error, so a reported count is never below the true count and at most
+    its error above it. Any component making up more than 1/capacity of all instances is
+    guaranteed to have a counter. Counters are kept in buckets by count, so each update is
+    O(1).
+
+    Each counter also holds a HyperLogLog sketch of the files its component was found in,
+    and the first few of those files as examples. With --subtrees it also holds the
+    component's skeleton, taken from the first entry of the subtree in the file it got its
+    counter in, so only the skeletons of counted components are kept.
+    """
+
+    def __init__(self, k: int, min_classes: int = 1) -> None:
+        self.k = k
+        self.capacity = max(k * TOPK_COUNTERS_PER_K, TOPK_MIN_COUNTERS)
+        self.min_classes = min_classes
+        # (name, classes) -> [count, error, registers, example labels, skeleton]
+        self.counters: Dict[Tuple[str, str], List] = {}
+        # count -> counters with that count, in the order they reached it
+        self.buckets: Dict[int, Dict[Tuple[str, str], None]] = {}
+        self.min_count = 0
+        self.num_instances = 0
+        self.last_label: Tuple[str | None, Tuple[int, int]] = (None, (0, 0))
+        # Subtree skeletons of the file being added, by digest
+        self.file_skeletons: Dict[str, str] = {}
+        self.skeleton_label: str | None = None
+
+    def add_batch(self, data: List[TagEntry]) -> None:
+        """
+        Counterpart of aggregate_data: add tag entries to the sketch, skipping tags with
+        fewer than min_classes classes
+        """
+        for name, classes, num_classes, label in data:
+            if SKELETON_SEPARATOR in classes:
+                if label != self.skeleton_label:
+                    self.file_skeletons.clear()
+                    self.skeleton_label = label
+                classes, skeleton = classes.split(SKELETON_SEPARATOR, 1)
+                self.file_skeletons[classes] = skeleton
+            if num_classes >= self.min_classes:
+                self.add((name, classes), label)
+
+    def add(self, key: Tuple[str, str], label: str) -> None:
+        counter = self.counters.get(key)
+        if counter is not None:
+            bucket = self.buckets[counter[0]]
+            del bucket[key]
+            if not bucket:
+                del self.buckets[counter[0]]
+                if counter[0] == self.min_count:
+                    self.min_count += 1
+        elif len(self.counters) < self.capacity:
+            counter = self.counters[key] = [0, 0, bytearray(HLL_REGISTERS), [], self.file_skeletons.get(key[1])]
+            self.min_count = 1
+        else:
+            # Replace the oldest counter with the lowest count
+            bucket = self.buckets[self.min_count]
+            victim = next(iter(bucket))
+            del bucket[victim]
+            if not bucket:
+                del self.buckets[self.min_count]
+                self.min_count += 1
+            counter = self.counters[key] = self.counters.pop(victim)
+            counter[1] = counter[0]
+            counter[2][:] = bytes(HLL_REGISTERS)
+            counter[3].clear()
+            counter[4] = self.file_skeletons.get(key[1])
+
+        counter[0] += 1
+        self.buckets.setdefault(counter[0], {})[key] = None
+        self.num_instances += 1
+
+        # Entries arrive grouped by file, so the label's hash is usually the last one
+        if self.last_label[0] != label:
+            self.last_label = (label, hll_position(label))
+        index, rank = self.last_label[1]
+        if counter[2][index] < rank:
+            counter[2][index] = rank
+        if len(counter[3]) < TOPK_EXAMPLES and label not in counter[3]:
+            counter[3].append(label)
+
+    def rows(self, min_instances=2, min_locations=1) -> List[Tuple[str, int, int, str, int, int, str]]:
+        """
+        Return (name, num_instances, max_error, classes, num_locations, location_error,
+        example_file_paths) for the k components with the highest guaranteed counts
+        (num_instances - max_error), most frequent first, filtered on those guaranteed
+        counts. The true instance count is between num_instances - max_error and
+        num_instances. Ranking on the upper bound would let components that just replaced
+        a counter, whose counts are almost all error, push out the truly frequent ones.
+        location_error is two standard errors of the location estimate, which only covers
+        files seen since the component got its counter.
+        """
+        rows = []
+        for (name, classes), (count, error, registers, examples, skeleton) in self.counters.items():
+            num_locations = hll_estimate(registers)
+            if count - error < min_instances or num_locations < min_locations:
+                continue
+            location_error = round(2 * HLL_RELATIVE_ERROR * num_locations)
+            rows.append((name, count, error, classes if skeleton is None else skeleton, num_locations, location_error, sorted(examples)))
+        rows.sort(key=lambda row: (row[2] - row[1], -row[1], row[0], row[3]))
+        return rows[:self.k]
+
+# Identifies shard files written by write_shard, and the version of their layout
+SHARD_FORMAT = "template-analyzer-shard"
+SHARD_VERSION = 2
+
+def iter_db_components(conn: Connection) -> Iterator[Tuple[str, str, int, int, List[str]]]:
+    """
+    Yield (name, classes, num_classes, num_instances, file_paths) for every component in a
+    populated database, one component at a time
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT tag_rows.name, tag_rows.class_id, classes, num_classes, file_path, COUNT(*)
+        FROM tag_rows
+        JOIN class_sets ON class_sets.id = tag_rows.class_id
+        JOIN file_paths ON file_paths.id = tag_rows.file_id
+        GROUP BY tag_rows.name, tag_rows.class_id, tag_rows.file_id
+        ORDER BY tag_rows.name, tag_rows.class_id
+    ''')
+    for _, rows in groupby(cursor, key=lambda row: row[:2]):
+        rows = list(rows)
+        name, _, classes, num_classes, _, _ = rows[0]
+        yield name, classes, num_classes, sum(row[5] for row in rows), [row[4] for row in rows]
+    cursor.close()
+
+def iter_memory_components(aggregate: Dict[Tuple[str, str], List]) -> Iterator[Tuple[str, str, int, int, List[str]]]:
+    """
+    In-memory counterpart of iter_db_components, for an aggregate built by aggregate_data
+    """
+    for (name, classes), (num_classes, num_instances, file_paths) in aggregate.items():
+        yield name, classes, num_classes, num_instances, sorted(file_paths)
+
+def write_shard(components: Iterable[Tuple[str, str, int, int, List[str]]], shard_path: str, tags: Tuple[str, ...] = TARGET_TAGS, subtrees: bool = False, skeletons: Dict[str, str] | None = None) -> int:
+    """
+    Write components from iter_db_components or iter_memory_components to a new shard file
+    at shard_path, replacing any existing file. A shard is a sqlite database holding each
+    component's instance count and the ids of the files it was found in, along with the
+    tags and subtrees setting of the run, so that shards from separate runs can be combined
+    by merge_shards before filtering. With subtrees, the skeleton of each component's digest
+    is written from skeletons.
+
+    returns: the number of components written
+    """
+    import sqlite3
+
+    if os.path.exists(shard_path):
+        os.remove(shard_path)
+    conn = sqlite3.connect(shard_path)
+    cursor = conn.cursor()
+    cursor.executescript('''
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        CREATE TABLE shard_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE file_paths (
+            id INTEGER PRIMARY KEY,
+            file_path TEXT
+        );
+        CREATE TABLE components (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            classes TEXT,
+            num_classes INTEGER,
+            num_instances INTEGER
+        );
+        CREATE TABLE component_files (
+            component_id INTEGER,
+            file_id INTEGER
+        );
+        CREATE TABLE skeletons (
+            classes TEXT PRIMARY KEY,
+            skeleton TEXT
+        );
+    ''')
+    meta = {"format": SHARD_FORMAT, "version": str(SHARD_VERSION), "tags": ",".join(sorted(tags)), "subtrees": str(int(subtrees))}
+    cursor.executemany("INSERT INTO shard_meta (key, value) VALUES(?, ?)", meta.items())
+
+    file_ids: Dict[str, int] = {}
+    batches: Dict[str, List[Tuple]] = {"file_paths": [], "components": [], "component_files": [], "skeletons": []}
+
+    def flush() -> None:
+        cursor.executemany("INSERT INTO file_paths (id, file_path) VALUES(?, ?)", batches["file_paths"])
+        cursor.executemany("INSERT INTO components (id, name, classes, num_classes, num_instances) VALUES(?, ?, ?, ?, ?)", batches["components"])
+        cursor.executemany("INSERT INTO component_files (component_id, file_id) VALUES(?, ?)", batches["component_files"])
+        cursor.executemany("INSERT OR IGNORE INTO skeletons (classes, skeleton) VALUES(?, ?)", batches["skeletons"])
+        for batch in batches.values():
+            batch.clear()
+
+    num_components = 0
+    for num_components, (name, classes, num_classes, num_instances, file_paths) in enumerate(components, 1):
+        batches["components"].append((num_components, name, classes, num_classes, num_instances))
+        if skeletons and classes in skeletons:
+            batches["skeletons"].append((classes, skeletons[classes]))
+        for file_path in file_paths:
+            file_id = file_ids.get(file_path)
+            if file_id is None:
+                file_id = file_ids[file_path] = len(file_ids) + 1
+                batches["file_paths"].append((file_id, file_path))
+            batches["component_files"].append((num_components, file_id))
+        if len(batches["component_files"]) >= BATCH_SIZE:
+            flush()
+    flush()
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return num_components
+
+def merge_shards(shard_paths: List[str], skeletons: Dict[str, str] | None = None) -> Tuple[Dict[Tuple[str, str], List], Dict[str, str]]:
+    """
+    Combine the shard files at shard_paths into one aggregate, in the form built by
+    aggregate_data, in a single pass over each shard. Instance counts are added up and
+    file paths are unioned, so a file that is in more than one shard is only counted as
+    one location. If skeletons is given, the shards' subtree skeletons are added to it.
+
+    returns: the aggregate and the shards' metadata
+    raises: FileNotFoundError if a shard doesn't exist, ValueError if a file is not a
+    shard, was written by another shard version, or was made with different tags or
+    subtrees setting than the first shard
+    """
+    import sqlite3
+
+    aggregate: Dict[Tuple[str, str], List] = {}
+    # Each distinct file path is only stored once, however many shards it is in
+    interned_paths: Dict[str, str] = {}
+    merged_meta = None
+
+    for shard_path in shard_paths:
+        if not os.path.isfile(shard_path):
+            raise FileNotFoundError(f"Error: the shard file \'{shard_path}\' was not found")
+        conn = sqlite3.connect(shard_path)
+        cursor = conn.cursor()
+        try:
+            meta = dict(cursor.execute("SELECT key, value FROM shard_meta").fetchall())
+        except sqlite3.DatabaseError:
+            meta = {}
+        if meta.get("format") != SHARD_FORMAT:
+            conn.close()
+            raise ValueError(f"Error: \'{shard_path}\' is not a shard file")
+        if meta.get("version") != str(SHARD_VERSION):
+            conn.close()
+            raise ValueError(f"Error: \'{shard_path}\' is shard version {meta.get('version')}, expected {SHARD_VERSION}")
+        if merged_meta is None:
+            merged_meta = meta
+        elif (meta["tags"], meta["subtrees"]) != (merged_meta["tags"], merged_meta["subtrees"]):
+            conn.close()
+            raise ValueError(f"Error: \'{shard_path}\' was made with different --tags or --subtrees than \'{shard_paths[0]}\'")
+
+        file_paths = {file_id: interned_paths.setdefault(file_path, file_path)
+                      for file_id, file_path in cursor.execute("SELECT id, file_path FROM file_paths")}
+        component_paths: Dict[int, set] = {}
+        for component_id, name, classes, num_classes, num_instances in cursor.execute("SELECT id, name, classes, num_classes, num_instances FROM components"):
+            component = aggregate.get((name, classes))
+            if component is None:
+                component = aggregate[(name, classes)] = [num_classes, 0, set()]
+            component[1] += num_instances
+            component_paths[component_id] = component[2]
+        for component_id, file_id in cursor.execute("SELECT component_id, file_id FROM component_files"):
+            component_paths[component_id].add(file_paths[file_id])
+        if skeletons is not None:
+            skeletons.update(cursor.execute("SELECT classes, skeleton FROM skeletons"))
+
+        cursor.close()
+        conn.close()
+
+    return aggregate, merged_meta or {}
+
+
+BASELINE_VERSION = 2
+DIFF_HEADERS = ["change", "name", "num_instances", "base_num_instances", "classes", "num_locations", "base_num_locations", "file_paths"]
+DIFF_SUBTREE_HEADERS = ["change", "name", "num_instances", "base_num_instances", "subtree", "num_locations", "base_num_locations", "file_paths"]
+# git's mode for submodule entries and symlinks, whose blobs are not templates
+GIT_SKIPPED_MODES = {"160000", "120000"}
+
+def run_git(repo: str, *args: str) -> str:
+    """
+    Run a git command in the repository at repo and return its output
+
+    raises: ValueError with git's error message if the command fails
+    """
+    import subprocess
+
+    try:
+        process = subprocess.run(["git", "-C", repo, *args], capture_output=True)
+    except FileNotFoundError:
+        raise ValueError("Error: git is not installed")
+    if process.returncode != 0:
+        message = process.stderr.decode("utf-8", "replace").strip()
+        raise ValueError(f"Error: git {args[0]} failed: {message}")
+    return process.stdout.decode("utf-8", "surrogateescape")
+
+def resolve_revision(repo: str, revision: str) -> str:
+    """
+    Return the full commit id of revision
+    """
+    try:
+        return run_git(repo, "rev-parse", "--verify", "--quiet", "--end-of-options", revision + "^{commit}").strip()
+    except ValueError:
+        raise ValueError(f"Error: \'{revision}\' is not a commit in {repo}")
+
+def tree_blobs(repo: str, revision: str, extensions: Tuple[str, ...] = DEFAULT_EXTENSIONS) -> List[Tuple[str, str]]:
+    """
+    Return (file_path, blob id) of every file in revision whose name ends with one of extensions
+    """
+    blobs = []
+    for item in run_git(repo, "ls-tree", "-r", "-z", "--full-tree", revision).split("\0"):
+        if not item:
+            continue
+        info, file_path = item.split("\t", 1)
+        mode, object_type, blob = info.split()
+        if object_type == "blob" and mode not in GIT_SKIPPED_MODES and file_path.endswith(extensions):
+            blobs.append((file_path, blob))
+    return blobs
+
+def changed_blobs(repo: str, old_revision: str, new_revision: str, extensions: Tuple[str, ...] = DEFAULT_EXTENSIONS) -> List[Tuple[str, str | None, str | None]]:
+    """
+    Return (file_path, old blob id, new blob id) of every file whose name ends with one of
+    extensions that differs between old_revision and new_revision, with None for the side
+    it doesn't exist on. Renamed files count as deleted and added.
+    """
+    items = run_git(repo, "diff", "--raw", "-z", "--no-renames", "--no-abbrev", old_revision, new_revision, "--").split("\0")
+    changes = []
+    for info, file_path in zip(items[0::2], items[1::2]):
+        old_mode, new_mode, old_blob, new_blob, _ = info.lstrip(":").split()
+        if not file_path.endswith(extensions):
+            continue
+        old_blob = None if old_mode in GIT_SKIPPED_MODES or not old_blob.strip("0") else old_blob
+        new_blob = None if new_mode in GIT_SKIPPED_MODES or not new_blob.strip("0") else new_blob
+        if old_blob != new_blob:
+            changes.append((file_path, old_blob, new_blob))
+    return changes
+
+def iter_blob_contents(repo: str, blobs: List[str]) -> Iterator[Tuple[str, bytes]]:
+    """
+    Yield (blob id, content) for each of blobs, in order, read straight from the object
+    store by a single git cat-file --batch process. Blob ids are fed to git from a thread
+    while contents are read, so neither side blocks on a full pipe.
+
+    raises: ValueError if a blob doesn't exist
+    """
+    import subprocess
+
+    process = subprocess.Popen(["git", "-C", repo, "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def feed() -> None:
+        try:
+            for blob in blobs:
+                process.stdin.write(blob.encode("ascii") + b"\n")
+            process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.start()
+    try:
+        for blob in blobs:
+            header = process.stdout.readline().split()
+            if len(header) != 3:
+                raise ValueError(f"Error: git object {blob} is missing")
+            content = process.stdout.read(int(header[2]))
+            process.stdout.read(1)
+            yield blob, content
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+        writer.join()
+
+def analyze_blobs(repo: str, blobs: List[Tuple[str, str]], tags: Tuple[str, ...] = TARGET_TAGS, subtrees: bool = False, skeletons: Dict[str, str] | None = None) -> Dict[str, List[Tuple[str, str, int]]]:
+    """
+    Parse the (file_path, blob id) blobs, returning the (tag_name, class_strs, num_classes)
+    of each file, by blob id. Each distinct blob is only read and parsed once. With
+    subtrees, entries are keyed on bare digests and the skeletons are added to skeletons.
+    """
+    unique_blobs = list(dict.fromkeys(blob for _, blob in blobs))
+    paths = dict((blob, file_path) for file_path, blob in blobs)
+    if skeletons is None:
+        skeletons = {}
+    results = {}
+    for blob, raw in iter_blob_contents(repo, unique_blobs):
+        entries = analyze_content(raw, paths[blob], tags=tags, subtrees=subtrees) if may_have_entries(raw, tags, subtrees) else []
+        results[blob] = split_skeletons(entries, skeletons) if subtrees else entries
+    return results
+
+def open_baseline(baseline_path: str, tags: Tuple[str, ...] = TARGET_TAGS, extensions: Tuple[str, ...] = DEFAULT_EXTENSIONS, subtrees: bool = False) -> Connection:
+    """
+    Open (creating if needed) the baseline database at baseline_path, which stores each
+    component's instance count and the files it is in at one revision of a repository.
+    A baseline made by a different baseline version or with different tags, extensions
+    or subtrees setting is discarded.
+    """
+    import sqlite3
+
+    conn = sqlite3.connect(baseline_path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS baseline_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+    config = f"{BASELINE_VERSION}:{DEFAULT_PARSER}:{','.join(sorted(tags))}:{','.join(sorted(extensions))}"
+    if subtrees:
+        config += ":subtrees"
+    row = cursor.execute("SELECT value FROM baseline_meta WHERE key = 'config'").fetchone()
+    if row is None or row[0] != config:
+        cursor.execute("DROP TABLE IF EXISTS baseline_components")
+        cursor.execute("DROP TABLE IF EXISTS baseline_files")
+        cursor.execute("DELETE FROM baseline_meta")
+        cursor.execute("INSERT INTO baseline_meta (key, value) VALUES ('config', ?)", (config,))
+
+    cursor.executescript('''
+        CREATE TABLE IF NOT EXISTS baseline_components (
+            name TEXT,
+            classes TEXT,
+            num_classes INTEGER,
+            num_instances INTEGER,
+            PRIMARY KEY (name, classes)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS baseline_files (
+            name TEXT,
+            classes TEXT,
+            file_path TEXT,
+            PRIMARY KEY (name, classes, file_path)
+        ) WITHOUT ROWID;
+    ''')
+    conn.commit()
+    cursor.close()
+    return conn
+
+def baseline_revision(conn: Connection) -> str | None:
+    row = conn.execute("SELECT value FROM baseline_meta WHERE key = 'revision'").fetchone()
+    return row[0] if row is not None else None
+
+def count_entries(entries: List[Tuple[str, str, int]]) -> Dict[Tuple[str, str], List[int]]:
     """
-    path: a path to a file or directory
+    Return [num_classes, num_instances] of each (tag_name, class_str) in one file's entries
+    """
+    counts: Dict[Tuple[str, str], List[int]] = {}
+    for name, classes, num_classes in entries:
+        count = counts.get((name, classes))
+        if count is None:
+            counts[(name, classes)] = [num_classes, 1]
+        else:
+            count[1] += 1
+    return counts
 
-    returns: a list of (filepath, filename) to all .html files in the directory,
-             or a list of a single filepath if path is to a file.
-             If the path is invalid, raise an error
+def apply_file_change(cursor: Cursor, file_path: str, old_entries: List[Tuple[str, str, int]], new_entries: List[Tuple[str, str, int]]) -> None:
+    """
+    Replace the counts of file_path's old entries in a baseline with those of its new entries
     """
+    old_counts = count_entries(old_entries)
+    new_counts = count_entries(new_entries)
+    cursor.executemany("UPDATE baseline_components SET num_instances = num_instances - ? WHERE name = ? AND classes = ?",
+                       [(count, name, classes) for (name, classes), (_, count) in old_counts.items()])
+    cursor.executemany("DELETE FROM baseline_files WHERE name = ? AND classes = ? AND file_path = ?",
+                       [(name, classes, file_path) for name, classes in old_counts])
+    cursor.executemany('''
+        INSERT INTO baseline_components (name, classes, num_classes, num_instances) VALUES(?, ?, ?, ?)
+        ON CONFLICT (name, classes) DO UPDATE SET num_instances = num_instances + excluded.num_instances
+    ''', [(name, classes, num_classes, count) for (name, classes), (num_classes, count) in new_counts.items()])
+    cursor.executemany("INSERT OR IGNORE INTO baseline_files (name, classes, file_path) VALUES(?, ?, ?)",
+                       [(name, classes, file_path) for name, classes in new_counts])
+    cursor.executemany("DELETE FROM baseline_components WHERE name = ? AND classes = ? AND num_instances <= 0",
+                       [key for key in old_counts if key not in new_counts])
 
-    if (os.path.isfile(path)):
-        
-        return [path]
-    elif (os.path.isdir(path)):
-        directories = os.walk(path)
-        filepaths = []
-        for dirpath, dirnames, filenames in directories:
-            for filename in filenames:
-                if filename.endswith(".html"):
-                    filepath = os.path.join(dirpath,filename)
-                    filepaths.append(filepath)
-        if (not filepaths):
-            print("no .html files to analyze in the given directory.")
-            sys.exit(0)
-        return filepaths
-    
-    raise FileNotFoundError(f"\'{path}\' is not a path to a file or directory.")
+def update_baseline(conn: Connection, repo: str, revision: str, tags: Tuple[str, ...] = TARGET_TAGS, extensions: Tuple[str, ...] = DEFAULT_EXTENSIONS, subtrees: bool = False) -> int:
+    """
+    Bring the baseline in conn to the commit revision. A baseline at another revision is
+    updated by parsing only the files that changed in between, on both sides; an empty
+    baseline, or one whose revision is no longer in the repository, is built from every
+    file in revision.
 
-def parse_html(content: str, file_path: str) -> List[TagEntry]:
+    returns: the number of files whose blobs were parsed
     """
-    Given a file_path and its content, return a 3-tuple for each tag in the file:
-    (tag_name, class_strs, file_path), where class_strs is a alphabetically sorted,
-    space separated string of classes in the tag. 
+    current = baseline_revision(conn)
+    if current == revision:
+        return 0
+    changes = None
+    if current is not None:
+        try:
+            changes = changed_blobs(repo, current, revision, extensions)
+        except ValueError:
+            changes = None
+    cursor = conn.cursor()
+    if changes is None:
+        cursor.execute("DELETE FROM baseline_components")
+        cursor.execute("DELETE FROM baseline_files")
+        changes = [(file_path, None, blob) for file_path, blob in tree_blobs(repo, revision, extensions)]
+
+    blobs = [(file_path, blob) for file_path, old_blob, new_blob in changes for blob in (old_blob, new_blob) if blob is not None]
+    entries = analyze_blobs(repo, blobs, tags, subtrees)
+    for file_path, old_blob, new_blob in changes:
+        apply_file_change(cursor, file_path, entries.get(old_blob, []), entries.get(new_blob, []))
+    cursor.execute("INSERT OR REPLACE INTO baseline_meta (key, value) VALUES ('revision', ?)", (revision,))
+    conn.commit()
+    cursor.close()
+    return len(blobs)
+
+def diff_revisions(conn: Connection, repo: str, base: str, head: str, min_classes=1, min_instances=2, min_locations=1, tags: Tuple[str, ...] = TARGET_TAGS, extensions: Tuple[str, ...] = DEFAULT_EXTENSIONS, subtrees: bool = False) -> List[Tuple[str, str, int, int, str, int, int, List[str]]]:
     """
-    soup = BeautifulSoup(content, "html.parser")
-    all_elements = soup.find_all(["div"])
-    tags = [elem for elem in all_elements if isinstance(elem, Tag)]
+    Compare the components of the commits base and head of the repository at repo, using
+    the baseline in conn (which is first brought to base) and the files changed between
+    them, so the work done scales with the size of the diff rather than the repository.
 
-    data = []
-    for tag in tags:
-        name = tag.name
+    returns: (change, name, num_instances, base_num_instances, classes, num_locations,
+    base_num_locations, file_paths) for each component that passes the filters at head
+    but not at base ("new"), or at base but not at head ("resolved"), sorted by tag name
+    and classes. file_paths are the component's files at head. With subtrees, classes is
+    the subtree's skeleton, which every component the diff touches has in a changed file.
+    """
+    update_baseline(conn, repo, base, tags, extensions, subtrees)
+    changes = changed_blobs(repo, base, head, extensions)
+    blobs = [(file_path, blob) for file_path, old_blob, new_blob in changes for blob in (old_blob, new_blob) if blob is not None]
+    skeletons: Dict[str, str] = {}
+    entries = analyze_blobs(repo, blobs, tags, subtrees, skeletons)
 
-        class_attr = tag.attrs.get("class")
-        if class_attr is None:
+    # [num_classes, instance change, files it left, files it joined] of each component the diff touches
+    deltas: Dict[Tuple[str, str], List] = {}
+    for file_path, old_blob, new_blob in changes:
+        for side, blob in ((-1, old_blob), (1, new_blob)):
+            for key, (num_classes, count) in count_entries(entries.get(blob, [])).items():
+                delta = deltas.get(key)
+                if delta is None:
+                    delta = deltas[key] = [num_classes, 0, set(), set()]
+                delta[1] += side * count
+                delta[2 if side < 0 else 3].add(file_path)
+
+    def passes(num_classes: int, num_instances: int, num_locations: int) -> bool:
+        return num_classes >= min_classes and num_instances >= min_instances and num_locations >= min_locations
+
+    cursor = conn.cursor()
+    rows = []
+    for (name, classes), (num_classes, instance_change, left, joined) in sorted(deltas.items()):
+        row = cursor.execute("SELECT num_instances FROM baseline_components WHERE name = ? AND classes = ?", (name, classes)).fetchone()
+        base_instances = row[0] if row is not None else 0
+        base_locations = cursor.execute("SELECT COUNT(*) FROM baseline_files WHERE name = ? AND classes = ?", (name, classes)).fetchone()[0]
+        head_instances = base_instances + instance_change
+        head_locations = base_locations - len(left - joined) + len(joined - left)
+        was_reported = passes(num_classes, base_instances, base_locations)
+        if was_reported == passes(num_classes, head_instances, head_locations):
             continue
-        
-        classes = sorted(list(set(class_attr)))
-        classes.sort()
-        num_classes = len(classes)
-        class_strs = " ".join(str(class_name) for class_name in classes)
-        data.append((name, class_strs, num_classes, file_path))
+        base_files = {file_path for file_path, in cursor.execute("SELECT file_path FROM baseline_files WHERE name = ? AND classes = ?", (name, classes))}
+        head_files = sorted((base_files - left) | joined)
+        rows.append(("resolved" if was_reported else "new", name, head_instances, base_instances, skeletons.get(classes, classes), head_locations, base_locations, head_files))
+    cursor.close()
+    return rows
 
-    return data
 
-def parse_data(data: List[TagEntry], conn: Connection) -> None:
+class Watcher:
     """
-    Given a data representation of tag data, update the
-    database to include that data
+    Per-file entries and their aggregate for --watch, kept in memory between polls of the
+    directory at path, so a change only costs reparsing the files that changed.
+
+    The aggregate has the form built by aggregate_data, except that each component maps
+    its labels to how many of its instances they have, rather than holding a set of them.
+    That lets a file's old entries be subtracted again, even when --short gives several
+    files the same label.
     """
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tag_data (
-            id INTEGER PRIMARY KEY,
-            name TEXT,
-            classes TEXT,
-            num_classes INTEGER,
-            file_path TEXT
-        )
-    ''')
 
-    cursor.executemany("INSERT INTO tag_data (name, classes, num_classes, file_path) VALUES(?, ?, ?, ?)", data)
-    conn.commit()
-    cursor.close()
+    def __init__(self, path: str, is_short: bool = False, parser: str = DEFAULT_PARSER, verify: bool = False, tags: Tuple[str, ...] = TARGET_TAGS, subtrees: bool = False, walk_options: Dict[str, Any] | None = None) -> None:
+        self.path = path
+        # Keyword arguments of iter_filepaths
+        self.walk_options = walk_options or {}
+        self.is_short = is_short
+        self.parser = parser
+        self.verify = verify
+        self.tags = tags
+        self.subtrees = subtrees
+        # (mtime_ns, size) and entries of each file, by file path
+        self.snapshot: Dict[str, Tuple[int, int]] = {}
+        self.entries: Dict[str, List[Tuple[str, str, int]]] = {}
+        self.aggregate: Dict[Tuple[str, str], List] = {}
+        # Skeleton of each subtree digest in the aggregate, with subtrees
+        self.skeletons: Dict[str, str] = {}
 
-def analyze_db_info(conn: Connection, csv_path="template_analysis.csv", min_classes=1, min_instances=2, min_locations=1) -> None:
+    def scan(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Return the (mtime_ns, size) of each file under path that iter_filepaths yields, by file path
+        """
+        snapshot = {}
+        try:
+            for file_path in iter_filepaths(self.path, **self.walk_options):
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                snapshot[file_path] = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            # The watched path itself was removed; every file counts as deleted
+            pass
+        return snapshot
+
+    def label(self, file_path: str) -> str:
+        return os.path.basename(file_path) if self.is_short else file_path
+
+    def add(self, file_path: str, entries: List[Tuple[str, str, int]]) -> None:
+        label = self.label(file_path)
+        if self.subtrees:
+            entries = split_skeletons(entries, self.skeletons)
+        self.entries[file_path] = entries
+        for name, classes, num_classes in entries:
+            component = self.aggregate.get((name, classes))
+            if component is None:
+                component = self.aggregate[(name, classes)] = [num_classes, 0, {}]
+            component[1] += 1
+            component[2][label] = component[2].get(label, 0) + 1
+
+    def remove(self, file_path: str) -> None:
+        label = self.label(file_path)
+        for name, classes, _ in self.entries.pop(file_path, []):
+            component = self.aggregate[(name, classes)]
+            component[1] -= 1
+            component[2][label] -= 1
+            if not component[2][label]:
+                del component[2][label]
+            if not component[1]:
+                del self.aggregate[(name, classes)]
+                self.skeletons.pop(classes, None)
+
+    def load(self, jobs: int = 1, io_threads: int = 1) -> int:
+        """
+        Parse every file under path, in a pool of jobs processes if jobs is greater than 1
+
+        returns: the number of files loaded
+        """
+        self.snapshot = self.scan()
+        for file_path, entries in analyze_files(list(self.snapshot), self.parser, self.verify, jobs, None, self.tags, io_threads, self.subtrees):
+            self.add(file_path, entries)
+        return len(self.snapshot)
+
+    def update(self) -> int:
+        """
+        Poll path once, and replace the entries of every file that was added, modified or
+        deleted since the last poll. Files that can't be parsed are reported and left out
+        until they change again.
+
+        returns: the number of files that changed
+        """
+        snapshot = self.scan()
+        changed = [file_path for file_path, signature in snapshot.items() if self.snapshot.get(file_path) != signature]
+        deleted = [file_path for file_path in self.snapshot if file_path not in snapshot]
+
+        for file_path in deleted:
+            self.remove(file_path)
+        for file_path in changed:
+            self.remove(file_path)
+            try:
+                self.add(file_path, analyze_file(file_path, self.parser, self.verify, self.tags, self.subtrees))
+            except FileNotFoundError:
+                # Deleted since the scan; the next poll no longer sees it
+                del snapshot[file_path]
+            except (IOError, ValueError) as e:
+                print(f"Error reading \'{file_path}\': {e}")
+        self.snapshot = snapshot
+        return len(changed) + len(deleted)
+
+    def rows(self, min_classes=1, min_instances=2, min_locations=1, similarity: float | None = None) -> List[Tuple]:
+        """
+        Return the output rows of the current aggregate, as iter_memory_info (or
+        cluster_similar, if similarity is given) would for a full run
+        """
+        if similarity is None:
+            rows = iter_memory_info(self.aggregate, min_classes, min_instances, min_locations)
+            return list(show_skeletons(rows, self.skeletons) if self.subtrees else rows)
+        return cluster_similar(list(iter_memory_info(self.aggregate, min_classes, 1, 1)), similarity, min_instances, min_locations)
+
+def watch(watcher: Watcher, output_file: str, min_classes=1, min_instances=2, min_locations=1, similarity: float | None = None, interval: float = 1.0, jobs: int = 1, io_threads: int = 1, output_format: str = "csv", polls: int | None = None) -> None:
     """
-    Given a connection to a populated database, analyze the tag data in the database and
-    create a csv file with (name, num_occurrences, classes, file_paths) for each unique
-    component (tag + classes). 
+    Load every file into watcher and write the output file in output_format, then poll for
+    changes every interval seconds and rewrite it whenever files changed. Runs until
+    interrupted, or for polls polls if given.
+    """
+    headers = SUBTREE_HEADERS if watcher.subtrees else RESULT_HEADERS
+    if similarity is not None:
+        headers = CLUSTER_HEADERS
 
-    Only include tags with at least min_classes (default=1) classes that occur at least min_instances (default=2) times.  
+    num_files = watcher.load(jobs, io_threads)
+    write_rows(watcher.rows(min_classes, min_instances, min_locations, similarity), output_file, headers, output_format)
+    print(f"Output file created at: {output_file} ({num_files} files). Watching for changes...")
+
+    poll = 0
+    while polls is None or poll < polls:
+        poll += 1
+        time.sleep(interval)
+        start = time.perf_counter()
+        num_changed = watcher.update()
+        if num_changed:
+            write_rows(watcher.rows(min_classes, min_instances, min_locations, similarity), output_file, headers, output_format)
+            print(f"{num_changed} file(s) changed, output file updated in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+class Analyzer:
     """
-    cursor = conn.cursor()
-    cursor.execute(f'''
-        SELECT name, COUNT(id) as num_instances, classes, GROUP_CONCAT(DISTINCT file_path ORDER BY file_path) as file_paths
-        FROM tag_data
-        WHERE num_classes >= {min_classes} 
-        GROUP BY name, classes
-        HAVING num_instances >= {min_instances} AND COUNT(DISTINCT file_path) >= {min_locations}
-        ORDER BY num_instances DESC
-    ''')
-    query_data = cursor.fetchall()
+    Long-lived analysis for use as a library, e.g. from a build server: add templates with
+    add_file, add_html or add_many, then read results as many times as needed, and close
+    it when done. It can be used as a context manager.
 
-    if "." not in csv_path:
-        csv_path += ".csv"
+    The sqlite backend keeps its tag data in its own connection to database, which is a
+    private in-memory database by default, so any number of instances can run side by side
+    in one process. Give each instance its own database file, since the file is deleted by
+    close. The memory backend keeps a dict built by aggregate_data. Adding and reading are
+    serialized by a lock, so one instance can also be shared between threads. Once closed,
+    adding or reading raises ValueError.
 
-    if not os.path.isdir(csv_path):
-        csv_path = Path(csv_path)
-        csv_path.parent.mkdir(exist_ok=True, parents=True)
+    With subtrees, components are keyed on subtree digests and the skeleton of each digest
+    is kept in skeletons, which results show in place of the digest.
+    """
 
-    with open(csv_path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow([header[0] for header in cursor.description])
-        writer.writerows(query_data)
+    def __init__(self, backend: str = "sqlite", database: str = ":memory:", parser: str = DEFAULT_PARSER, verify: bool = False, tags: Tuple[str, ...] = TARGET_TAGS, subtrees: bool = False, is_short: bool = False) -> None:
+        if backend not in BACKENDS:
+            raise ValueError(f"Error: {backend} is not a recognized backend")
+        if parser not in PARSERS:
+            raise ValueError(f"Error: {parser} is not a recognized parser")
+        self.backend = backend
+        self.database = database
+        self.parser = parser
+        self.verify = verify
+        self.tags = tags
+        self.subtrees = subtrees
+        self.is_short = is_short
+        self.headers = SUBTREE_HEADERS if subtrees else RESULT_HEADERS
+        self.lock = threading.RLock()
+        self.conn = None
+        self.aggregate: Dict[Tuple[str, str], List] = {}
+        self.skeletons: Dict[str, str] = {}
+        # Whether the database has data that flush hasn't committed and indexed yet
+        self.pending = False
+        self.closed = False
+        if backend == "sqlite":
+            import sqlite3
+            self.conn = sqlite3.connect(database, check_same_thread=False)
+            self.bulk_ids = begin_bulk_load(self.conn)
+
+    def __enter__(self) -> "Analyzer":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def label(self, file_path: str) -> str:
+        return os.path.basename(file_path) if self.is_short else file_path
+
+    def _check_open(self) -> None:
+        if self.closed:
+            raise ValueError("Error: the Analyzer is closed")
+
+    def add_entries(self, data: List[TagEntry]) -> None:
+        """
+        Add labeled tag entries, as passed to parse_data or aggregate_data
+        """
+        with self.lock:
+            self._check_open()
+            if self.subtrees:
+                data = split_skeletons(data, self.skeletons)
+            if self.conn is not None:
+                parse_data(data, self.conn, self.bulk_ids)
+                self.pending = True
+            else:
+                aggregate_data(data, self.aggregate)
+
+    def add_html(self, content: str, file_path: str) -> int:
+        """
+        Add the tags of html content, as if it was read from file_path
+
+        returns: the number of tag entries added
+        """
+        data = parse_html(content, self.label(file_path), self.parser, self.verify, self.tags, self.subtrees)
+        self.add_entries(data)
+        return len(data)
+
+    def add_file(self, file_path: str) -> int:
+        """
+        Add the tags of the file at file_path
+
+        returns: the number of tag entries added
+        """
+        label = self.label(file_path)
+        data = [entry + (label,) for entry in analyze_file(file_path, self.parser, self.verify, self.tags, self.subtrees)]
+        self.add_entries(data)
+        return len(data)
+
+    def add_many(self, file_paths: Iterable[str], jobs: int = 1, io_threads: int = 1) -> int:
+        """
+        Add the tags of every file in file_paths, e.g. from iter_filepaths, reading and
+        parsing them as analyze_files does
+
+        returns: the number of files added
+        """
+        self._check_open()
+        results = analyze_files(file_paths, self.parser, self.verify, jobs, None, self.tags, io_threads, self.subtrees)
+        return load_entries(results, self.add_entries, self.is_short)
+
+    def flush(self) -> None:
+        """
+        Commit the data added to the database and build its query index. Called by the
+        methods that read results, so it only needs calling to time it separately.
+        """
+        with self.lock:
+            self._check_open()
+            if self.pending:
+                finish_bulk_load(self.conn)
+                self.pending = False
+
+    def iter_results(self, min_classes=1, min_instances=2, min_locations=1) -> Iterator[Tuple[str, int, str, List[str]]]:
+        """
+        Yield the rows of results one at a time. Nothing may be added until they have all
+        been read.
+        """
+        self.flush()
+        if self.conn is not None:
+            rows = iter_db_info(self.conn, min_classes, min_instances, min_locations)
+        else:
+            rows = iter_memory_info(self.aggregate, min_classes, min_instances, min_locations)
+        return show_skeletons(rows, self.skeletons) if self.subtrees else rows
+
+    def results(self, min_classes=1, min_instances=2, min_locations=1) -> List[Tuple[str, int, str, List[str]]]:
+        """
+        returns: (name, num_instances, classes, file_paths) of each component of everything
+        added so far that passes the filters, most frequent first, then by tag name and classes
+        """
+        with self.lock:
+            return list(self.iter_results(min_classes, min_instances, min_locations))
+
+    def components(self) -> Iterator[Tuple[str, str, int, int, List[str]]]:
+        """
+        Yield every component unfiltered, as iter_db_components does, e.g. for write_shard
+        (along with skeletons, for subtrees)
+        """
+        self.flush()
+        if self.conn is not None:
+            return iter_db_components(self.conn)
+        return iter_memory_components(self.aggregate)
+
+    def num_components(self) -> int:
+        with self.lock:
+            self._check_open()
+            return count_db_components(self.conn) if self.conn is not None else len(self.aggregate)
+
+    def close(self) -> None:
+        """
+        Release the backend's data, deleting the database file if there is one. Closing
+        twice does nothing.
+        """
+        with self.lock:
+            self.closed = True
+            if self.conn is not None:
+                drop_data(self.conn)
+                self.conn.close()
+                self.conn = None
+                if self.database != ":memory:" and os.path.exists(self.database):
+                    os.remove(self.database)
+            self.aggregate = {}
+            self.skeletons = {}
+
+# Defaults for options that are not part of the positional parse_args result
+DEFAULT_OPTIONS: Dict[str, Any] = {
+    "parser": DEFAULT_PARSER,
+    "verify_parser": False,
+    "jobs": 1,
+    "tags": TARGET_TAGS,
+    "io_threads": 1,
+    "similarity": None,
+    "subtrees": False,
+    "shard": None,
+    "watch": False,
+    "top_k": None,
+    "format": "csv",
+    "extensions": DEFAULT_EXTENSIONS,
+    "excludes": (),
+    "ignore_files": True,
+    "follow_symlinks": False,
+    "watch_interval": 1.0,
+    "backend": "sqlite",
+    "cache": None,
+    "database": "database.db",
+    "stats": False,
+    "stats_json": None,
+    "profile": None,
+}
+
+# Defaults of the options shared by the analysis, merge and diff commands
+SHARED_DEFAULTS: Dict[str, Any] = {
+    "output": None,
+    "format": "csv",
+    "min_classes": 1,
+    "min_occurrences": 2,
+    "min_locations": 1,
+}
+LIMIT_ARGS = {"-mc": "min_classes", "--min-classes": "min_classes", "-mo": "min_occurrences",
+              "--min-occurrences": "min_occurrences", "-ml": "min_locations", "--min-locations": "min_locations"}
+
+def parse_shared_option(args: List, i: int, settings: Dict[str, Any]) -> bool:
+    """
+    Parse args[i] if it is one of the options shared by the analysis, merge and diff
+    commands: -o, -f, -mc, -mo, -ml, and -t and -e when settings has a "tags" or
+    "extensions" key. Its value, args[i+1], which the caller has checked is there, is
+    stored in settings under the keys of SHARED_DEFAULTS.
+
+    returns: whether args[i] was one of these options
+    raises: ValueError if its value is invalid
+    """
+    arg = args[i]
+    if arg in ["-o", "--output"]:
+        settings["output"] = args[i+1]
+    elif arg in ["-f", "--format"]:
+        if args[i+1] not in OUTPUT_FORMATS:
+            raise ValueError(f"Error: {args[i+1]} is not a recognized output format")
+        settings["format"] = args[i+1]
+    elif arg in LIMIT_ARGS:
+        try:
+            settings[LIMIT_ARGS[arg]] = int(args[i+1])
+        except ValueError:
+            raise ValueError(f"Error: {args[i+1]} is not an integer")
+    elif arg in ["-t", "--tags"] and "tags" in settings:
+        tags = tuple(tag.strip().lower() for tag in args[i+1].split(",") if tag.strip())
+        if not tags:
+            raise ValueError(f"Error: {arg} requires at least one tag name")
+        settings["tags"] = tags
+    elif arg in ["-e", "--extensions"] and "extensions" in settings:
+        extensions = tuple(ext if ext.startswith(".") else "." + ext for ext in (ext.strip() for ext in args[i+1].split(",")) if ext)
+        if not extensions:
+            raise ValueError(f"Error: {arg} requires at least one file extension")
+        settings["extensions"] = extensions
+    else:
+        return False
+    return True
 
 def parse_args(args: List) -> List:
     if (len(args) == 1):
@@ -119,39 +2481,107 @@ def parse_args(args: List) -> List:
 
     analysis_dir = None
     # Default values
-    output_file = "template_analysis.csv"
-    min_classes = 1
-    min_occurrences = 2
-    min_locations = 1
     is_short = False
+    options = dict(DEFAULT_OPTIONS)
+    settings = dict(SHARED_DEFAULTS, format=options["format"], tags=options["tags"], extensions=options["extensions"])
+    backend_given = False
 
     i = 1
     while i < len(args):
         arg = args[i]
         if arg in ["-s", "--short"]:
             is_short = True
+        elif arg == "--verify-parser":
+            options["verify_parser"] = True
+        elif arg == "--stats":
+            options["stats"] = True
+        elif arg == "--subtrees":
+            options["subtrees"] = True
+        elif arg == "--watch":
+            options["watch"] = True
+        elif arg == "--no-ignore":
+            options["ignore_files"] = False
+        elif arg == "--follow-symlinks":
+            options["follow_symlinks"] = True
         elif arg.startswith("-") and i + 1  >= len(args):
             raise ValueError(f"Error: {arg} requires an additional argument")
-        elif arg in ["-o", "--output"]:
-            output_file = args[i+1]
+        elif parse_shared_option(args, i, settings):
+            i += 1
+        elif arg in ["-p", "--parser"]:
+            if args[i+1] not in PARSERS:
+                raise ValueError(f"Error: {args[i+1]} is not a recognized parser")
+            options["parser"] = args[i+1]
             i += 1
-        elif arg in ["-mc", "--min-classes"]:
+        elif arg in ["-b", "--backend"]:
+            if args[i+1] not in BACKENDS:
+                raise ValueError(f"Error: {args[i+1]} is not a recognized backend")
+            options["backend"] = args[i+1]
+            backend_given = True
+            i += 1
+        elif arg == "--watch-interval":
+            try:
+                interval = float(args[i+1])
+            except ValueError:
+                raise ValueError(f"Error: {args[i+1]} is not a number")
+            if interval <= 0:
+                raise ValueError(f"Error: {arg} must be greater than 0")
+            options["watch_interval"] = interval
+            i += 1
+        elif arg == "--top-k":
             try:
-                min_classes = int(args[i+1])
+                top_k = int(args[i+1])
             except ValueError:
                 raise ValueError(f"Error: {args[i+1]} is not an integer")
+            if top_k < 1:
+                raise ValueError(f"Error: {arg} must be at least 1")
+            options["top_k"] = top_k
             i += 1
-        elif arg in ["-mo", "--min-occurrences"]:
+        elif arg == "--shard":
+            options["shard"] = args[i+1]
+            i += 1
+        elif arg in ["-c", "--cache"]:
+            options["cache"] = args[i+1]
+            i += 1
+        elif arg == "--io-threads":
             try:
-                min_occurrences = int(args[i+1])
+                io_threads = int(args[i+1])
             except ValueError:
                 raise ValueError(f"Error: {args[i+1]} is not an integer")
+            if io_threads < 1:
+                raise ValueError(f"Error: {arg} must be at least 1")
+            options["io_threads"] = io_threads
+            i += 1
+        elif arg == "--similarity":
+            try:
+                similarity = float(args[i+1])
+            except ValueError:
+                raise ValueError(f"Error: {args[i+1]} is not a number")
+            if not 0 < similarity <= 1:
+                raise ValueError(f"Error: {arg} must be greater than 0 and at most 1")
+            options["similarity"] = similarity
+            i += 1
+        elif arg in ["-x", "--exclude"]:
+            options["excludes"] = options["excludes"] + (args[i+1],)
+            i += 1
+        elif arg in ["-d", "--database"]:
+            options["database"] = args[i+1]
+            backend_given = True
+            i += 1
+        elif arg == "--stats-json":
+            options["stats_json"] = args[i+1]
             i += 1
-        elif arg in ["-ml", "--min-locations"]:
+        elif arg == "--profile":
+            options["profile"] = args[i+1]
+            i += 1
+        elif arg in ["-j", "--jobs"]:
             try:
-                min_locations = int(args[i+1])
+                jobs = int(args[i+1])
             except ValueError:
                 raise ValueError(f"Error: {args[i+1]} is not an integer")
+            if jobs < 0:
+                raise ValueError(f"Error: {arg} must not be negative")
+            # 0 uses every available core
+            options["jobs"] = jobs or os.cpu_count() or 1
             i += 1
         elif arg.startswith("-"):
             raise ValueError(f"Error: {arg} is not a recognized option")
@@ -163,53 +2593,629 @@ def parse_args(args: List) -> List:
     
     if analysis_dir is None:
         raise ValueError("Error: no target file or directory specified")
+    for key in ["format", "tags", "extensions"]:
+        options[key] = settings[key]
+    output_file = settings["output"]
+    if output_file is None:
+        output_file = "template_analysis" + OUTPUT_EXTENSIONS[options["format"]]
+    if options["subtrees"] and (options["parser"] != "stream" or options["verify_parser"]):
+        raise ValueError("Error: --subtrees only works with the stream parser")
+    if options["subtrees"] and options["similarity"] is not None:
+        raise ValueError("Error: --subtrees can't be combined with --similarity")
+    if options["shard"] is not None and options["similarity"] is not None:
+        raise ValueError("Error: --shard can't be combined with --similarity")
+    if options["watch"] and (options["shard"] is not None or options["cache"] is not None):
+        raise ValueError("Error: --watch keeps its data in memory and can't be combined with --shard or --cache")
+    if options["top_k"] is not None and (options["shard"] is not None or options["similarity"] is not None or options["watch"]):
+        raise ValueError("Error: --top-k can't be combined with --shard, --similarity or --watch")
+    if options["top_k"] is not None and backend_given:
+        raise ValueError("Error: --top-k uses its own in-memory sketch and can't be combined with --backend or --database")
     
-    return [analysis_dir, output_file, min_classes, min_occurrences, min_locations, is_short]
+    return [analysis_dir, output_file, settings["min_classes"], settings["min_occurrences"], settings["min_locations"], is_short, options]
 
+def parse_merge_args(args: List) -> List:
+    """
+    Parse the arguments of the merge subcommand: analyze.py merge <shard>... [options]
+    """
+    if len(args) == 2:
+        raise ValueError("Error: please provide one or more shard files to merge.")
 
-if __name__ == "__main__":
+    shard_paths = []
+    settings = dict(SHARED_DEFAULTS)
+
+    i = 2
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith("-") and i + 1 >= len(args):
+            raise ValueError(f"Error: {arg} requires an additional argument")
+        elif parse_shared_option(args, i, settings):
+            i += 1
+        elif arg.startswith("-"):
+            raise ValueError(f"Error: {arg} is not a recognized option")
+        else:
+            shard_paths.append(arg)
+        i += 1
+
+    if not shard_paths:
+        raise ValueError("Error: no shard files specified")
+    output_file = settings["output"]
+    if output_file is None:
+        output_file = "template_analysis" + OUTPUT_EXTENSIONS[settings["format"]]
+
+    return [shard_paths, output_file, settings["min_classes"], settings["min_occurrences"], settings["min_locations"], settings["format"]]
+
+def parse_diff_args(args: List) -> List:
+    """
+    Parse the arguments of the diff subcommand: analyze.py diff <base> <head> [options]
+    """
+    revisions = []
+    settings = dict(SHARED_DEFAULTS, tags=TARGET_TAGS, extensions=DEFAULT_EXTENSIONS)
+    options = {"repo": ".", "baseline": "template_baseline.db", "subtrees": False}
+
+    i = 2
+    while i < len(args):
+        arg = args[i]
+        if arg == "--subtrees":
+            options["subtrees"] = True
+        elif arg.startswith("-") and i + 1 >= len(args):
+            raise ValueError(f"Error: {arg} requires an additional argument")
+        elif parse_shared_option(args, i, settings):
+            i += 1
+        elif arg == "-C":
+            options["repo"] = args[i+1]
+            i += 1
+        elif arg == "--baseline":
+            options["baseline"] = args[i+1]
+            i += 1
+        elif arg.startswith("-"):
+            raise ValueError(f"Error: {arg} is not a recognized option")
+        elif len(revisions) < 2:
+            revisions.append(arg)
+        else:
+            raise ValueError(f"Error: too many arguments")
+        i += 1
+
+    if len(revisions) < 2:
+        raise ValueError("Error: please provide a base and a head revision to compare.")
+    for key in ["format", "tags", "extensions"]:
+        options[key] = settings[key]
+    output_file = settings["output"]
+    if output_file is None:
+        output_file = "template_diff" + OUTPUT_EXTENSIONS[options["format"]]
+
+    return [revisions[0], revisions[1], output_file, settings["min_classes"], settings["min_occurrences"], settings["min_locations"], options]
+
+
+# Seconds without a request after which a daemon started by serve exits
+DAEMON_IDLE_TIMEOUT = 600.0
+# Seconds a client waits for a daemon it started to accept connections
+DAEMON_START_TIMEOUT = 10.0
+
+def _current_uid() -> int | None:
+    return os.getuid() if hasattr(os, "getuid") else None
+
+def user_socket_directory() -> str:
+    """
+    Return the current user's private directory for the daemon socket in the temporary
+    directory, used when $XDG_RUNTIME_DIR is not set
+    """
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), f"template-analyzer-{_current_uid() or 0}")
+
+def default_socket_path() -> str:
+    """
+    Return the unix socket of the current user's daemon: in $XDG_RUNTIME_DIR, which only
+    the user can access, or else in user_socket_directory
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "template-analyzer.sock")
+    return os.path.join(user_socket_directory(), "daemon.sock")
+
+def make_socket_directory(directory: str) -> None:
+    """
+    Create directory with mode 0700 if it doesn't exist. As anyone can create it first in
+    the shared temporary directory, it is then checked (without following symlinks) to be
+    a directory owned by the current user that nobody else can access.
+
+    raises: ValueError if it isn't
+    """
+    import stat
+
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != _current_uid() or info.st_mode & 0o077:
+        raise ValueError(f"Error: {directory} must be a directory that only the current user can access")
+
+def check_socket(socket_path: str) -> bool:
+    """
+    Check that whatever is at socket_path is a unix socket owned by the current user, so
+    nothing is sent to, or removed from, a path another user has taken
+
+    returns: whether socket_path exists
+    raises: ValueError if it is something else
+    """
+    import stat
+
+    try:
+        info = os.lstat(socket_path)
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISSOCK(info.st_mode) or info.st_uid != _current_uid():
+        raise ValueError(f"Error: {socket_path} is not a socket owned by the current user")
+    return True
+
+def _peer_uid(sock) -> int | None:
+    """
+    Return the user id of the process at the other end of a connected unix socket, where
+    the platform can tell (SO_PEERCRED)
+    """
+    import socket
+    import struct
+
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", credentials)[1]
+
+def script_version() -> int:
+    """
+    Return the modification time of this script, so a daemon running older code can be told apart
+    """
+    return os.stat(os.path.abspath(__file__)).st_mtime_ns
+
+def _send_message(sock, message: Dict[str, Any]) -> None:
+    sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+def _receive_message(sock) -> Dict[str, Any] | None:
+    with sock.makefile("rb") as f:
+        line = f.readline()
+    return json.loads(line) if line else None
+
+def run_request(argv: List[str], cwd: str) -> Tuple[int, str]:
+    """
+    Run main(argv) in the directory cwd with its output captured, as a daemon does for a client
+
+    returns: the exit code and everything main printed
+    """
+    import io
+    from contextlib import redirect_stdout
+
+    output = io.StringIO()
+    previous_cwd = os.getcwd()
+    code = 0
+    try:
+        os.chdir(cwd)
+        with redirect_stdout(output):
+            try:
+                main(argv)
+            except SystemExit as e:
+                if isinstance(e.code, int) or e.code is None:
+                    code = e.code or 0
+                else:
+                    print(e.code)
+                    code = 1
+            except Exception as e:
+                print(f"Unexpected error: {e}")
+                code = 1
+    except OSError as e:
+        print(f"Error: {e}", file=output)
+        code = 1
+    finally:
+        os.chdir(previous_cwd)
+    return code, output.getvalue()
+
+def serve(socket_path: str, idle_timeout: float = DAEMON_IDLE_TIMEOUT) -> int:
+    """
+    Run a daemon that keeps this process, and every module the analyses have imported,
+    warm between client requests on the unix socket at socket_path. Requests are handled
+    one at a time, each in the client's working directory. The daemon exits after
+    idle_timeout seconds without a request, when a client asks it to stop, or when a
+    client runs a newer version of the script.
+
+    returns: the number of requests handled
+    raises: ValueError if unix sockets are not available, a daemon is already listening,
+    or socket_path or the per-user socket directory belongs to someone else
+    """
+    import socket
+
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError("Error: the daemon needs unix domain sockets, which this platform doesn't have")
+    if os.path.dirname(socket_path) == user_socket_directory():
+        make_socket_directory(user_socket_directory())
+    if check_socket(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            raise ValueError(f"Error: a daemon is already listening on {socket_path}")
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Left behind by a daemon that didn't shut down cleanly
+            os.remove(socket_path)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the current user may connect, as the daemon reads and writes files for its clients
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    server.settimeout(idle_timeout)
+    version = script_version()
+    num_requests = 0
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+            with conn:
+                if _peer_uid(conn) not in (None, _current_uid()):
+                    continue
+                conn.settimeout(None)
+                request = _receive_message(conn)
+                if request is None:
+                    continue
+                if request.get("stop"):
+                    _send_message(conn, {"stopped": True})
+                    break
+                if request.get("version") != version:
+                    _send_message(conn, {"stale": True})
+                    break
+                code, output = run_request(request["argv"], request["cwd"])
+                num_requests += 1
+                _send_message(conn, {"code": code, "stdout": output})
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+    return num_requests
+
+def _connect(socket_path: str):
+    """
+    Connect to the daemon at socket_path, after checking the socket and (where the platform
+    can tell) the process listening on it belong to the current user
+
+    returns: the connected socket, or None if no daemon is listening
+    raises: ValueError if the socket or the daemon belongs to someone else
+    """
+    import socket
+
+    if not check_socket(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    if _peer_uid(sock) not in (None, _current_uid()):
+        sock.close()
+        raise ValueError(f"Error: the daemon on {socket_path} is run by another user")
+    return sock
+
+def start_daemon(socket_path: str, idle_timeout: float = DAEMON_IDLE_TIMEOUT) -> None:
+    """
+    Start serve(socket_path) in a detached process and wait until it accepts connections
+
+    raises: ValueError if it doesn't start within DAEMON_START_TIMEOUT seconds
+    """
+    import subprocess
+
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", "--socket", socket_path, "--idle-timeout", str(idle_timeout)],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + DAEMON_START_TIMEOUT
+    while time.monotonic() < deadline:
+        sock = _connect(socket_path)
+        if sock is not None:
+            # An empty request is ignored by the daemon
+            sock.close()
+            return
+        time.sleep(0.01)
+    raise ValueError(f"Error: the daemon didn't start listening on {socket_path}")
+
+def run_client(argv: List[str], socket_path: str, start: bool = True) -> int:
+    """
+    Have the daemon at socket_path run argv in the current directory, print its output and
+    return its exit code. If no daemon is running, or it runs an older version of the
+    script, a new one is started first when start is True.
+
+    raises: ValueError if there is no daemon to run argv
+    """
+    for attempt in range(2):
+        sock = _connect(socket_path)
+        if sock is None:
+            if not start:
+                raise ValueError(f"Error: no daemon is listening on {socket_path}")
+            start_daemon(socket_path)
+            sock = _connect(socket_path)
+            if sock is None:
+                raise ValueError(f"Error: couldn't connect to the daemon on {socket_path}")
+        with sock:
+            _send_message(sock, {"argv": argv, "cwd": os.getcwd(), "version": script_version()})
+            reply = _receive_message(sock)
+        if reply is not None and not reply.get("stale"):
+            sys.stdout.write(reply["stdout"])
+            sys.stdout.flush()
+            return reply["code"]
+        # The daemon exited: it was stale, or stopped while handling the request
+        time.sleep(0.05)
+    raise ValueError(f"Error: the daemon on {socket_path} didn't run the request")
+
+def stop_daemon(socket_path: str) -> bool:
+    """
+    Ask the daemon at socket_path to exit
+
+    returns: whether a daemon was running
+    """
+    sock = _connect(socket_path)
+    if sock is None:
+        return False
+    with sock:
+        _send_message(sock, {"stop": True})
+        _receive_message(sock)
+    return True
+
+def parse_daemon_args(args: List) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    Split the daemon options out of args: --daemon and --socket <path> on any command
+    line, and --stop and --idle-timeout <seconds> after serve. Returns the remaining
+    arguments and the daemon options.
+    """
+    options = {"daemon": False, "socket": None, "stop": False, "idle_timeout": DAEMON_IDLE_TIMEOUT}
+    remaining = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "--daemon":
+            options["daemon"] = True
+        elif arg == "--stop" and remaining[1:2] == ["serve"]:
+            options["stop"] = True
+        elif arg in ["--socket", "--idle-timeout"] and (arg == "--socket" or remaining[1:2] == ["serve"]):
+            if i + 1 >= len(args):
+                raise ValueError(f"Error: {arg} requires an additional argument")
+            if arg == "--socket":
+                options["socket"] = args[i+1]
+            else:
+                try:
+                    options["idle_timeout"] = float(args[i+1])
+                except ValueError:
+                    raise ValueError(f"Error: {args[i+1]} is not a number")
+                if options["idle_timeout"] <= 0:
+                    raise ValueError(f"Error: {arg} must be greater than 0")
+            i += 1
+        else:
+            remaining.append(arg)
+        i += 1
+    if options["socket"] is None:
+        options["socket"] = default_socket_path()
+    if options["daemon"] and "--watch" in remaining:
+        raise ValueError("Error: --watch can't be run by the daemon")
+    if options["daemon"] and remaining[1:2] == ["serve"]:
+        raise ValueError("Error: serve can't be combined with --daemon")
+    return remaining, options
+
+def main(argv: List[str]) -> None:
+    """
+    Run the command line with arguments argv (including the script name), exiting with
+    sys.exit when done
+    """
+    # Report components that started or stopped passing the filters between two commits
+    if len(argv) > 1 and argv[1] == "diff":
+        try:
+            base, head, output_file, min_classes, min_occurrences, min_locations, options = parse_diff_args(argv)
+            base = resolve_revision(options["repo"], base)
+            head = resolve_revision(options["repo"], head)
+            conn = open_baseline(options["baseline"], options["tags"], options["extensions"], options["subtrees"])
+            rows = diff_revisions(conn, options["repo"], base, head, min_classes, min_occurrences, min_locations,
+                                  options["tags"], options["extensions"], options["subtrees"])
+            conn.close()
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        write_rows(rows, output_file, DIFF_SUBTREE_HEADERS if options["subtrees"] else DIFF_HEADERS, options["format"])
+        num_new = sum(row[0] == "new" for row in rows)
+        print(f"{num_new} new and {len(rows) - num_new} resolved repeated components between {base[:12]} and {head[:12]}")
+        print(f"Output file created at: {output_file}")
+        sys.exit(0)
+
+    # Combine shard files from earlier runs into the usual csv
+    if len(argv) > 1 and argv[1] == "merge":
+        try:
+            shard_paths, output_file, min_classes, min_occurrences, min_locations, output_format = parse_merge_args(argv)
+            skeletons: Dict[str, str] = {}
+            aggregate, meta = merge_shards(shard_paths, skeletons)
+        except (ValueError, FileNotFoundError) as e:
+            print(e)
+            sys.exit(1)
+        rows = iter_memory_info(aggregate, min_classes, min_occurrences, min_locations)
+        if meta.get("subtrees") == "1":
+            rows = show_skeletons(rows, skeletons)
+        write_rows(rows, output_file, SUBTREE_HEADERS if meta.get("subtrees") == "1" else RESULT_HEADERS, output_format)
+        print(f"Output file created at: {output_file}")
+        sys.exit(0)
 
     #parse command line arguments
     try:
-        analysis_dir, output_file, min_classes, min_occurrences, min_locations, is_short = parse_args(sys.argv)
+        analysis_dir, output_file, min_classes, min_occurrences, min_locations, is_short, options = parse_args(argv)
     except ValueError as e:
         print(e)
         sys.exit(1)
             
+    walk_options = {key: options[key] for key in ["extensions", "excludes", "ignore_files", "follow_symlinks"]}
     try:
-        file_paths = get_filepaths(analysis_dir)
+        file_paths = iter_filepaths(analysis_dir, **walk_options)
     except FileNotFoundError:
         print(f"Error: {analysis_dir} is not a path to a file or directory.")
         sys.exit(1)
 
-    data = []
-    for file_path in file_paths:
+    if options["watch"]:
+        watcher = Watcher(analysis_dir, is_short, options["parser"], options["verify_parser"], options["tags"], options["subtrees"], walk_options)
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                content = f.read()
-        except FileNotFoundError:
-            print(f"Error: the file \'{file_path}\' was not found")
+            watch(watcher, output_file, min_classes, min_occurrences, min_locations, options["similarity"],
+                  options["watch_interval"], options["jobs"], options["io_threads"], options["format"])
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        except (IOError, ValueError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
+    # Collect per-stage timings if any kind of stats output was requested
+    stats = None
+    if options["stats"] or options["stats_json"] is not None or options["profile"] is not None:
+        profiler = None
+        if options["profile"] is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+            if options["jobs"] > 1:
+                print("Note: --profile parses files in this process, ignoring --jobs")
+                options["jobs"] = 1
+        stats = RunStats(profiler)
+        file_paths = stats.timed("walk", file_paths)
+    stage = stats.stage if stats is not None else lambda name: nullcontext()
+
+    # Peek at the first path after wrapping the walk, so the step that finds it is timed too
+    first_path = next(file_paths, None)
+    if first_path is None:
+        print(f"no {'/'.join(options['extensions'])} files to analyze in the given directory.")
+        sys.exit(0)
+    file_paths = chain([first_path], file_paths)
+
+    cache_conn = None
+    if options["cache"] is not None:
+        cache_conn = open_cache(options["cache"], options["parser"], options["tags"], options["subtrees"])
+        results = analyze_files_cached(file_paths, cache_conn, options["parser"], options["verify_parser"], options["jobs"], stats, options["tags"], options["io_threads"], options["subtrees"])
+    else:
+        results = analyze_files(file_paths, options["parser"], options["verify_parser"], options["jobs"], stats, options["tags"], options["io_threads"], options["subtrees"])
+
+    # Set up the aggregation backend; --top-k replaces it with an approximate sketch
+    backend = "topk" if options["top_k"] is not None else options["backend"]
+    # Errors of the database behind the sqlite backend, e.g. an unwritable or locked file.
+    # sqlite3 is only imported when that backend is used.
+    backend_errors: Tuple[type, ...] = ()
+    if backend == "sqlite":
+        import sqlite3
+        backend_errors = (sqlite3.Error,)
+    analyzer = None
+    if backend == "topk":
+        sketch = TopKSketch(options["top_k"], min_classes)
+        add_entries = sketch.add_batch
+    else:
+        try:
+            analyzer = Analyzer(backend, options["database"], options["parser"], options["verify_parser"], options["tags"], options["subtrees"], is_short)
+        except backend_errors as e:
+            print(f"Error: couldn't open the database \'{options['database']}\': {e}")
+            sys.exit(1)
+        add_entries = analyzer.add_entries
+
+    def add_batch(batch: List[TagEntry]) -> None:
+        with stage("ingest"):
+            add_entries(batch)
+        if stats is not None:
+            stats.count("tags", len(batch))
+
+    try:
+        # Stream entries from the files into the backend
+        try:
+            num_files = load_entries(results, add_batch, is_short)
+        except FileNotFoundError as e:
+            print(f"Error: the file \'{e.filename}\' was not found")
             sys.exit(1)
         except IOError as e:
             print(f"Error reading file: {e}")
             sys.exit(1)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        except backend_errors as e:
+            print(f"Error: couldn't load the database \'{options['database']}\': {e}")
+            sys.exit(1)
         except Exception as e:
             print(f"Unexpected error: {e}")
             sys.exit(1)
-        if is_short:
-            data += parse_html(content, os.path.basename(file_path))
+
+        if cache_conn is not None:
+            cache_conn.close()
+
+        if analyzer is not None:
+            try:
+                with stage("index"):
+                    analyzer.flush()
+            except backend_errors as e:
+                print(f"Error: couldn't load the database \'{options['database']}\': {e}")
+                sys.exit(1)
+
+        if options["shard"] is not None:
+            # Write every component unfiltered, to be filtered once shards are merged
+            with stage("write"):
+                num_rows = write_shard(analyzer.components(), options["shard"], options["tags"], options["subtrees"], analyzer.skeletons)
+            print(f"Shard file created at: {options['shard']}")
         else:
-            data += parse_html(content, file_path)
+            # analyze aggregated data and write to csv. Similarity clusters are filtered on
+            # their total instances and locations, so every component is queried for them.
+            headers = SUBTREE_HEADERS if options["subtrees"] else RESULT_HEADERS
+            min_component_instances, min_component_locations = min_occurrences, min_locations
+            if options["similarity"] is not None:
+                headers = CLUSTER_HEADERS
+                min_component_instances, min_component_locations = 1, 1
+            elif backend == "topk":
+                headers = TOPK_SUBTREE_HEADERS if options["subtrees"] else TOPK_HEADERS
+            # Rows stream from the query to the output file; the write stage includes
+            # fetching all but the first of them
+            with stage("query"):
+                if backend == "topk":
+                    rows = sketch.rows(min_occurrences, min_locations)
+                else:
+                    rows = analyzer.iter_results(min_classes, min_component_instances, min_component_locations)
+            if options["similarity"] is not None:
+                with stage("cluster"):
+                    rows = cluster_similar(list(rows), options["similarity"], min_occurrences, min_locations)
+            with stage("write"):
+                num_rows = write_rows(rows, output_file, headers, options["format"])
+            print(f"Output file created at: {output_file}")
 
-    # Set up sqlite3 db and add data
-    conn = sqlite3.connect("database.db")
-    parse_data(data, conn)
+        if stats is not None:
+            stats.count("files", num_files)
+            stats.count("components", len(sketch.counters) if backend == "topk" else analyzer.num_components())
+            stats.count("output_rows", num_rows)
+            if options["stats"]:
+                print(stats.summary())
+            if options["stats_json"] is not None:
+                with open(options["stats_json"], "w", encoding="utf-8") as f:
+                    json.dump(stats.to_dict(), f, indent=2)
+                print(f"Stats written to: {options['stats_json']}")
+            if options["profile"] is not None:
+                stats.profiler.dump_stats(options["profile"])
+                print(f"Parse profile written to: {options['profile']}")
+    finally:
+        # Clean up
+        if analyzer is not None:
+            analyzer.close()
 
-    # analyze data in db and write to csv 
-    analyze_db_info(conn, output_file, min_classes, min_occurrences, min_locations)
-    print(f"Output file created at: {output_file}")
 
-    # Clean up
-    conn.cursor().execute("DROP TABLE tag_data")
-    conn.close()
-    os.remove("database.db")
\ No newline at end of file
+if __name__ == "__main__":
+
+    # Hand the command line to a warm daemon process, or run one
+    if "--daemon" in sys.argv or (len(sys.argv) > 1 and sys.argv[1] == "serve"):
+        try:
+            argv, daemon_options = parse_daemon_args(sys.argv)
+            if len(argv) > 1 and argv[1] == "serve":
+                if daemon_options["stop"]:
+                    print("Daemon stopped" if stop_daemon(daemon_options["socket"]) else "No daemon is running")
+                    sys.exit(0)
+                if len(argv) > 2:
+                    raise ValueError(f"Error: {argv[2]} is not a recognized option")
+                serve(daemon_options["socket"], daemon_options["idle_timeout"])
+                sys.exit(0)
+            sys.exit(run_client(argv, daemon_options["socket"]))
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+    main(sys.argv)
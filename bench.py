@@ -0,0 +1,303 @@
+import sys
+import os
+import json
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from typing import List, Dict, Any, Callable, Tuple
+from analyze import get_filepaths, read_file, parse_html, parse_data, analyze_db_info, aggregate_data, analyze_memory_info
+from analyze import begin_bulk_load, finish_bulk_load, peak_rss, PARSERS, BACKENDS, DEFAULT_PARSER, BATCH_SIZE
+
+# Defaults for the synthetic corpus and the benchmark run
+DEFAULT_BENCH_OPTIONS: Dict[str, Any] = {
+    "files": 200,
+    "divs": 200,
+    "depth": 4,
+    "class_sets": 500,
+    "duplication": 0.8,
+    "seed": 0,
+    "parser": DEFAULT_PARSER,
+    "backend": "sqlite",
+    "database": None,
+    "repeat": 1,
+    "trace_memory": False,
+    "output": None,
+    "corpus": None,
+    "startup": False,
+    "startup_budget": None,
+}
+
+# Number of generated files per subdirectory of the corpus
+FILES_PER_DIR = 100
+
+# Target for how long a single-file run of analyze.py may take on top of starting the
+# interpreter, e.g. once per changed file in a pre-commit hook
+STARTUP_BUDGET_SECONDS = 0.15
+ANALYZE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "analyze.py")
+
+def generate_corpus(root: str, files=200, divs=200, depth=4, class_sets=500, duplication=0.8, seed=0) -> Dict[str, int]:
+    """
+    Write a reproducible synthetic template corpus to the directory root.
+
+    Each of the files .html files holds divs class-bearing divs, nested up to depth levels.
+    With probability duplication a div reuses one of class_sets shared class sets, otherwise
+    it gets a class set of its own. The same arguments always produce the same corpus.
+
+    returns: the number of files, bytes and class-bearing divs written
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"{prefix}-{value}" for prefix in ["p", "m", "w", "h", "text", "bg", "flex", "grid", "gap"] for value in range(40)]
+    shared = [" ".join(rng.sample(vocabulary, rng.randint(1, 8))) for _ in range(class_sets)]
+
+    num_bytes = 0
+    num_tags = 0
+    for i in range(files):
+        directory = os.path.join(root, f"dir_{i // FILES_PER_DIR}")
+        os.makedirs(directory, exist_ok=True)
+
+        parts = ["<!DOCTYPE html>\n<html>\n<body>\n"]
+        open_divs = 0
+        for _ in range(divs):
+            while open_divs and (open_divs >= depth or rng.random() < 0.5):
+                parts.append("</div>\n")
+                open_divs -= 1
+            if shared and rng.random() < duplication:
+                classes = rng.choice(shared)
+            else:
+                classes = " ".join(rng.sample(vocabulary, rng.randint(1, 8)))
+            parts.append(f"<div class=\"{classes}\">\n<p>Lorem ipsum {rng.randint(0, 1000)}</p>\n")
+            open_divs += 1
+        parts.append("</div>\n" * open_divs)
+        parts.append("</body>\n</html>\n")
+
+        content = "".join(parts)
+        with open(os.path.join(directory, f"template_{i}.html"), "w", encoding="utf-8") as f:
+            f.write(content)
+        num_bytes += len(content.encode("utf-8"))
+        num_tags += divs
+
+    return {"files": files, "bytes": num_bytes, "tags": num_tags}
+
+def time_stage(function: Callable[[], Any], trace_memory=False) -> Tuple[Any, Dict[str, float]]:
+    """
+    Call function, returning its result and the wall time, cpu time and (if trace_memory)
+    peak traced Python memory of the call.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    result = function()
+    timing = {
+        "seconds": time.perf_counter() - wall_start,
+        "cpu_seconds": time.process_time() - cpu_start,
+    }
+    if trace_memory:
+        timing["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, timing
+
+def run_benchmark(corpus: str, parser=DEFAULT_PARSER, backend="sqlite", repeat=1, trace_memory=False, database=None) -> Dict[str, Any]:
+    """
+    Time each stage of an analysis of the directory corpus separately: get_filepaths,
+    parse_html (including reading files), parse_data and analyze_db_info, or their
+    in-memory counterparts for the memory backend. Each stage is run repeat times and
+    the fastest run is reported, with files/s and tags/s throughput.
+
+    The sqlite backend loads data in batches with the same bulk load as analyze.py, into
+    database (a temporary file by default, or e.g. ":memory:").
+    """
+    work_dir = tempfile.mkdtemp()
+    stages: Dict[str, Dict[str, float]] = {}
+
+    def record(stage: str, timing: Dict[str, float]) -> None:
+        if stage not in stages or timing["seconds"] < stages[stage]["seconds"]:
+            stages[stage] = timing
+
+    try:
+        for _ in range(repeat):
+            file_paths, timing = time_stage(lambda: get_filepaths(corpus), trace_memory)
+            record("get_filepaths", timing)
+
+            def parse_all() -> List:
+                data = []
+                for file_path in file_paths:
+                    data += parse_html(read_file(file_path), file_path, parser)
+                return data
+            data, timing = time_stage(parse_all, trace_memory)
+            record("parse_html", timing)
+
+            csv_path = os.path.join(work_dir, "template_analysis.csv")
+            if backend == "memory":
+                aggregate = {}
+                _, timing = time_stage(lambda: aggregate_data(data, aggregate), trace_memory)
+                record("parse_data", timing)
+                _, timing = time_stage(lambda: analyze_memory_info(aggregate, csv_path), trace_memory)
+                record("analyze_db_info", timing)
+            else:
+                conn = sqlite3.connect(database or os.path.join(work_dir, "database.db"))
+
+                def bulk_load() -> None:
+                    bulk_ids = begin_bulk_load(conn)
+                    for i in range(0, len(data), BATCH_SIZE):
+                        parse_data(data[i:i + BATCH_SIZE], conn, bulk_ids)
+                    finish_bulk_load(conn)
+                _, timing = time_stage(bulk_load, trace_memory)
+                record("parse_data", timing)
+                _, timing = time_stage(lambda: analyze_db_info(conn, csv_path), trace_memory)
+                record("analyze_db_info", timing)
+                conn.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    num_files = len(file_paths)
+    num_tags = len(data)
+    for timing in stages.values():
+        seconds = timing["seconds"] or float("inf")
+        timing["files_per_second"] = num_files / seconds
+        timing["tags_per_second"] = num_tags / seconds
+
+    report = {
+        "parser": parser,
+        "backend": backend,
+        "files": num_files,
+        "tags": num_tags,
+        "stages": stages,
+        "total_seconds": sum(timing["seconds"] for timing in stages.values()),
+    }
+    peak_rss_bytes = peak_rss()
+    if peak_rss_bytes is not None:
+        report["peak_rss_bytes"] = peak_rss_bytes
+    return report
+
+def run_startup_benchmark(file_path: str, repeat=5, budget=STARTUP_BUDGET_SECONDS) -> Dict[str, Any]:
+    """
+    Time a fresh interpreter running analyze.py on the single file file_path, and one that
+    does nothing, repeat times each, and compare the fastest difference (the startup and
+    run cost of the script itself) with budget seconds.
+    """
+    work_dir = tempfile.mkdtemp()
+
+    def fastest(command: List[str]) -> float:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(command, check=True, capture_output=True, cwd=work_dir)
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    try:
+        interpreter_seconds = fastest([sys.executable, "-c", "pass"])
+        seconds = fastest([sys.executable, ANALYZE_SCRIPT, os.path.abspath(file_path), "-o", "template_analysis.csv"])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    overhead = max(seconds - interpreter_seconds, 0.0)
+    return {
+        "interpreter_seconds": interpreter_seconds,
+        "seconds": seconds,
+        "overhead_seconds": overhead,
+        "budget_seconds": budget,
+        "within_budget": overhead <= budget,
+    }
+
+def parse_bench_args(args: List) -> Dict[str, Any]:
+    options = dict(DEFAULT_BENCH_OPTIONS)
+    int_options = {"--files": "files", "--divs": "divs", "--depth": "depth", "--class-sets": "class_sets", "--seed": "seed", "--repeat": "repeat"}
+
+    i = 1
+    while i < len(args):
+        arg = args[i]
+        if arg == "--trace-memory":
+            options["trace_memory"] = True
+        elif arg == "--startup":
+            options["startup"] = True
+        elif arg.startswith("-") and i + 1 >= len(args):
+            raise ValueError(f"Error: {arg} requires an additional argument")
+        elif arg in int_options:
+            try:
+                options[int_options[arg]] = int(args[i+1])
+            except ValueError:
+                raise ValueError(f"Error: {args[i+1]} is not an integer")
+            i += 1
+        elif arg == "--startup-budget":
+            try:
+                options["startup_budget"] = float(args[i+1])
+            except ValueError:
+                raise ValueError(f"Error: {args[i+1]} is not a number")
+            i += 1
+        elif arg == "--duplication":
+            try:
+                options["duplication"] = float(args[i+1])
+            except ValueError:
+                raise ValueError(f"Error: {args[i+1]} is not a number")
+            i += 1
+        elif arg in ["-p", "--parser"]:
+            if args[i+1] not in PARSERS:
+                raise ValueError(f"Error: {args[i+1]} is not a recognized parser")
+            options["parser"] = args[i+1]
+            i += 1
+        elif arg in ["-b", "--backend"]:
+            if args[i+1] not in BACKENDS:
+                raise ValueError(f"Error: {args[i+1]} is not a recognized backend")
+            options["backend"] = args[i+1]
+            i += 1
+        elif arg in ["-d", "--database"]:
+            options["database"] = args[i+1]
+            i += 1
+        elif arg in ["-o", "--output"]:
+            options["output"] = args[i+1]
+            i += 1
+        elif arg == "--corpus":
+            options["corpus"] = args[i+1]
+            i += 1
+        else:
+            raise ValueError(f"Error: {arg} is not a recognized option")
+        i += 1
+
+    return options
+
+
+if __name__ == "__main__":
+
+    try:
+        options = parse_bench_args(sys.argv)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    # Generate into --corpus (kept afterwards) or a temporary directory. The startup
+    # benchmark analyzes a single generated file.
+    corpus = options["corpus"] or tempfile.mkdtemp()
+    num_files = 1 if options["startup"] else options["files"]
+    try:
+        corpus_info = generate_corpus(corpus, num_files, options["divs"], options["depth"],
+                                      options["class_sets"], options["duplication"], options["seed"])
+        if options["startup"]:
+            file_path = os.path.join(corpus, "dir_0", "template_0.html")
+            budget = STARTUP_BUDGET_SECONDS if options["startup_budget"] is None else options["startup_budget"]
+            report = run_startup_benchmark(file_path, max(options["repeat"], 5), budget)
+        else:
+            report = run_benchmark(corpus, options["parser"], options["backend"], options["repeat"], options["trace_memory"], options["database"])
+    finally:
+        if options["corpus"] is None:
+            shutil.rmtree(corpus, ignore_errors=True)
+
+    report["corpus"] = {key: options[key] for key in ["files", "divs", "depth", "class_sets", "duplication", "seed"]}
+    report["corpus"]["files"] = num_files
+    report["corpus"]["bytes"] = corpus_info["bytes"]
+
+    output = json.dumps(report, indent=2)
+    if options["output"] is None:
+        print(output)
+    else:
+        with open(options["output"], "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        print(f"Benchmark results written to: {options['output']}")
+    if options["startup"] and not report["within_budget"]:
+        print(f"Startup overhead of {report['overhead_seconds']:.3f}s is over the budget of {report['budget_seconds']:.3f}s")
+        sys.exit(1)
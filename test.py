@@ -2,8 +2,28 @@ import pytest
 import sqlite3
 import csv
 import os
+import subprocess
+import sys
+import tracemalloc
+import json
+import random
+import inspect
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 from pytest import raises
-from analyze import parse_args, get_filepaths, parse_html, parse_data, analyze_db_info
+from analyze import parse_args, get_filepaths, parse_html, parse_data, analyze_db_info, DEFAULT_OPTIONS, analyze_files
+from analyze import aggregate_data, analyze_memory_info, BACKENDS, open_cache, analyze_files_cached
+from analyze import iter_filepaths, load_entries, RunStats, begin_bulk_load, finish_bulk_load, query_db_info
+from analyze import read_file, read_file_raw, cluster_similar, lsh_params, extract_subtrees, split_skeletons
+from analyze import parse_merge_args, write_shard, merge_shards, iter_db_components, iter_memory_components, query_memory_info
+from analyze import Watcher, watch, TopKSketch, hll_position, hll_estimate, analyze_file, may_have_entries
+from analyze import iter_db_info, iter_memory_info, write_rows, read_columnar, OUTPUT_FORMATS
+from analyze import Analyzer, run_request, parse_daemon_args
+from analyze import open_baseline, baseline_revision, update_baseline, diff_revisions, resolve_revision, parse_diff_args
+from bench import generate_corpus, run_benchmark, run_startup_benchmark
+import analyze
 
 #  ------------ Tests for parse_args -------------
 def test_parse_args_works_for_minimal_args() -> None:
@@ -14,8 +34,9 @@ def test_parse_args_works_for_minimal_args() -> None:
     expected_occurrences = 2
     expected_locations = 1
     expected_is_short = False
+    expected_options = DEFAULT_OPTIONS
     
-    assert [expected_analysis, expected_output, expected_classes, expected_occurrences, expected_locations, expected_is_short] == parse_args(args)
+    assert [expected_analysis, expected_output, expected_classes, expected_occurrences, expected_locations, expected_is_short, expected_options] == parse_args(args)
 
 def test_parse_args_works_for_all_args() -> None:
     args = ["analyze.py", "directory/templates", "-o", "output.csv", "-mo", "18", "-mc", "0", "-s", "-ml", "4"]
@@ -25,8 +46,9 @@ def test_parse_args_works_for_all_args() -> None:
     expected_occurrences = 18
     expected_locations = 4
     expected_is_short = True
+    expected_options = DEFAULT_OPTIONS
     
-    assert [expected_analysis, expected_output, expected_classes, expected_occurrences, expected_locations, expected_is_short] == parse_args(args)
+    assert [expected_analysis, expected_output, expected_classes, expected_occurrences, expected_locations, expected_is_short, expected_options] == parse_args(args)
 
 def test_parse_args_works_for_verbose_options() -> None:
     args = ["analyze.py", "directory/templates/template.html", "--output", "output.csv", "--min-occurrences", "18", "--min-classes", "0", "--short", "--min-locations", "3"]
@@ -36,10 +58,109 @@ def test_parse_args_works_for_verbose_options() -> None:
     expected_occurrences = 18
     expected_locations = 3
     expected_is_short = True
+    expected_options = DEFAULT_OPTIONS
     
-    assert [expected_analysis, expected_output, expected_classes, expected_occurrences, expected_locations, expected_is_short] == parse_args(args)
+    assert [expected_analysis, expected_output, expected_classes, expected_occurrences, expected_locations, expected_is_short, expected_options] == parse_args(args)
 
 
+def test_parse_args_works_for_parser_options() -> None:
+    args = ["analyze.py", "templates", "--parser", "bs4", "--verify-parser"]
+    options = parse_args(args)[6]
+    assert options["parser"] == "bs4"
+    assert options["verify_parser"] == True
+
+def test_parse_args_rejects_unknown_parser() -> None:
+    with raises(ValueError):
+        parse_args(["analyze.py", "templates", "--parser", "lxml"])
+
+def test_parse_args_works_for_jobs() -> None:
+    assert parse_args(["analyze.py", "templates", "-j", "4"])[6]["jobs"] == 4
+    assert parse_args(["analyze.py", "templates", "--jobs", "0"])[6]["jobs"] >= 1
+    with raises(ValueError):
+        parse_args(["analyze.py", "templates", "--jobs", "-2"])
+
+def test_parse_args_works_for_similarity() -> None:
+    assert parse_args(["analyze.py", "templates", "--similarity", "0.8"])[6]["similarity"] == 0.8
+    for value in ["0", "1.5", "high"]:
+        with raises(ValueError):
+            parse_args(["analyze.py", "templates", "--similarity", value])
+
+def test_parse_args_works_for_subtrees() -> None:
+    assert parse_args(["analyze.py", "templates", "--subtrees"])[6]["subtrees"]
+    for extra in [["-p", "bs4"], ["--verify-parser"], ["--similarity", "0.8"]]:
+        with raises(ValueError):
+            parse_args(["analyze.py", "templates", "--subtrees", *extra])
+
+def test_parse_args_works_for_shard() -> None:
+    assert parse_args(["analyze.py", "templates", "--shard", "part.shard"])[6]["shard"] == "part.shard"
+    with raises(ValueError):
+        parse_args(["analyze.py", "templates", "--shard", "part.shard", "--similarity", "0.8"])
+
+def test_parse_merge_args_works() -> None:
+    assert parse_merge_args(["analyze.py", "merge", "a.shard", "b.shard", "-o", "out.csv", "-mc", "2", "-mo", "3", "-ml", "4"]) == [["a.shard", "b.shard"], "out.csv", 2, 3, 4, "csv"]
+    assert parse_merge_args(["analyze.py", "merge", "a.shard"]) == [["a.shard"], "template_analysis.csv", 1, 2, 1, "csv"]
+    assert parse_merge_args(["analyze.py", "merge", "a.shard", "-f", "jsonl"]) == [["a.shard"], "template_analysis.jsonl", 1, 2, 1, "jsonl"]
+    for args in [["analyze.py", "merge"], ["analyze.py", "merge", "-o", "out.csv"], ["analyze.py", "merge", "a.shard", "-mo", "x"], ["analyze.py", "merge", "a.shard", "-x"]]:
+        with raises(ValueError):
+            parse_merge_args(args)
+
+def test_parse_args_works_for_watch() -> None:
+    options = parse_args(["analyze.py", "templates", "--watch", "--watch-interval", "0.5"])[6]
+    assert options["watch"] and options["watch_interval"] == 0.5
+    for extra in [["--watch-interval", "0"], ["--watch", "--cache", "cache.db"], ["--watch", "--shard", "part.shard"]]:
+        with raises(ValueError):
+            parse_args(["analyze.py", "templates", *extra])
+
+def test_parse_args_works_for_top_k() -> None:
+    assert parse_args(["analyze.py", "templates", "--top-k", "100"])[6]["top_k"] == 100
+    for extra in [["--top-k", "0"], ["--top-k", "10", "--shard", "part.shard"], ["--top-k", "10", "--similarity", "0.8"],
+                  ["--top-k", "10", "-b", "sqlite"], ["-d", "a.db", "--top-k", "10"]]:
+        with raises(ValueError):
+            parse_args(["analyze.py", "templates", *extra])
+
+def test_parse_args_works_for_format() -> None:
+    assert parse_args(["analyze.py", "templates", "-f", "jsonl"])[1] == "template_analysis.jsonl"
+    assert parse_args(["analyze.py", "templates", "--format", "columnar", "-o", "out.bin"])[1:7:5] == ["out.bin", {**DEFAULT_OPTIONS, "format": "columnar"}]
+    with raises(ValueError):
+        parse_args(["analyze.py", "templates", "--format", "xml"])
+
+def test_parse_args_works_for_walk_options() -> None:
+    options = parse_args(["analyze.py", "templates", "-e", "html,.jinja", "-x", "node_modules/", "--exclude", "*.min.html", "--no-ignore", "--follow-symlinks"])[6]
+    assert options == {**DEFAULT_OPTIONS, "extensions": (".html", ".jinja"), "excludes": ("node_modules/", "*.min.html"), "ignore_files": False, "follow_symlinks": True}
+    with raises(ValueError):
+        parse_args(["analyze.py", "templates", "--extensions", ","])
+
+def test_parse_args_works_for_io_threads() -> None:
+    assert parse_args(["analyze.py", "templates", "--io-threads", "8"])[6]["io_threads"] == 8
+    with raises(ValueError):
+        parse_args(["analyze.py", "templates", "--io-threads", "0"])
+
+def test_parse_args_works_for_backend() -> None:
+    assert parse_args(["analyze.py", "templates", "--backend", "memory"])[6]["backend"] == "memory"
+    with raises(ValueError):
+        parse_args(["analyze.py", "templates", "-b", "postgres"])
+
+def test_parse_args_works_for_stats_options() -> None:
+    options = parse_args(["analyze.py", "templates", "--stats", "--stats-json", "stats.json", "--profile", "parse.prof"])[6]
+    assert options["stats"] == True
+    assert options["stats_json"] == "stats.json"
+    assert options["profile"] == "parse.prof"
+
+def test_parse_args_works_for_tags() -> None:
+    assert parse_args(["analyze.py", "templates"])[6]["tags"] == ("div",)
+    assert parse_args(["analyze.py", "templates", "--tags", "div, SPAN,a"])[6]["tags"] == ("div", "span", "a")
+    assert parse_args(["analyze.py", "templates", "-t", "*"])[6]["tags"] == ("*",)
+    with raises(ValueError):
+        parse_args(["analyze.py", "templates", "--tags", ","])
+
+def test_parse_args_works_for_database() -> None:
+    assert parse_args(["analyze.py", "templates"])[6]["database"] == "database.db"
+    assert parse_args(["analyze.py", "templates", "--database", ":memory:"])[6]["database"] == ":memory:"
+
+def test_parse_args_works_for_cache() -> None:
+    assert parse_args(["analyze.py", "templates"])[6]["cache"] is None
+    assert parse_args(["analyze.py", "templates", "--cache", ".analysis-cache.db"])[6]["cache"] == ".analysis-cache.db"
+
 
 #  ------------ Tests for get_filepaths -------------
 def test_get_filepaths_works_for_dir() -> None:
@@ -63,6 +184,81 @@ def test_get_filepaths_raises_error_for_invalid_path() -> None:
     with raises(FileNotFoundError):
         get_filepaths("additional_files")
 
+def test_iter_filepaths_is_lazy_and_matches_get_filepaths() -> None:
+    paths = iter_filepaths("test_data")
+    assert next(paths) in get_filepaths("test_data")
+    assert sorted(iter_filepaths("test_data")) == sorted(get_filepaths("test_data"))
+
+def test_iter_filepaths_raises_error_for_invalid_path_before_iterating() -> None:
+    with raises(FileNotFoundError):
+        iter_filepaths("additional_files")
+
+def test_iter_filepaths_walks_like_os_walk() -> None:
+    expected = [os.path.join(dirpath, filename) for dirpath, _, filenames in os.walk("test_data") for filename in filenames if filename.endswith(".html")]
+    assert list(iter_filepaths("test_data")) == expected
+
+def make_tree(root, files) -> None:
+    for file_path, content in files.items():
+        path = root / file_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content, encoding="utf-8")
+
+def relative_paths(root, paths) -> List[str]:
+    return sorted(os.path.relpath(path, root).replace(os.sep, "/") for path in paths)
+
+def test_iter_filepaths_honors_ignore_files(tmp_path) -> None:
+    make_tree(tmp_path, {
+        ".gitignore": "# build output\nnode_modules/\n/build\n*.min.html\n!keep.min.html\ndocs/**/draft_*.html\n",
+        "index.html": "",
+        "app.min.html": "",
+        "keep.min.html": "",
+        "node_modules/pkg/readme.html": "",
+        "build/out.html": "",
+        "src/build/page.html": "",
+        "docs/a/b/draft_1.html": "",
+        "docs/a/final.html": "",
+        "src/.gitignore": "/local.html\nfixtures\n",
+        "src/local.html": "",
+        "src/deep/local.html": "",
+        "src/deep/fixtures/x.html": "",
+        ".git/description.html": "",
+    })
+    assert relative_paths(tmp_path, iter_filepaths(str(tmp_path))) == [
+        "docs/a/final.html", "index.html", "keep.min.html", "src/build/page.html", "src/deep/local.html",
+    ]
+    assert len(list(iter_filepaths(str(tmp_path), ignore_files=False))) == 12
+
+def test_iter_filepaths_works_for_excludes_and_extensions(tmp_path) -> None:
+    make_tree(tmp_path, {
+        "a.html": "",
+        "b.jinja": "",
+        "c.vue": "",
+        "d.txt": "",
+        "vendor/e.html": "",
+        "src/vendor/f.njk": "",
+        "src/g.njk": "",
+    })
+    paths = iter_filepaths(str(tmp_path), extensions=(".html", ".jinja", ".njk", ".vue"), excludes=("/vendor", "*.vue"))
+    assert relative_paths(tmp_path, paths) == ["a.html", "b.jinja", "src/g.njk", "src/vendor/f.njk"]
+    paths = iter_filepaths(str(tmp_path), extensions=(".njk",), excludes=("vendor/",))
+    assert relative_paths(tmp_path, paths) == ["src/g.njk"]
+    # A leading "./" stands for the analyzed directory
+    paths = iter_filepaths(str(tmp_path), extensions=(".html", ".njk"), excludes=("./vendor", ".//src/vendor/"))
+    assert relative_paths(tmp_path, paths) == ["a.html", "src/g.njk"]
+    assert [analyze.normalize_exclude(pattern) for pattern in ["./dist", "!./a/b.html", "dist", "*.min.html"]] == ["/dist", "!/a/b.html", "dist", "*.min.html"]
+
+@pytest.mark.skipif(not hasattr(os, "symlink"), reason="needs symlinks")
+def test_iter_filepaths_follows_symlinks_without_looping(tmp_path) -> None:
+    make_tree(tmp_path, {"site/a.html": "", "shared/b.html": ""})
+    try:
+        os.symlink(tmp_path / "site", tmp_path / "site" / "loop", target_is_directory=True)
+        os.symlink(tmp_path / "shared", tmp_path / "site" / "shared", target_is_directory=True)
+    except OSError:
+        pytest.skip("can't create symlinks")
+    root = tmp_path / "site"
+    assert relative_paths(root, iter_filepaths(str(root))) == ["a.html"]
+    assert relative_paths(root, iter_filepaths(str(root), follow_symlinks=True)) == ["a.html", "shared/b.html"]
+
 #  ------------ Tests for parse_html -------------
 
 def test_parse_html_has_correct_format() -> None:
@@ -112,6 +308,452 @@ def test_parse_html_works_with_duplicate_classes() -> None:
     expected_inner = ("div", "md:text-lg sm:text-sm", 2, "folder/file.html")
     assert expected_inner in data
 
+def test_parse_html_stream_matches_bs4_on_edge_cases() -> None:
+    html_str = \
+    "<DIV CLASS='Upper lower'></DIV>" \
+    "<div class=''></div><div class></div><div></div>" \
+    "<div class='a' class='b'></div>" \
+    "<div class='x&amp;y  z\t\nq'/>" \
+    "<!-- <div class='commented'></div> -->" \
+    "<script><div class='in-script'></div></script>" \
+    "<span class='not-a-div'></span>" \
+    "<div class='unclosed'"
+    stream_data = parse_html(html_str, "folder/file.html", "stream")
+    bs4_data = parse_html(html_str, "folder/file.html", "bs4")
+    assert stream_data == bs4_data
+    assert ("div", "", 0, "folder/file.html") in stream_data
+
+def test_parse_html_stream_matches_bs4_on_test_data() -> None:
+    for file_path in ["test_data/ex_file_1.html", "test_data/ex_file_2.html",
+                      "test_data/additional_files/nested_1.html", "test_data/additional_files/nested_2.html"]:
+        with open(file_path, "r", encoding="utf-8") as f:
+            content = f.read()
+        assert parse_html(content, file_path, "stream", verify=True) == parse_html(content, file_path, "bs4")
+
+@pytest.mark.parametrize("parser", ["stream", "bs4"])
+def test_parse_html_collects_requested_tags_in_one_pass(parser: str) -> None:
+    html_str = \
+    "<section class='page'>" \
+        "<div class='card'><span class='label bold'>A</span><a class='link' href='#'>B</a></div>" \
+        "<p class='text'></p>" \
+    "</section>"
+    data = parse_html(html_str, "file.html", parser, tags=("span", "a", "div"))
+    assert data == [
+        ("div", "card", 1, "file.html"),
+        ("span", "bold label", 2, "file.html"),
+        ("a", "link", 1, "file.html"),
+    ]
+
+@pytest.mark.parametrize("parser", ["stream", "bs4"])
+def test_parse_html_collects_all_tags_for_star(parser: str) -> None:
+    html_str = "<section class='page'><div class='card'><p class='text'></p><br></div></section>"
+    data = parse_html(html_str, "file.html", parser, tags=("*",))
+    assert [entry[0] for entry in data] == ["section", "div", "p"]
+
+def test_parse_html_stream_matches_bs4_for_all_tags_on_test_data() -> None:
+    for file_path in get_filepaths("test_data"):
+        with open(file_path, "r", encoding="utf-8") as f:
+            content = f.read()
+        assert parse_html(content, file_path, "stream", verify=True, tags=("*",)) == parse_html(content, file_path, "bs4", tags=("*",))
+
+
+#  ------------ Tests for extract_subtrees -------------
+def test_extract_subtrees_gives_identical_subtrees_the_same_digest() -> None:
+    html_str = """
+        <div class='card shadow'><div class='card-header'>Title</div><div class='card-body'><p>One</p></div></div>
+        <div class='shadow card' id='x'><div class='card-header'>Other</div><div class='card-body'><p>Two<br></p></div></div>
+        <div class='card shadow'><div class='card-header'></div><div class='card-body'><p>Three</p></div></div>
+    """
+    entries = extract_subtrees(html_str)
+    skeletons = {}
+    split = split_skeletons(entries, skeletons)
+    assert [(name, num_classes) for name, _, num_classes in split] == [("div", 1), ("div", 2)] * 3
+    keys = [key for _, key, _ in split]
+    assert all(len(key) == 2 * analyze.SUBTREE_DIGEST_SIZE for key in keys)
+    assert keys[0] == keys[4] and keys[1] == keys[5]
+    assert len(set(keys)) == 4
+    # Only the first entry of each subtree carries its skeleton
+    assert [analyze.SKELETON_SEPARATOR in key for _, key, _ in entries] == [True, True, True, True, False, False]
+    card = '<div class="card shadow"><div class="card-header"></div><div class="card-body"><p></p></div></div>'
+    assert [skeletons[key] for key in keys] == [
+        '<div class="card-body"><p></p></div>',
+        card,
+        '<div class="card-body"><p><br></p></div>',
+        '<div class="card shadow"><div class="card-header"></div><div class="card-body"><p><br></p></div></div>',
+        '<div class="card-body"><p></p></div>',
+        card,
+    ]
+
+def test_extract_subtrees_handles_void_and_unclosed_elements() -> None:
+    html_str = "<section class='a'><div><img src='x'><input/></span><ul><li>one<li>two</ul></section>"
+    skeletons = {}
+    split = split_skeletons(extract_subtrees(html_str, ("*",)), skeletons)
+    assert [(name, skeletons[key], num_classes) for name, key, num_classes in split] == [
+        ("li", "<li><li></li></li>", 0),
+        ("ul", "<ul><li><li></li></li></ul>", 0),
+        ("div", "<div><img><input><ul><li><li></li></li></ul></div>", 0),
+        ("section", '<section class="a"><div><img><input><ul><li><li></li></li></ul></div></section>', 1),
+    ]
+
+def test_extract_subtrees_keys_stay_small_for_deep_and_wide_subtrees() -> None:
+    depth = 3000
+    deep = "<div class='wrap'>" * depth + "<p></p>" + "</div>" * depth
+    wide = "<section>" + "<div class='card'><p></p></div>" * depth + "</section>"
+    max_key_length = 2 * analyze.SUBTREE_DIGEST_SIZE + len(analyze.SKELETON_SEPARATOR) + analyze.MAX_SKELETON_LENGTH + len("...")
+    for html_str in (deep, wide):
+        entries = extract_subtrees(html_str, ("*",))
+        assert max(len(key) for _, key, _ in entries) <= max_key_length
+    skeletons = {}
+    split = split_skeletons(extract_subtrees(wide, ("*",)), skeletons)
+    assert len(split) == depth + 1 and len(skeletons) == 2
+    assert skeletons[split[-1][1]].startswith('<section><div class="card"><p></p></div>')
+    assert skeletons[split[-1][1]].endswith("...")
+
+def test_main_subtrees_counts_repeated_subtrees(tmp_path) -> None:
+    card = "<div class='card'><div class='card-header'>{0}</div><div class='card-body'>{0}</div></div>"
+    (tmp_path / "a.html").write_text(card.format("a") * 2 + "<div class='card'><div class='card-header'></div></div>", encoding="utf-8")
+    (tmp_path / "b.html").write_text(card.format("b"), encoding="utf-8")
+    outputs = []
+    for extra in [[], ["-j", "2"], ["-b", "memory"]]:
+        csv_path = tmp_path / f"out{len(outputs)}.csv"
+        subprocess.run([sys.executable, "analyze.py", str(tmp_path), "-o", str(csv_path), "-s", "--subtrees", *extra], check=True, capture_output=True)
+        outputs.append(csv_path.read_text(encoding="utf-8"))
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert outputs[0].splitlines() == [
+        "name,num_instances,subtree,file_paths",
+        "div,3,\"<div class=\"\"card\"\"><div class=\"\"card-header\"\"></div><div class=\"\"card-body\"\"></div></div>\",\"a.html,b.html\"",
+    ]
+
+
+#  ------------ Tests for analyze_files -------------
+def test_analyze_files_parallel_matches_serial() -> None:
+    file_paths = sorted(get_filepaths("test_data"))
+    serial = list(analyze_files(file_paths))
+    parallel = list(analyze_files(file_paths, jobs=2))
+    assert [file_path for file_path, entries in serial] == file_paths
+    assert parallel == serial
+    assert ("div", "container random", 2) in serial[file_paths.index(os.path.join("test_data", "ex_file_1.html"))][1]
+
+def test_main_parallel_csv_is_identical_to_serial(tmp_path) -> None:
+    serial_csv = tmp_path / "serial.csv"
+    parallel_csv = tmp_path / "parallel.csv"
+    subprocess.run([sys.executable, "analyze.py", "test_data", "-o", str(serial_csv)], check=True, capture_output=True)
+    subprocess.run([sys.executable, "analyze.py", "test_data", "-o", str(parallel_csv), "-j", "3"], check=True, capture_output=True)
+    assert serial_csv.read_bytes() == parallel_csv.read_bytes()
+
+def test_main_groups_multiple_tags_by_tag_name(tmp_path) -> None:
+    (tmp_path / "page.html").write_text("<div class='x'></div><span class='x'></span><span class='x'></span><div class='x'></div>", encoding="utf-8")
+    csv_path = tmp_path / "out.csv"
+    subprocess.run([sys.executable, "analyze.py", str(tmp_path), "-o", str(csv_path), "-s", "--tags", "div,span"], check=True, capture_output=True)
+    assert csv_path.read_text(encoding="utf-8").splitlines() == [
+        "name,num_instances,classes,file_paths",
+        "div,2,x,page.html",
+        "span,2,x,page.html",
+    ]
+
+def test_main_in_memory_database_csv_is_identical_to_file_database(tmp_path) -> None:
+    file_csv = tmp_path / "file.csv"
+    memory_csv = tmp_path / "memory.csv"
+    subprocess.run([sys.executable, "analyze.py", "test_data", "-o", str(file_csv), "-mo", "1"], check=True, capture_output=True)
+    subprocess.run([sys.executable, "analyze.py", "test_data", "-o", str(memory_csv), "-mo", "1", "-d", ":memory:"], check=True, capture_output=True)
+    assert file_csv.read_bytes() == memory_csv.read_bytes()
+    assert not os.path.exists(":memory:")
+
+def test_main_reports_database_errors(tmp_path) -> None:
+    database = tmp_path / "missing_dir" / "analysis.db"
+    result = subprocess.run([sys.executable, "analyze.py", "test_data", "-o", str(tmp_path / "a.csv"), "-d", str(database)], capture_output=True, text=True)
+    assert result.returncode == 1
+    assert result.stdout.startswith(f"Error: couldn't open the database '{database}'")
+    assert "Traceback" not in result.stderr
+
+def test_main_memory_backend_csv_is_identical_to_sqlite(tmp_path) -> None:
+    sqlite_csv = tmp_path / "sqlite.csv"
+    memory_csv = tmp_path / "memory.csv"
+    subprocess.run([sys.executable, "analyze.py", "test_data", "-o", str(sqlite_csv), "-mo", "1"], check=True, capture_output=True)
+    subprocess.run([sys.executable, "analyze.py", "test_data", "-o", str(memory_csv), "-mo", "1", "-b", "memory"], check=True, capture_output=True)
+    assert sqlite_csv.read_bytes() == memory_csv.read_bytes()
+
+@pytest.mark.parametrize("with_stats", [False, True])
+def test_analyze_files_io_threads_matches_serial(with_stats: bool) -> None:
+    file_paths = sorted(get_filepaths("test_data"))
+    stats = RunStats() if with_stats else None
+    assert list(analyze_files(file_paths, stats=stats, io_threads=4)) == list(analyze_files(file_paths))
+    if with_stats:
+        assert set(stats.stages) == {"read", "parse"}
+        assert stats.counts["bytes"] == sum(os.path.getsize(file_path) for file_path in file_paths)
+
+def test_read_file_mmaps_large_files_and_translates_newlines(tmp_path, monkeypatch) -> None:
+    path = tmp_path / "page.html"
+    path.write_bytes("<div class='a\r\nb'>é</div>\r<div class='c'></div>\n".encode("utf-8"))
+    with open(path, encoding="utf-8") as f:
+        expected = f.read()
+    assert read_file(str(path)) == expected
+    assert isinstance(read_file_raw(str(path)), bytes)
+
+    monkeypatch.setattr(analyze, "MMAP_THRESHOLD", 1)
+    raw = read_file_raw(str(path))
+    assert not isinstance(raw, bytes)
+    raw.close()
+    assert read_file(str(path)) == expected
+    assert list(analyze_files([str(path)], io_threads=2)) == [(str(path), [("div", "a b", 2), ("div", "c", 1)])]
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_analyze_files_with_stats_records_read_and_parse(jobs: int) -> None:
+    file_paths = sorted(get_filepaths("test_data"))
+    stats = RunStats()
+    assert list(analyze_files(file_paths, jobs=jobs, stats=stats)) == list(analyze_files(file_paths))
+    assert set(stats.stages) == {"read", "parse"}
+    assert stats.counts["bytes"] == sum(os.path.getsize(file_path) for file_path in file_paths)
+
+
+PREFILTER_CASES = [
+    "<p>No classes here</p>{{ include 'card.html' }}",
+    "<div id='x'><p class='text'></p></div>",
+    "<span class='a'></span>",
+    "<DIV CLASS='Upper case'></DIV>",
+    "<div class>valueless</div>",
+    "<!-- <div class='commented'></div> --><p>text</p>",
+    "<p data-class='x'>class mentioned</p><div></div>",
+    "<div class='é'>Unicode</div>",
+    "<p>ünïcode without tags</p>",
+    "<linK class='kelvin-sign'></linK>",
+    "<div><div><p></p></div></div>",
+    "<section><article><p></p></article></section>",
+    "",
+]
+
+@pytest.mark.parametrize("tags,subtrees", [(("div",), False), (("span", "link"), False), (("*",), False), (("div",), True), (("section",), True)])
+def test_prefilter_never_changes_results(tmp_path, tags: tuple, subtrees: bool) -> None:
+    file_paths = get_filepaths("test_data")
+    for i, content in enumerate(PREFILTER_CASES):
+        (tmp_path / f"{i}.html").write_text(content, encoding="utf-8")
+        file_paths.append(str(tmp_path / f"{i}.html"))
+
+    for file_path in file_paths:
+        expected = [entry[:3] for entry in parse_html(read_file(file_path), file_path, tags=tags, subtrees=subtrees)]
+        assert analyze_file(file_path, tags=tags, subtrees=subtrees) == expected
+        if not expected:
+            continue
+        with open(file_path, "rb") as f:
+            assert may_have_entries(f.read(), tags, subtrees)
+
+def test_prefilter_skips_files_without_class_bearing_tags(tmp_path) -> None:
+    for i, content in enumerate(PREFILTER_CASES[:3]):
+        (tmp_path / f"{i}.html").write_text(content, encoding="utf-8")
+    (tmp_path / "card.html").write_text("<div class='card'></div>", encoding="utf-8")
+    file_paths = sorted(get_filepaths(str(tmp_path)))
+    for io_threads in [1, 2]:
+        stats = RunStats()
+        results = dict(analyze_files(file_paths, stats=stats, io_threads=io_threads))
+        assert stats.counts["skipped_files"] == 2
+        assert results[str(tmp_path / "card.html")] == [("div", "card", 1)]
+    assert not may_have_entries("<p>ünïcode</p>".encode("utf-8"))
+    with raises(UnicodeDecodeError):
+        may_have_entries(b"<p>\xff</p>")
+
+
+#  ------------ Tests for RunStats -------------
+def test_run_stats_accumulates_stages_and_counts() -> None:
+    stats = RunStats()
+    assert list(stats.timed("walk", ["a.html", "b.html"])) == ["a.html", "b.html"]
+    with stats.stage("ingest"):
+        pass
+    with stats.stage("ingest"):
+        pass
+    stats.add_time("parse", 1.5, 1.0, 2048)
+    stats.add_time("parse", 0.5, 0.25, 1024)
+    stats.count("tags", 3)
+    stats.count("tags", 4)
+
+    assert list(stats.stages) == ["walk", "ingest", "parse"]
+    assert stats.stages["parse"]["wall_seconds"] == 2.0
+    assert stats.stages["parse"]["cpu_seconds"] == 1.25
+    assert stats.stages["parse"]["max_rss_so_far_bytes"] == 2048
+    assert stats.counts == {"tags": 7}
+    assert "tags: 7" in stats.summary()
+    assert stats.to_dict()["counts"] == {"tags": 7}
+
+def test_run_stats_stage_cpu_leaves_out_other_threads() -> None:
+    stats = RunStats()
+    done = []
+
+    def spin() -> None:
+        while not done:
+            sum(range(1000))
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(spin)
+        with stats.stage("walk"):
+            time.sleep(0.2)
+        done.append(True)
+    assert stats.stages["walk"]["wall_seconds"] >= 0.2
+    assert stats.stages["walk"]["cpu_seconds"] < 0.05
+
+def test_main_writes_stats_json_and_profile(tmp_path) -> None:
+    stats_path = tmp_path / "stats.json"
+    profile_path = tmp_path / "parse.prof"
+    result = subprocess.run([sys.executable, "analyze.py", "test_data", "-o", str(tmp_path / "out.csv"), "--stats",
+                             "--stats-json", str(stats_path), "--profile", str(profile_path)], check=True, capture_output=True, text=True)
+    assert "wall (s)" in result.stdout
+
+    with open(stats_path, "r", encoding="utf-8") as f:
+        stats = json.load(f)
+    assert {"walk", "read", "parse", "ingest", "query", "write"} <= set(stats["stages"])
+    assert stats["counts"]["files"] == 4
+    assert stats["counts"]["tags"] == 16
+    assert stats["counts"]["components"] == 5
+    assert profile_path.exists()
+
+
+#  ------------ Tests for analyze_files_cached -------------
+def count_analyze_file_calls(monkeypatch) -> list:
+    """
+    Record the paths passed to analyze.analyze_file
+    """
+    calls = []
+    original = analyze.analyze_file
+    def counting_analyze_file(file_path, *args):
+        calls.append(file_path)
+        return original(file_path, *args)
+    monkeypatch.setattr(analyze, "analyze_file", counting_analyze_file)
+    return calls
+
+def test_analyze_files_cached_only_reparses_changed_files(tmp_path, monkeypatch) -> None:
+    first = tmp_path / "first.html"
+    second = tmp_path / "second.html"
+    first.write_text("<div class='a b'></div>", encoding="utf-8")
+    second.write_text("<div class='c'></div>", encoding="utf-8")
+    file_paths = [str(first), str(second)]
+    calls = count_analyze_file_calls(monkeypatch)
+
+    cache_conn = open_cache(str(tmp_path / "cache.db"))
+    initial = list(analyze_files_cached(file_paths, cache_conn))
+    assert calls == file_paths
+    assert initial == list(analyze_files(file_paths))
+
+    calls.clear()
+    assert list(analyze_files_cached(file_paths, cache_conn)) == initial
+    assert calls == []
+
+    second.write_text("<div class='c d'></div><div class='c'></div>", encoding="utf-8")
+    assert list(analyze_files_cached(file_paths, cache_conn)) == [
+        (str(first), [("div", "a b", 2)]),
+        (str(second), [("div", "c d", 2), ("div", "c", 1)]),
+    ]
+    assert calls == [str(second)]
+    cache_conn.close()
+
+def test_analyze_files_cached_reads_reparsed_files_in_io_threads(tmp_path, monkeypatch) -> None:
+    file_paths = get_filepaths("test_data")
+    cache_conn = open_cache(str(tmp_path / "cache.db"))
+    reads = []
+    read_file_timed = analyze.read_file_timed
+    monkeypatch.setattr(analyze, "read_file_timed", lambda file_path: reads.append(file_path) or read_file_timed(file_path))
+    stats = RunStats()
+    assert list(analyze_files_cached(file_paths, cache_conn, stats=stats, io_threads=4)) == list(analyze_files(file_paths))
+    assert sorted(reads) == sorted(file_paths)
+    assert stats.counts["bytes"] > 0 and "parse" in stats.stages
+    reads.clear()
+    assert list(analyze_files_cached(file_paths, cache_conn, io_threads=4)) == list(analyze_files(file_paths))
+    assert reads == []
+    cache_conn.close()
+
+def test_analyze_files_cached_takes_the_same_arguments_as_analyze_files() -> None:
+    uncached = list(inspect.signature(analyze_files).parameters)
+    cached = list(inspect.signature(analyze_files_cached).parameters)
+    assert cached == uncached[:1] + ["cache_conn"] + uncached[1:]
+
+def test_analyze_files_cached_skips_touched_but_unchanged_files(tmp_path, monkeypatch) -> None:
+    page = tmp_path / "page.html"
+    page.write_text("<div class='a'></div>", encoding="utf-8")
+    calls = count_analyze_file_calls(monkeypatch)
+
+    cache_conn = open_cache(str(tmp_path / "cache.db"))
+    list(analyze_files_cached([str(page)], cache_conn))
+    os.utime(page, ns=(0, 0))
+    calls.clear()
+    assert list(analyze_files_cached([str(page)], cache_conn)) == [(str(page), [("div", "a", 1)])]
+    assert calls == []
+    cache_conn.close()
+
+def test_analyze_files_cached_prunes_deleted_files(tmp_path) -> None:
+    kept = tmp_path / "kept.html"
+    deleted = tmp_path / "deleted.html"
+    kept.write_text("<div class='a'></div>", encoding="utf-8")
+    deleted.write_text("<div class='b'></div>", encoding="utf-8")
+
+    cache_conn = open_cache(str(tmp_path / "cache.db"))
+    list(analyze_files_cached([str(kept), str(deleted)], cache_conn))
+    os.remove(deleted)
+    list(analyze_files_cached([str(kept)], cache_conn))
+
+    cursor = cache_conn.cursor()
+    assert cursor.execute("SELECT path FROM file_index").fetchall() == [(str(kept),)]
+    assert cursor.execute("SELECT path, classes FROM file_tags").fetchall() == [(str(kept), "a")]
+    cache_conn.close()
+
+def test_open_cache_discards_rows_from_other_parser(tmp_path) -> None:
+    page = tmp_path / "page.html"
+    page.write_text("<div class='a'></div>", encoding="utf-8")
+    cache_path = str(tmp_path / "cache.db")
+
+    cache_conn = open_cache(cache_path, "stream")
+    list(analyze_files_cached([str(page)], cache_conn))
+    cache_conn.close()
+
+    cache_conn = open_cache(cache_path, "bs4")
+    assert cache_conn.execute("SELECT COUNT(*) FROM file_index").fetchone() == (0,)
+    cache_conn.close()
+
+def test_open_cache_discards_rows_from_other_tags(tmp_path) -> None:
+    page = tmp_path / "page.html"
+    page.write_text("<div class='a'><span class='b'></span></div>", encoding="utf-8")
+    cache_path = str(tmp_path / "cache.db")
+
+    cache_conn = open_cache(cache_path, tags=("div",))
+    assert list(analyze_files_cached([str(page)], cache_conn, tags=("div",))) == [(str(page), [("div", "a", 1)])]
+    cache_conn.close()
+
+    cache_conn = open_cache(cache_path, tags=("div", "span"))
+    assert list(analyze_files_cached([str(page)], cache_conn, tags=("div", "span"))) == [(str(page), [("div", "a", 1), ("span", "b", 1)])]
+    cache_conn.close()
+
+
+#  ------------ Tests for load_entries -------------
+def test_load_entries_labels_and_batches_entries() -> None:
+    results = [
+        ("dir/a.html", [("div", "x", 1), ("div", "y", 1), ("div", "x", 1)]),
+        ("dir/b.html", []),
+        ("dir/c.html", [("div", "x y", 2)]),
+    ]
+    batches = []
+    num_files = load_entries(results, batches.append, is_short=True, batch_size=2)
+    assert num_files == 3
+    assert batches == [
+        [("div", "x", 1, "a.html"), ("div", "y", 1, "a.html")],
+        [("div", "x", 1, "a.html"), ("div", "x y", 2, "c.html")],
+    ]
+
+def test_load_entries_memory_stays_below_ceiling_for_large_corpus(tmp_path) -> None:
+    corpus = tmp_path / "corpus"
+    corpus.mkdir()
+    for i in range(60):
+        divs = "".join(f"<div class='c{j % 10} flex mt-{j % 7}'><p>text</p></div>" for j in range(300))
+        (corpus / f"page_{i}.html").write_text(divs, encoding="utf-8")
+    conn = sqlite3.connect(str(tmp_path / "database.db"))
+
+    tracemalloc.start()
+    try:
+        load_entries(analyze_files(iter_filepaths(str(corpus))), lambda batch: parse_data(batch, conn), batch_size=1000)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    # 18000 entries held in one list would need several MB
+    assert conn.execute("SELECT COUNT(*) FROM tag_data").fetchone() == (18000,)
+    assert peak < 1_000_000
+    conn.close()
+
 
 #  ------------ Tests for parse_data -------------
 def test_parse_data_creates_correct_table_headers() -> None:
@@ -140,23 +782,98 @@ def test_parse_data_populates_table_correctly() -> None:
     assert set(rows) == set(data)
     conn.close()
 
-#  ------------ Tests for analyze_db_info -------------
-# NOTE: tests rely on parse_data working correctly
-
-def test_analyze_db_info_creates_correct_csv_with_empty_data() -> None:
-    data=[]
+def test_parse_data_stores_each_class_string_and_path_once() -> None:
     conn = sqlite3.connect(":memory:")
-    parse_data(data, conn)
-    analyze_db_info(conn)
+    parse_data([
+        ("div", "flex flex-col", 2, "_table.html"),
+        ("span", "flex flex-col", 2, "_table.html"),
+        ("div", "flex", 1, "index.html"),
+    ], conn)
+    parse_data([
+        ("div", "flex flex-col", 2, "index.html"),
+        ("div", "flex", 1, "detail.html"),
+    ], conn)
+    cursor = conn.cursor()
+    assert cursor.execute("SELECT COUNT(*) FROM class_sets").fetchone() == (2,)
+    assert cursor.execute("SELECT COUNT(*) FROM file_paths").fetchone() == (3,)
+    assert cursor.execute("SELECT COUNT(*) FROM tag_rows").fetchone() == (5,)
+    assert cursor.execute("SELECT name, classes, file_path FROM tag_data WHERE file_path = 'index.html' ORDER BY id").fetchall() == [
+        ("div", "flex", "index.html"),
+        ("div", "flex flex-col", "index.html"),
+    ]
+    conn.close()
+
+def test_bulk_load_matches_plain_load() -> None:
+    data = [
+        ("div", "flex flex-col", 2, "_table.html"),
+        ("div", "flex flex-col", 2, "index.html"),
+        ("div", "flex", 1, "index.html"),
+        ("div", "flex", 1, "index.html"),
+        ("span", "flex", 1, "detail.html"),
+        ("span", "flex", 1, "_table.html"),
+    ]
+    plain_conn = sqlite3.connect(":memory:")
+    parse_data(data[:3], plain_conn)
+    parse_data(data[3:], plain_conn)
+
+    bulk_conn = sqlite3.connect(":memory:")
+    bulk_ids = begin_bulk_load(bulk_conn)
+    parse_data(data[:3], bulk_conn, bulk_ids)
+    parse_data(data[3:], bulk_conn, bulk_ids)
+    finish_bulk_load(bulk_conn)
+
+    assert bulk_ids["file_paths"] == {"_table.html": 1, "index.html": 2, "detail.html": 3}
+    assert query_db_info(bulk_conn) == query_db_info(plain_conn)
+    assert bulk_conn.execute("SELECT * FROM tag_data ORDER BY id").fetchall() == plain_conn.execute("SELECT * FROM tag_data ORDER BY id").fetchall()
+    plain_conn.close()
+    bulk_conn.close()
+
+def test_begin_bulk_load_discards_old_data_and_finish_builds_index(tmp_path) -> None:
+    conn = sqlite3.connect(str(tmp_path / "database.db"))
+    parse_data([("div", "stale", 1, "old.html")], conn)
+
+    bulk_ids = begin_bulk_load(conn)
+    assert conn.execute("PRAGMA synchronous").fetchone() == (0,)
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("off",)
+    assert conn.execute("SELECT COUNT(*) FROM tag_data").fetchone() == (0,)
+
+    parse_data([("div", "flex", 1, "new.html")], conn, bulk_ids)
+    finish_bulk_load(conn)
+    indexes = [row[1] for row in conn.execute("PRAGMA index_list(tag_rows)")]
+    assert "tag_rows_component" in indexes
+    assert conn.execute("SELECT name, classes, num_classes, file_path FROM tag_data").fetchall() == [("div", "flex", 1, "new.html")]
     conn.close()
 
+#  ------------ Tests for analyze_db_info / analyze_memory_info -------------
+# NOTE: tests rely on parse_data and aggregate_data working correctly
+
+def run_backend(backend: str, data: list, **kwargs) -> None:
+    """
+    Load data into the given aggregation backend and write its analysis csv
+    """
+    if backend == "sqlite":
+        conn = sqlite3.connect(":memory:")
+        parse_data(data, conn)
+        analyze_db_info(conn, **kwargs)
+        conn.close()
+    else:
+        aggregate = {}
+        aggregate_data(data, aggregate)
+        analyze_memory_info(aggregate, **kwargs)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_analyze_db_info_creates_correct_csv_with_empty_data(backend: str) -> None:
+    data=[]
+    run_backend(backend, data)
+
     with open("template_analysis.csv", "r") as f:
         content = f.read().strip()
     
     assert content == "name,num_instances,classes,file_paths"
     os.remove("template_analysis.csv")
 
-def test_analyze_db_info_creates_correct_csv() -> None:
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_analyze_db_info_creates_correct_csv(backend: str) -> None:
     data = [
         ("div", "flex flex-col gap-y-5 max-w-5xl mt-5 mx-auto", 6, "test_data/fake_path.html"),
         ("div", "flex flex-col gap-y-5 max-w-5xl mt-5 mx-auto", 6, "test_data/diff_path.html"),
@@ -164,10 +881,7 @@ def test_analyze_db_info_creates_correct_csv() -> None:
         ("div", "flex", 1, "_table.html"),
         ("div", "flex", 1, "_table.html"),
     ]
-    conn = sqlite3.connect(":memory:")
-    parse_data(data, conn)
-    analyze_db_info(conn)
-    conn.close()
+    run_backend(backend, data)
 
     with open("template_analysis.csv", "r", newline='') as file:
         reader = csv.reader(file)
@@ -190,7 +904,8 @@ def test_analyze_db_info_creates_correct_csv() -> None:
     os.remove("template_analysis.csv")
 
 
-def test_analyze_db_info_sorts_and_filters_correctly() -> None:
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_analyze_db_info_sorts_and_filters_correctly(backend: str) -> None:
     data = [
         ("div", "flex", 1, "_table.html"),
         ("div", "", 0, "demo.html"), #exclude 0 classes
@@ -206,10 +921,7 @@ def test_analyze_db_info_sorts_and_filters_correctly() -> None:
         ("div", "flex flex-col gap-y-5 max-w-5xl mt-5 mx-auto", 6, "test_data/diff_path.html"),
         ("div", "flex flex-col gap-y-5 max-w-5xl mt-5 mx-auto min-w-8", 7, "test_data/diff_path.html"), #exclude single occurrences
     ]
-    conn = sqlite3.connect(":memory:")
-    parse_data(data, conn)
-    analyze_db_info(conn)
-    conn.close()
+    run_backend(backend, data)
 
     with open("template_analysis.csv", "r", newline='') as file:
         reader = csv.reader(file)
@@ -231,7 +943,8 @@ def test_analyze_db_info_sorts_and_filters_correctly() -> None:
     assert table_data == expected_data
     os.remove("template_analysis.csv")
 
-def test_analyze_db_info_filters_locations_correctly() -> None:
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_analyze_db_info_filters_locations_correctly(backend: str) -> None:
     data = [
         ("div", "flex flex-col", 2, "_table.html"),
         ("div", "flex flex-col", 2, "_table.html"),
@@ -242,10 +955,7 @@ def test_analyze_db_info_filters_locations_correctly() -> None:
         ("div", "flex flex-col gap-y-5 max-w-5xl mt-5 mx-auto", 6, "test_data/diff_path.html"),
         ("div", "flex flex-col gap-y-5 max-w-5xl mt-5 mx-auto min-w-8", 7, "test_data/diff_path.html"), #exclude single occurrences
     ]
-    conn = sqlite3.connect(":memory:")
-    parse_data(data, conn)
-    analyze_db_info(conn, min_locations=3)
-    conn.close()
+    run_backend(backend, data, min_locations=3)
 
     with open("template_analysis.csv", "r", newline='') as file:
         reader = csv.reader(file)
@@ -267,20 +977,19 @@ def test_analyze_db_info_filters_locations_correctly() -> None:
 
 
 
-def test_analyze_db_info_creates_new_directories() -> None:
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_analyze_db_info_creates_new_directories(backend: str) -> None:
     data = []
     csv_path = "analysis/subdir/templates.csv"
-    conn = sqlite3.connect(":memory:")
-    parse_data(data, conn)
-    analyze_db_info(conn, csv_path=csv_path)
-    conn.close()
+    run_backend(backend, data, csv_path=csv_path)
 
     assert os.path.exists(csv_path)
     os.remove(csv_path)
     os.rmdir("analysis/subdir")
     os.rmdir("analysis")
 
-def test_analyze_db_info_works_with_set_occurrences_and_classes() -> None:
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_analyze_db_info_works_with_set_occurrences_and_classes(backend: str) -> None:
     data = [
         ("div", "flex", 1, "_table.html"),
         ("div", "", 0, "demo.html"),
@@ -296,10 +1005,7 @@ def test_analyze_db_info_works_with_set_occurrences_and_classes() -> None:
         ("div", "flex flex-col gap-y-5 max-w-5xl mt-5 mx-auto", 6, "test_data/diff_path.html"),
         ("div", "flex flex-col gap-y-5 max-w-5xl mt-5 mx-auto", 6, "test_data/diff_path.html"),
     ]
-    conn = sqlite3.connect(":memory:")
-    parse_data(data, conn)
-    analyze_db_info(conn, min_classes=6, min_instances=1)
-    conn.close()
+    run_backend(backend, data, min_classes=6, min_instances=1)
 
     with open("template_analysis.csv", "r", newline='') as file:
         reader = csv.reader(file)
@@ -320,17 +1026,15 @@ def test_analyze_db_info_works_with_set_occurrences_and_classes() -> None:
     assert table_data == expected_data
     os.remove("template_analysis.csv")
 
-def test_analyze_db_info_orders_filenames_alphabetically() -> None:
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_analyze_db_info_orders_filenames_alphabetically(backend: str) -> None:
     data = [
         ("div", "flex flex-col", 2, "_table.html"),
         ("div", "flex flex-col", 2, "_index_table.html"),
         ("div", "flex flex-col", 2, "index.html"),
         ("div", "flex flex-col", 2, "detail.html"),
     ]
-    conn = sqlite3.connect(":memory:")
-    parse_data(data, conn)
-    analyze_db_info(conn)
-    conn.close()
+    run_backend(backend, data)
 
     with open("template_analysis.csv", "r", newline='') as file:
         reader = csv.reader(file)
@@ -340,4 +1044,668 @@ def test_analyze_db_info_orders_filenames_alphabetically() -> None:
     
     assert row == ["div", "4", "flex flex-col", "_index_table.html,_table.html,detail.html,index.html"]
     
-    os.remove("template_analysis.csv")
\ No newline at end of file
+    os.remove("template_analysis.csv")
+def test_backends_write_identical_csv_for_ties(tmp_path) -> None:
+    data = [
+        ("div", "b", 1, "z.html"),
+        ("div", "a", 1, "y.html"),
+        ("span", "a", 1, "x.html"),
+        ("div", "b", 1, "a.html"),
+        ("span", "a", 1, "x.html"),
+        ("div", "a", 1, "b.html"),
+    ]
+    outputs = []
+    for backend in BACKENDS:
+        csv_path = str(tmp_path / f"{backend}.csv")
+        run_backend(backend, data, csv_path=csv_path)
+        with open(csv_path, "rb") as f:
+            outputs.append(f.read())
+
+    assert outputs[0] == outputs[1]
+    assert outputs[0].splitlines()[1:] == [b"div,2,a,\"b.html,y.html\"", b"div,2,b,\"a.html,z.html\"", b"span,2,a,x.html"]
+
+
+
+#  ------------ Tests for output formats -------------
+def test_iter_info_streams_file_paths_as_lists() -> None:
+    data = [("div", "a", 1, "b,1.html"), ("div", "a", 1, "a.html"), ("div", "a", 1, "a.html"), ("div", "b", 1, "a.html")]
+    conn = sqlite3.connect(":memory:")
+    parse_data(data, conn)
+    aggregate = {}
+    aggregate_data(data, aggregate)
+    expected = [("div", 3, "a", ["a.html", "b,1.html"]), ("div", 1, "b", ["a.html"])]
+    db_rows = iter_db_info(conn, min_instances=1)
+    assert not isinstance(db_rows, list)
+    assert list(db_rows) == list(iter_memory_info(aggregate, min_instances=1)) == expected
+    assert query_db_info(conn, min_instances=1) == [("div", 3, "a", "a.html,b,1.html"), ("div", 1, "b", "a.html")]
+    conn.close()
+
+@pytest.mark.parametrize("output_format", OUTPUT_FORMATS)
+def test_write_rows_round_trips(tmp_path, output_format: str) -> None:
+    headers = ["name", "num_instances", "classes", "file_paths", "similarity"]
+    rows = [("div", 3, "a é", ["a.html", "b,1.html"], 0.5), ("span", 1, "", [], 1.0)]
+    path = str(tmp_path / "nested" / f"out.{output_format}")
+    assert write_rows(iter(rows), path, headers, output_format) == 2
+
+    if output_format == "csv":
+        with open(path, newline="", encoding="utf-8") as f:
+            assert list(csv.reader(f)) == [headers, ["div", "3", "a é", "a.html,b,1.html", "0.5"], ["span", "1", "", "", "1.0"]]
+    elif output_format == "jsonl":
+        with open(path, encoding="utf-8") as f:
+            assert [json.loads(line) for line in f] == [dict(zip(headers, row)) for row in rows]
+    else:
+        read_headers, read_rows = read_columnar(path)
+        assert read_headers == headers
+        assert list(read_rows) == rows
+
+def test_columnar_writes_row_groups_and_empty_files(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(analyze, "ROW_GROUP_SIZE", 3)
+    rows = [("div", i, f"c{i}", [f"{j}.html" for j in range(i % 4)]) for i in range(10)]
+    path = str(tmp_path / "out.tacol")
+    assert write_rows(rows, path, analyze.RESULT_HEADERS, "columnar") == 10
+    assert list(read_columnar(path)[1]) == rows
+    write_rows([], path, analyze.RESULT_HEADERS, "columnar")
+    assert read_columnar(path)[0] == analyze.RESULT_HEADERS
+    assert list(read_columnar(path)[1]) == []
+    with raises(ValueError):
+        read_columnar("test_data/ex_file_1.html")
+
+def test_main_jsonl_output_matches_csv(tmp_path) -> None:
+    csv_path = tmp_path / "out.csv"
+    jsonl_path = tmp_path / "out.jsonl"
+    subprocess.run([sys.executable, "analyze.py", "test_data", "-o", str(csv_path), "-mo", "1"], check=True, capture_output=True)
+    subprocess.run([sys.executable, "analyze.py", "test_data", "-o", str(jsonl_path), "-mo", "1", "-f", "jsonl"], check=True, capture_output=True)
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        csv_rows = list(csv.reader(f))[1:]
+    with open(jsonl_path, encoding="utf-8") as f:
+        jsonl_rows = [json.loads(line) for line in f]
+    assert [[row["name"], str(row["num_instances"]), row["classes"], ",".join(row["file_paths"])] for row in jsonl_rows] == csv_rows
+
+
+#  ------------ Tests for cluster_similar -------------
+def brute_force_clusters(rows: list, threshold: float) -> list:
+    """
+    Reference for cluster_similar that compares every pair of components
+    """
+    rows = sorted(rows, key=lambda row: (-row[1], row[0], row[2]))
+    clustered = [False] * len(rows)
+    clusters = []
+    for i, row in enumerate(rows):
+        if clustered[i]:
+            continue
+        clustered[i] = True
+        members = [i]
+        for j in range(len(rows)):
+            a, b = set(row[2].split()), set(rows[j][2].split())
+            if not clustered[j] and rows[j][0] == row[0] and len(a & b) / len(a | b) >= threshold:
+                clustered[j] = True
+                members.append(j)
+        if len(members) > 1:
+            clusters.append(sorted(rows[j][:3] for j in members))
+    return sorted(clusters)
+
+def test_cluster_similar_groups_near_duplicate_class_sets() -> None:
+    rows = [
+        ("div", 5, "a b c d e", "x.html"),
+        ("div", 2, "a b c d f", "y.html"),
+        ("div", 1, "a b c d e g", "x.html,z.html"),
+        ("div", 4, "p q r", "x.html"),
+        ("span", 3, "a b c d e", "x.html"),
+        ("div", 1, "", "x.html"),
+    ]
+    assert cluster_similar(rows, 0.6) == [
+        (1, "div", 5, "a b c d e", "x.html", 1.0),
+        (1, "div", 2, "a b c d f", "y.html", 0.667),
+        (1, "div", 1, "a b c d e g", "x.html,z.html", 0.833),
+    ]
+    assert cluster_similar(rows, 0.6, min_instances=9) == []
+    assert cluster_similar(rows, 0.6, min_locations=4) == []
+    assert cluster_similar(rows, 0.8) == [
+        (1, "div", 5, "a b c d e", "x.html", 1.0),
+        (1, "div", 1, "a b c d e g", "x.html,z.html", 0.833),
+    ]
+
+def test_cluster_similar_matches_pairwise_comparison_without_comparing_every_pair(monkeypatch) -> None:
+    rng = random.Random(0)
+    vocabulary = [f"c{i}" for i in range(300)]
+    rows = []
+    for i in range(400):
+        base = rng.sample(vocabulary, 8)
+        rows.append(("div", rng.randint(1, 50), " ".join(sorted(base)), f"{i}.html"))
+        for _ in range(rng.randint(0, 3)):
+            variant = set(base)
+            variant.discard(rng.choice(base))
+            rows.append(("div", rng.randint(1, 50), " ".join(sorted(variant)), f"{i}.html"))
+    rows = list({row[2]: row for row in rows}.values())
+
+    calls = []
+    jaccard = analyze.jaccard
+    monkeypatch.setattr(analyze, "jaccard", lambda a, b: calls.append(1) or jaccard(a, b))
+    clusters = {}
+    for cluster, *row, similarity in cluster_similar(rows, 0.7, min_instances=1):
+        clusters.setdefault(cluster, []).append(tuple(row[:3]))
+
+    assert sorted(sorted(members) for members in clusters.values()) == brute_force_clusters(rows, 0.7)
+    assert len(calls) < len(rows) * 10
+
+def test_lsh_params_catch_pairs_at_threshold() -> None:
+    for threshold in [0.3, 0.5, 0.8, 0.95, 1.0]:
+        bands, rows = lsh_params(threshold)
+        assert bands * rows <= analyze.NUM_PERMUTATIONS
+        assert 1 - (1 - threshold ** rows) ** bands >= analyze.LSH_RECALL
+
+def test_main_similarity_writes_clusters(tmp_path) -> None:
+    (tmp_path / "a.html").write_text("<div class='card p-4 shadow'></div><div class='card p-4 shadow rounded'></div>", encoding="utf-8")
+    (tmp_path / "b.html").write_text("<div class='card p-4 shadow'></div><div class='nav'></div>", encoding="utf-8")
+    for backend in BACKENDS:
+        csv_path = tmp_path / f"{backend}.csv"
+        subprocess.run([sys.executable, "analyze.py", str(tmp_path), "-o", str(csv_path), "-s", "-b", backend, "--similarity", "0.7"], check=True, capture_output=True)
+        assert csv_path.read_text(encoding="utf-8").splitlines() == [
+            "cluster,name,num_instances,classes,file_paths,similarity",
+            "1,div,2,card p-4 shadow,\"a.html,b.html\",1.0",
+            "1,div,1,card p-4 rounded shadow,a.html,0.75",
+        ]
+
+
+#  ------------ Tests for shards -------------
+def test_db_and_memory_components_match() -> None:
+    data = [("div", "a", 1, "x.html"), ("div", "a", 1, "y.html"), ("div", "a", 1, "x.html"), ("span", "a b", 2, "x.html")]
+    conn = sqlite3.connect(":memory:")
+    parse_data(data, conn)
+    aggregate = {}
+    aggregate_data(data, aggregate)
+    expected = [("div", "a", 1, 3, ["x.html", "y.html"]), ("span", "a b", 2, 1, ["x.html"])]
+    assert sorted(iter_db_components(conn)) == sorted(iter_memory_components(aggregate)) == expected
+    conn.close()
+
+def test_merge_shards_adds_counts_and_unions_locations(tmp_path) -> None:
+    first = [("div", "a", 1, 2, ["x.html", "y.html"]), ("div", "b", 1, 1, ["x.html"])]
+    second = [("div", "a", 1, 3, ["y.html", "z.html"]), ("span", "a", 1, 1, ["z.html"])]
+    write_shard(first, str(tmp_path / "1.shard"))
+    write_shard(second, str(tmp_path / "2.shard"))
+    aggregate, meta = merge_shards([str(tmp_path / "1.shard"), str(tmp_path / "2.shard")])
+    assert meta["tags"] == "div"
+    assert aggregate == {
+        ("div", "a"): [1, 5, {"x.html", "y.html", "z.html"}],
+        ("div", "b"): [1, 1, {"x.html"}],
+        ("span", "a"): [1, 1, {"z.html"}],
+    }
+    assert query_memory_info(aggregate, min_locations=3) == [("div", 5, "a", "x.html,y.html,z.html")]
+
+def test_merge_shards_rejects_other_files_and_mismatched_shards(tmp_path) -> None:
+    write_shard([], str(tmp_path / "div.shard"))
+    write_shard([], str(tmp_path / "span.shard"), ("span",))
+    (tmp_path / "other.csv").write_text("name,num_instances\n", encoding="utf-8")
+    with raises(FileNotFoundError):
+        merge_shards([str(tmp_path / "missing.shard")])
+    with raises(ValueError):
+        merge_shards([str(tmp_path / "other.csv")])
+    with raises(ValueError):
+        merge_shards([str(tmp_path / "div.shard"), str(tmp_path / "span.shard")])
+
+def test_main_merged_shards_csv_is_identical_to_single_run(tmp_path) -> None:
+    full_csv = tmp_path / "full.csv"
+    merged_csv = tmp_path / "merged.csv"
+    subprocess.run([sys.executable, "analyze.py", "test_data", "-o", str(full_csv), "-mo", "1", "-ml", "1"], check=True, capture_output=True)
+    shards = []
+    for i, (target, backend) in enumerate([("ex_file_1.html", "sqlite"), ("ex_file_2.html", "memory"), ("additional_files", "sqlite")]):
+        shards.append(str(tmp_path / f"{i}.shard"))
+        subprocess.run([sys.executable, "analyze.py", os.path.join("test_data", target), "-b", backend, "--shard", shards[-1]], check=True, capture_output=True)
+    subprocess.run([sys.executable, "analyze.py", "merge", *shards, "-o", str(merged_csv), "-mo", "1", "-ml", "1"], check=True, capture_output=True)
+    assert full_csv.read_bytes() == merged_csv.read_bytes()
+
+
+#  ------------ Tests for diff mode -------------
+def git_commit(repo, files) -> str:
+    """
+    Write files (None deletes one) into the git repository repo, commit them and return the commit id
+    """
+    for file_path, content in files.items():
+        path = repo / file_path
+        if content is None:
+            path.unlink()
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(content, encoding="utf-8")
+    subprocess.run(["git", "-C", str(repo), "add", "-A"], check=True, capture_output=True)
+    subprocess.run(["git", "-C", str(repo), "-c", "user.name=test", "-c", "user.email=test@example.com", "commit", "-q", "-m", "change"], check=True, capture_output=True)
+    return subprocess.run(["git", "-C", str(repo), "rev-parse", "HEAD"], check=True, capture_output=True, text=True).stdout.strip()
+
+@pytest.fixture
+def git_repo(tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    subprocess.run(["git", "init", "-q", str(repo)], check=True, capture_output=True)
+    return repo
+
+def dump_baseline(conn) -> Tuple[List, List]:
+    return (sorted(conn.execute("SELECT * FROM baseline_components")), sorted(conn.execute("SELECT * FROM baseline_files")))
+
+def test_diff_revisions_reports_threshold_crossings(tmp_path, git_repo) -> None:
+    card = "<div class='card'></div>"
+    base = git_commit(git_repo, {
+        "a.html": card + "<div class='nav'></div><div class='nav'></div>",
+        "b.html": "<div class='footer'></div>",
+        "old/c.html": "<div class='footer'></div>",
+        "notes.txt": card * 5,
+    })
+    head = git_commit(git_repo, {
+        "b.html": card,
+        "old/c.html": None,
+        "a.html": card + "<div class='nav'></div>",
+        "notes.txt": card * 9,
+    })
+    conn = open_baseline(str(tmp_path / "baseline.db"))
+    rows = diff_revisions(conn, str(git_repo), base, head, min_instances=2)
+    assert rows == [
+        ("new", "div", 2, 1, "card", 2, 1, ["a.html", "b.html"]),
+        ("resolved", "div", 0, 2, "footer", 0, 2, []),
+        ("resolved", "div", 1, 2, "nav", 1, 1, ["a.html"]),
+    ]
+    assert baseline_revision(conn) == base
+    assert diff_revisions(conn, str(git_repo), base, head, min_instances=2, min_locations=2) == [
+        ("new", "div", 2, 1, "card", 2, 1, ["a.html", "b.html"]),
+        ("resolved", "div", 0, 2, "footer", 0, 2, []),
+    ]
+    conn.close()
+
+def test_update_baseline_follows_diffs_like_a_full_build(tmp_path, git_repo) -> None:
+    first = git_commit(git_repo, {"a.html": "<div class='x'></div>", "b.html": "<div class='x y'></div><div class='z'></div>", "c.njk": "<div class='z'></div>"})
+    second = git_commit(git_repo, {"a.html": None, "moved/b.html": "<div class='x y'></div><div class='z'></div>", "b.html": None, "d.html": "<div class='x'></div><div class='x'></div>"})
+    extensions = (".html", ".njk")
+    incremental = open_baseline(str(tmp_path / "incremental.db"), extensions=extensions)
+    assert update_baseline(incremental, str(git_repo), first, extensions=extensions) == 3
+    assert update_baseline(incremental, str(git_repo), first, extensions=extensions) == 0
+    # Only the deleted, moved and added files are parsed
+    assert update_baseline(incremental, str(git_repo), second, extensions=extensions) == 4
+    full = open_baseline(str(tmp_path / "full.db"), extensions=extensions)
+    update_baseline(full, str(git_repo), second, extensions=extensions)
+    assert dump_baseline(incremental) == dump_baseline(full)
+    assert dump_baseline(full)[1] == [("div", "x", "d.html"), ("div", "x y", "moved/b.html"), ("div", "z", "c.njk"), ("div", "z", "moved/b.html")]
+    incremental.close()
+    full.close()
+
+    # A baseline made with other options starts over
+    conn = open_baseline(str(tmp_path / "incremental.db"), tags=("span",), extensions=extensions)
+    assert baseline_revision(conn) is None
+    assert dump_baseline(conn) == ([], [])
+    conn.close()
+
+def test_resolve_revision_rejects_unknown_revisions(git_repo) -> None:
+    commit = git_commit(git_repo, {"a.html": ""})
+    assert resolve_revision(str(git_repo), "HEAD") == commit
+    with raises(ValueError):
+        resolve_revision(str(git_repo), "no-such-branch")
+
+def test_parse_diff_args_works() -> None:
+    assert parse_diff_args(["analyze.py", "diff", "main", "HEAD"]) == [
+        "main", "HEAD", "template_diff.csv", 1, 2, 1,
+        {"repo": ".", "baseline": "template_baseline.db", "format": "csv", "tags": ("div",), "extensions": (".html",), "subtrees": False},
+    ]
+    args = ["analyze.py", "diff", "-C", "site", "main", "HEAD", "--baseline", "base.db", "-f", "jsonl", "-mo", "3", "-t", "div,span", "-e", "vue", "--subtrees"]
+    assert parse_diff_args(args) == [
+        "main", "HEAD", "template_diff.jsonl", 1, 3, 1,
+        {"repo": "site", "baseline": "base.db", "format": "jsonl", "tags": ("div", "span"), "extensions": (".vue",), "subtrees": True},
+    ]
+    with raises(ValueError):
+        parse_diff_args(["analyze.py", "diff", "main"])
+    with raises(ValueError):
+        parse_diff_args(["analyze.py", "diff", "a", "b", "c"])
+
+def test_shared_options_parse_the_same_for_every_command() -> None:
+    shared = ["-o", "out.jsonl", "-f", "jsonl", "-mc", "2", "-mo", "3", "-ml", "4"]
+    analysis_dir, output_file, min_classes, min_occurrences, min_locations, _, options = parse_args(["analyze.py", "site"] + shared)
+    assert (output_file, options["format"], min_classes, min_occurrences, min_locations) == ("out.jsonl", "jsonl", 2, 3, 4)
+    assert parse_merge_args(["analyze.py", "merge", "a.db"] + shared) == [["a.db"], "out.jsonl", 2, 3, 4, "jsonl"]
+    base, head, output_file, min_classes, min_occurrences, min_locations, options = parse_diff_args(["analyze.py", "diff", "main", "HEAD"] + shared)
+    assert (output_file, options["format"], min_classes, min_occurrences, min_locations) == ("out.jsonl", "jsonl", 2, 3, 4)
+    for bad in [["-mc", "x"], ["-f", "xml"], ["-t", ","], ["-e", " "]]:
+        for parse, args in [(parse_args, ["analyze.py", "site"]), (parse_diff_args, ["analyze.py", "diff", "main", "HEAD"])]:
+            with raises(ValueError):
+                parse(args + bad)
+    # merge reads no files, so it doesn't take -t or -e
+    with raises(ValueError):
+        parse_merge_args(["analyze.py", "merge", "a.db", "-t", "div"])
+
+def test_main_diff_writes_crossings(tmp_path, git_repo) -> None:
+    git_commit(git_repo, {"a.html": "<div class='card'></div>"})
+    git_commit(git_repo, {"b.html": "<div class='card'></div>"})
+    output = tmp_path / "diff.csv"
+    result = subprocess.run([sys.executable, "analyze.py", "diff", "HEAD~1", "HEAD", "-C", str(git_repo), "--baseline", str(tmp_path / "base.db"), "-o", str(output)], check=True, capture_output=True, text=True)
+    assert "1 new and 0 resolved" in result.stdout
+    with open(output, newline="", encoding="utf-8") as f:
+        assert list(csv.reader(f)) == [analyze.DIFF_HEADERS, ["new", "div", "2", "1", "card", "2", "1", "a.html,b.html"]]
+    result = subprocess.run([sys.executable, "analyze.py", "diff", "HEAD", "nope", "-C", str(git_repo)], capture_output=True, text=True)
+    assert result.returncode == 1
+
+#  ------------ Tests for Watcher -------------
+def write_template(path, content: str) -> None:
+    """
+    Write content to path, moving its modification time forward so the change is seen
+    even on filesystems with coarse timestamps
+    """
+    existed = path.exists()
+    mtime = path.stat().st_mtime_ns if existed else 0
+    path.write_text(content, encoding="utf-8")
+    os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+
+def full_run_rows(path: str, is_short: bool = False) -> list:
+    """
+    Rows of a fresh, non-incremental analysis of path, for comparison with a Watcher
+    """
+    aggregate = {}
+    if os.listdir(path):
+        load_entries(analyze_files(get_filepaths(path)), lambda batch: aggregate_data(batch, aggregate), is_short)
+    return list(iter_memory_info(aggregate, 1, 1, 1))
+
+@pytest.mark.parametrize("is_short", [False, True])
+def test_watcher_updates_match_full_runs(tmp_path, monkeypatch, is_short: bool) -> None:
+    (tmp_path / "sub").mkdir()
+    write_template(tmp_path / "a.html", "<div class='x'></div><div class='y'></div>")
+    write_template(tmp_path / "sub" / "a.html", "<div class='x'></div>")
+    write_template(tmp_path / "b.html", "<div class='y'></div>")
+    watcher = Watcher(str(tmp_path), is_short)
+    assert watcher.load() == 3
+    assert watcher.rows(1, 1, 1) == full_run_rows(str(tmp_path), is_short)
+
+    parsed = []
+    analyze_file = analyze.analyze_file
+    monkeypatch.setattr(analyze, "analyze_file", lambda file_path, *args: parsed.append(file_path) or analyze_file(file_path, *args))
+
+    assert watcher.update() == 0
+    write_template(tmp_path / "sub" / "a.html", "<div class='z'></div><div class='z'></div>")
+    write_template(tmp_path / "c.html", "<div class='x'></div>")
+    os.remove(tmp_path / "b.html")
+    assert watcher.update() == 3
+    assert sorted(parsed) == sorted([str(tmp_path / "sub" / "a.html"), str(tmp_path / "c.html")])
+    assert watcher.rows(1, 1, 1) == full_run_rows(str(tmp_path), is_short)
+
+    for file_path in ["a.html", "c.html", os.path.join("sub", "a.html")]:
+        os.remove(tmp_path / file_path)
+    watcher.update()
+    assert watcher.aggregate == {}
+
+def test_watch_rewrites_csv_after_a_change(tmp_path, monkeypatch) -> None:
+    write_template(tmp_path / "a.html", "<div class='x'></div><div class='x'></div>")
+    csv_path = str(tmp_path / "out.csv")
+    monkeypatch.setattr(analyze.time, "sleep", lambda seconds: write_template(tmp_path / "a.html", "<div class='y'></div><div class='y'></div>"))
+    watch(Watcher(str(tmp_path), is_short=True), csv_path, polls=1)
+    with open(csv_path, encoding="utf-8") as f:
+        assert f.read().splitlines() == ["name,num_instances,classes,file_paths", "div,2,y,a.html"]
+
+
+#  ------------ Tests for Analyzer -------------
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_analyzer_matches_full_run(backend: str) -> None:
+    aggregate = {}
+    load_entries(analyze_files(iter_filepaths("test_data")), lambda batch: aggregate_data(batch, aggregate))
+    expected = list(iter_memory_info(aggregate, 1, 1, 1))
+    with Analyzer(backend) as analyzer:
+        assert analyzer.add_many(iter_filepaths("test_data")) == 4
+        assert analyzer.results(1, 1, 1) == expected
+        assert analyzer.results(1, 1, 1) == expected
+        assert analyzer.num_components() == len(aggregate)
+    with Analyzer(backend) as analyzer:
+        for file_path in iter_filepaths("test_data"):
+            analyzer.add_file(file_path)
+        assert analyzer.results(1, 1, 1) == expected
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_analyzer_can_keep_adding_after_results(backend: str) -> None:
+    analyzer = Analyzer(backend, tags=("div", "span"))
+    assert analyzer.add_html("<div class='card'></div><span class='x'></span>", "a.html") == 2
+    assert analyzer.results() == []
+    analyzer.add_html("<div class='card'></div>", "sub/b.html")
+    assert analyzer.results() == [("div", 2, "card", ["a.html", "sub/b.html"])]
+    assert list(analyzer.components()) == [("div", "card", 1, 2, ["a.html", "sub/b.html"]), ("span", "x", 1, 1, ["a.html"])]
+    analyzer.close()
+    analyzer.close()
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_analyzer_raises_once_closed(backend: str) -> None:
+    analyzer = Analyzer(backend)
+    analyzer.add_html("<div class='card'></div><div class='card'></div>", "a.html")
+    analyzer.close()
+    for use in (analyzer.results, analyzer.iter_results, analyzer.components, analyzer.num_components, analyzer.flush,
+                lambda: analyzer.add_html("<div class='card'></div>", "b.html"),
+                lambda: analyzer.add_file("test_data/ex_file_1.html"),
+                lambda: analyzer.add_many(["test_data/ex_file_1.html"])):
+        with raises(ValueError, match="closed"):
+            use()
+
+def test_analyzer_instances_are_isolated_across_threads() -> None:
+    def run(i: int) -> List:
+        with Analyzer(is_short=True) as analyzer:
+            for j in range(20):
+                analyzer.add_html(f"<div class='c{i}'></div>" * (i + 1), f"dir/{j}.html")
+            return analyzer.results(min_instances=1)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(run, range(8)))
+    assert results == [[("div", 20 * (i + 1), f"c{i}", sorted(f"{j}.html" for j in range(20)))] for i in range(8)]
+
+def test_analyzer_can_be_shared_between_threads() -> None:
+    with Analyzer() as analyzer:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda i: analyzer.add_html("<div class='x'></div>", f"{i}.html"), range(50)))
+        assert analyzer.results()[0][:3] == ("div", 50, "x")
+
+def test_analyzer_deletes_its_database_file(tmp_path) -> None:
+    database = tmp_path / "analysis.db"
+    with Analyzer(database=str(database)) as analyzer:
+        analyzer.add_html("<div class='x'></div><div class='x'></div>", "a.html")
+        assert analyzer.results() == [("div", 2, "x", ["a.html"])]
+        assert database.exists()
+    assert not database.exists()
+    with raises(ValueError):
+        Analyzer("nope")
+
+def test_get_filepaths_returns_empty_list_for_dir_without_templates(tmp_path) -> None:
+    assert get_filepaths(str(tmp_path)) == []
+
+#  ------------ Tests for TopKSketch -------------
+def test_top_k_sketch_is_exact_while_counters_are_free() -> None:
+    data = [("div", "a", 1, "x.html")] * 3 + [("div", "a", 1, "y.html"), ("div", "b", 1, "x.html"), ("div", "b", 1, "x.html"), ("span", "a b", 2, "z.html")]
+    sketch = TopKSketch(2, min_classes=1)
+    sketch.add_batch(data)
+    assert sketch.rows(min_instances=1) == [
+        ("div", 4, 0, "a", 2, 0, ["x.html", "y.html"]),
+        ("div", 2, 0, "b", 1, 0, ["x.html"]),
+    ]
+    assert sketch.rows(min_instances=1, min_locations=2) == [("div", 4, 0, "a", 2, 0, ["x.html", "y.html"])]
+    assert TopKSketch(2, min_classes=2).add_batch(data) is None
+
+def test_top_k_sketch_bounds_memory_and_errors() -> None:
+    rng = random.Random(0)
+    heavy = {f"heavy-{i}": 2000 - 100 * i for i in range(10)}
+    stream = [key for key, count in heavy.items() for _ in range(count)]
+    stream += [f"rare-{rng.randrange(50000)}" for _ in range(60000)]
+    rng.shuffle(stream)
+
+    sketch = TopKSketch(10)
+    sketch.add_batch([("div", key, 1, f"{i % 500}.html") for i, key in enumerate(stream)])
+    assert len(sketch.counters) == sketch.capacity == analyze.TOPK_MIN_COUNTERS
+
+    true_counts = {}
+    for key in stream:
+        true_counts[key] = true_counts.get(key, 0) + 1
+    rows = sketch.rows()
+    assert sorted(row[3] for row in rows) == sorted(heavy)
+    for name, count, error, classes, num_locations, location_error, examples in rows:
+        assert count - error <= true_counts[classes] <= count
+
+def test_top_k_sketch_ranks_on_guaranteed_counts() -> None:
+    # A few frequent components among far more one-off ones than there are counters, so
+    # one-offs that just took over a counter have counts that are almost all error
+    rng = random.Random(1)
+    frequent = {"top": 400, "second": 300, "third": 250}
+    stream = [key for key, count in frequent.items() for _ in range(count)]
+    stream += [f"once-{i}" for i in range(150000)]
+    rng.shuffle(stream)
+
+    sketch = TopKSketch(5)
+    assert sketch.capacity < 150000
+    sketch.add_batch([("div", key, 1, f"{i % 500}.html") for i, key in enumerate(stream)])
+    assert max(count for count, error, *_ in sketch.counters.values() if error) > 100
+    rows = sketch.rows()
+    assert rows[0][3] == "top"
+    assert {row[3] for row in rows} <= set(frequent)
+    for name, count, error, classes, num_locations, location_error, examples in rows:
+        assert 2 <= count - error <= frequent[classes] <= count
+
+def test_hll_estimate_is_within_error() -> None:
+    registers = bytearray(analyze.HLL_REGISTERS)
+    for i in range(20000):
+        index, rank = hll_position(f"templates/page_{i}.html")
+        registers[index] = max(registers[index], rank)
+    assert abs(hll_estimate(registers) - 20000) <= 20000 * 3 * analyze.HLL_RELATIVE_ERROR
+    assert hll_estimate(bytearray(analyze.HLL_REGISTERS)) == 0
+
+def test_main_top_k_writes_approximate_rows(tmp_path) -> None:
+    csv_path = tmp_path / "top.csv"
+    subprocess.run([sys.executable, "analyze.py", "test_data", "-o", str(csv_path), "-s", "--top-k", "1"], check=True, capture_output=True)
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ["name", "num_instances", "max_error", "classes", "num_locations", "location_error", "example_file_paths"]
+    assert len(rows) == 2 and rows[1][:6] == ["div", "8", "0", "random", "4", "0"]
+    examples = rows[1][6].split(",")
+    assert len(examples) == 3 and set(examples) < {"ex_file_1.html", "ex_file_2.html", "nested_1.html", "nested_2.html"}
+
+
+def test_main_top_k_subtrees_uses_subtree_headers(tmp_path) -> None:
+    card = "<div class='card'><div class='card-header'></div></div>"
+    (tmp_path / "a.html").write_text(card * 2, encoding="utf-8")
+    csv_path = tmp_path / "top.csv"
+    subprocess.run([sys.executable, "analyze.py", str(tmp_path), "-o", str(csv_path), "-s", "--top-k", "1", "--subtrees"], check=True, capture_output=True)
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == analyze.TOPK_SUBTREE_HEADERS
+    assert rows[1][:4] == ["div", "2", "0", '<div class="card"><div class="card-header"></div></div>']
+
+#  ------------ Tests for startup and the daemon -------------
+def imported_modules(args: List[str]) -> List[str]:
+    """
+    Run main(args) in a fresh interpreter and return which of the lazily imported modules it loaded
+    """
+    code = f"""
+import sys, analyze
+try:
+    analyze.main({["analyze.py", *args]!r})
+except SystemExit:
+    pass
+print(",".join(m for m in ["bs4", "sqlite3", "csv", "subprocess", "concurrent.futures", "socket"] if m in sys.modules))
+"""
+    result = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)
+    return result.stdout.splitlines()[-1].split(",") if result.stdout.splitlines()[-1] else []
+
+def test_single_file_runs_only_import_what_they_use(tmp_path) -> None:
+    assert imported_modules(["test_data/ex_file_1.html", "-o", str(tmp_path / "a.csv")]) == ["sqlite3", "csv"]
+    assert imported_modules(["test_data/ex_file_1.html", "-o", str(tmp_path / "a.jsonl"), "-f", "jsonl", "-b", "memory"]) == []
+    assert imported_modules(["test_data/ex_file_1.html", "-o", str(tmp_path / "b.csv"), "-p", "bs4", "-b", "memory"]) == ["bs4", "csv"]
+
+def test_run_startup_benchmark_reports_timings() -> None:
+    # Timing is enforced by bench.py --startup; only the report's shape is checked here
+    report = run_startup_benchmark("test_data/ex_file_1.html", repeat=1, budget=0.5)
+    assert set(report) == {"interpreter_seconds", "seconds", "overhead_seconds", "budget_seconds", "within_budget"}
+    assert report["budget_seconds"] == 0.5
+    assert report["within_budget"] == (report["overhead_seconds"] <= 0.5)
+
+def test_run_request_captures_output_and_exit_code() -> None:
+    assert run_request(["analyze.py", "test_data", "-mo", "x"], os.getcwd()) == (1, "Error: x is not an integer\n")
+
+def test_parse_daemon_args_works() -> None:
+    argv, options = parse_daemon_args(["analyze.py", "--daemon", "page.html", "--socket", "/tmp/a.sock", "-o", "out.csv"])
+    assert argv == ["analyze.py", "page.html", "-o", "out.csv"]
+    assert options == {"daemon": True, "socket": "/tmp/a.sock", "stop": False, "idle_timeout": analyze.DAEMON_IDLE_TIMEOUT}
+    argv, options = parse_daemon_args(["analyze.py", "serve", "--idle-timeout", "5", "--stop"])
+    assert argv == ["analyze.py", "serve"]
+    assert options["idle_timeout"] == 5 and options["stop"] and options["socket"] == analyze.default_socket_path()
+    with raises(ValueError):
+        parse_daemon_args(["analyze.py", "--daemon", "templates", "--watch"])
+
+def test_default_socket_path_prefers_the_runtime_dir(monkeypatch, tmp_path) -> None:
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    assert analyze.default_socket_path() == str(tmp_path / "template-analyzer.sock")
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+    assert os.path.dirname(analyze.default_socket_path()) == analyze.user_socket_directory()
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="needs unix user ids")
+def test_make_socket_directory_only_accepts_private_directories(tmp_path) -> None:
+    directory = tmp_path / "sockets"
+    analyze.make_socket_directory(str(directory))
+    assert os.lstat(directory).st_mode & 0o777 == 0o700
+    analyze.make_socket_directory(str(directory))
+    directory.chmod(0o755)
+    with raises(ValueError):
+        analyze.make_socket_directory(str(directory))
+    os.symlink(tmp_path, tmp_path / "link")
+    with raises(ValueError):
+        analyze.make_socket_directory(str(tmp_path / "link"))
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs unix domain sockets")
+def test_daemon_refuses_socket_paths_that_are_not_its_sockets(tmp_path) -> None:
+    socket_path = tmp_path / "d.sock"
+    socket_path.write_text("not a socket")
+    for run in (lambda: analyze.run_client(["analyze.py", "test_data"], str(socket_path), start=False),
+                lambda: analyze.stop_daemon(str(socket_path)),
+                lambda: analyze.serve(str(socket_path), idle_timeout=0.1)):
+        with raises(ValueError, match="not a socket owned by the current user"):
+            run()
+    assert socket_path.read_text() == "not a socket"
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs unix domain sockets")
+def test_daemon_output_matches_direct_runs(tmp_path) -> None:
+    socket_path = str(tmp_path / "d.sock")
+    try:
+        for i, args in enumerate([["test_data"], ["test_data", "-p", "bs4", "-t", "div,span", "-mo", "1"]]):
+            direct, daemon = tmp_path / f"direct_{i}.csv", tmp_path / f"daemon_{i}.csv"
+            subprocess.run([sys.executable, "analyze.py", *args, "-o", str(direct)], check=True, capture_output=True)
+            result = subprocess.run([sys.executable, "analyze.py", "--daemon", "--socket", socket_path, *args, "-o", str(daemon)], check=True, capture_output=True, text=True)
+            assert result.stdout == f"Output file created at: {daemon}\n"
+            assert direct.read_bytes() == daemon.read_bytes()
+        result = subprocess.run([sys.executable, "analyze.py", "--daemon", "--socket", socket_path, "missing_dir"], capture_output=True, text=True)
+        assert result.returncode == 1
+        assert "missing_dir is not a path" in result.stdout
+    finally:
+        result = subprocess.run([sys.executable, "analyze.py", "serve", "--socket", socket_path, "--stop"], check=True, capture_output=True, text=True)
+    assert result.stdout == "Daemon stopped\n"
+    for _ in range(100):
+        if not os.path.exists(socket_path):
+            break
+        time.sleep(0.05)
+    assert not os.path.exists(socket_path)
+
+#  ------------ Tests for bench -------------
+def read_tree(root) -> dict:
+    """
+    Map each file path under root (relative to root) to its content
+    """
+    contents = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            with open(file_path, "r", encoding="utf-8") as f:
+                contents[os.path.relpath(file_path, root)] = f.read()
+    return contents
+
+def test_generate_corpus_is_reproducible(tmp_path) -> None:
+    info = generate_corpus(str(tmp_path / "first"), files=5, divs=20, seed=3)
+    generate_corpus(str(tmp_path / "second"), files=5, divs=20, seed=3)
+    generate_corpus(str(tmp_path / "other"), files=5, divs=20, seed=4)
+
+    first = read_tree(tmp_path / "first")
+    assert len(first) == 5
+    assert first == read_tree(tmp_path / "second")
+    assert first != read_tree(tmp_path / "other")
+    assert info["tags"] == 100
+    assert info["bytes"] == sum(len(content.encode("utf-8")) for content in first.values())
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_run_benchmark_reports_every_stage(tmp_path, backend: str) -> None:
+    generate_corpus(str(tmp_path), files=3, divs=10, depth=2)
+    report = run_benchmark(str(tmp_path), backend=backend, trace_memory=True)
+    assert report["files"] == 3
+    assert report["tags"] == 30
+    assert list(report["stages"]) == ["get_filepaths", "parse_html", "parse_data", "analyze_db_info"]
+    for timing in report["stages"].values():
+        assert {"seconds", "cpu_seconds", "files_per_second", "tags_per_second", "peak_memory_bytes"} <= set(timing)